@@ -1,24 +1,25 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from sqlalchemy.orm import Session
 import logging
-import os
 import json
 
-from get_emails_info import get_emails_info_for_user, get_html_from_message_id
-from get_coupon_info_from_email import get_coupon_info_from_email
-from get_company_logo import get_company_logo_info
-from company_categorization import get_company_category
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
+from datetime import datetime
+
+from get_emails_info import get_html_from_message_id
+from coupon_refresh import create_gmail_service_for_user, refresh_coupons_for_user
+from refresh_jobs import start_refresh_job, get_refresh_job_status
+from coupon_stream import stream_coupon_events
 
 # Import authentication
 from auth.routes import router as auth_router, get_current_user
 from auth.schemas import UserResponse
 from auth.crud import get_user_by_id
-from database.connection import Base, engine, get_db
+from database.connection import Base, engine, get_db, SessionLocal
+from core.executor import run_blocking
 
 # Import Gmail webhooks
 from gmail_webhooks import router as gmail_webhook_router
@@ -55,57 +56,51 @@ app.include_router(gmail_webhook_router, tags=["gmail-webhooks"])
 # Include Gmail webhook routes
 app.include_router(gmail_webhook_router, tags=["gmail-webhooks"])
 
-def create_gmail_service_for_user(current_user: UserResponse, db: Session):
-    """Create a Gmail service using the user's stored tokens"""
-    # Get full user object to access Gmail tokens (UserResponse excludes sensitive fields)
-    user = get_user_by_id(db, current_user.id)
-    
-    if not user or not user.gmail_access_token:
-        raise HTTPException(status_code=400, detail="No Gmail access token found")
-    
-    user_creds = Credentials(
-        token=user.gmail_access_token,
-        refresh_token=user.gmail_refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("GOOGLE_CLIENT_ID"),
-        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-        scopes=[
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.modify'
-        ]
-    )
-    
-    return build('gmail', 'v1', credentials=user_creds)
-
 class CouponResponse(BaseModel):
     all_coupons: List[dict] = []
     total_emails_processed: int = 0
     emails_with_coupons: int = 0
 
+class RefreshJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, succeeded, failed
+    stage: Optional[str] = None  # fetching, extracting, saving, done
+    emails_total: Optional[int] = None
+    emails_fetched: int = 0
+    emails_ocred: int = 0
+    emails_extracted: int = 0
+    coupons_found: int = 0
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    @classmethod
+    def from_job(cls, job):
+        return cls(
+            job_id=job.id,
+            status=job.status,
+            stage=job.stage,
+            emails_total=job.emails_total,
+            emails_fetched=job.emails_fetched or 0,
+            emails_ocred=job.emails_ocred or 0,
+            emails_extracted=job.emails_extracted or 0,
+            coupons_found=job.coupons_found or 0,
+            error=job.error,
+            created_at=job.created_at,
+            started_at=job.started_at,
+            finished_at=job.finished_at
+        )
+
 class EmailHtmlResponse(BaseModel):
     success: bool
     message_id: str
     html_content: str
     error: Optional[str] = None
 
-@app.get("/api/coupons", response_model=CouponResponse)
-async def get_coupons(
-    refresh: bool = False,  # Add refresh parameter
-    current_user: UserResponse = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """
-    Extract coupon information from promotional emails for the authenticated user.
-    
-    This endpoint:
-    1. First checks the database for cached coupons
-    2. If no cached data or refresh=True, fetches from Gmail
-    3. Processes emails and caches results in database
-    4. Returns list of all coupons found
-    
-    Parameters:
-    - refresh: If True, clears cache and re-fetches from Gmail
-    """
+def get_coupons_for_user(current_user: UserResponse, refresh: bool) -> CouponResponse:
+    """Blocking implementation of GET /api/coupons, run on the blocking executor with its own session"""
+    db = SessionLocal()
     try:
         logger.info(f"Starting coupon retrieval for user: {current_user.email} (refresh={refresh})")
         
@@ -117,117 +112,33 @@ async def get_coupons(
                 detail="Gmail not connected. Please connect your Gmail account first."
             )
         
-        # Import CRUD functions
-        from auth.crud import get_all_user_coupons, save_user_coupons_batch, delete_all_user_coupons
+        from auth.crud import get_all_user_coupons
         
         # Check if we have cached coupons and refresh is not requested
         if not refresh:
             cached_coupons = get_all_user_coupons(db, current_user.id)
             if cached_coupons:
-                logger.info(f"Returning {len(cached_coupons)} cached coupons for user {current_user.email}")
                 # Parse coupon data from JSON strings
-                all_coupons = [json.loads(coupon.coupon_data) for coupon in cached_coupons]
+                cached_coupon_data = [json.loads(coupon.coupon_data) for coupon in cached_coupons]
+                logger.info(f"Returning {len(cached_coupons)} cached coupons for user {current_user.email}")
                 return CouponResponse(
-                    all_coupons=all_coupons,
+                    all_coupons=cached_coupon_data,
                     total_emails_processed=len(cached_coupons),
-                    emails_with_coupons=len(all_coupons)
+                    emails_with_coupons=len(cached_coupon_data)
                 )
             else:
                 logger.info(f"No cached coupons found for user {current_user.email}, fetching from Gmail")
         else:
-            logger.info(f"Refresh requested for user {current_user.email}, clearing cache and fetching from Gmail")
-            # Clear existing coupons
-            delete_all_user_coupons(db, current_user.id)
-        
-        # Create Gmail service using USER'S tokens (not static files!)
-        gmail_service = create_gmail_service_for_user(current_user, db)
-        logger.info(f"Created Gmail service for user {current_user.email}")
-        
-        # Get email texts using USER'S Gmail service
-        logger.info(f"Fetching emails for user {current_user.email}...")
-        emails_info = get_emails_info_for_user(gmail_service)
-        logger.info(f"Retrieved {len(emails_info) if emails_info else 0} emails for user {current_user.email}")
-        
-        if not emails_info:
-            logger.info(f"No promotional emails found for user {current_user.email}")
-            # Return empty result instead of error
-            return CouponResponse(
-                all_coupons=[],
-                total_emails_processed=0,
-                emails_with_coupons=0
-            )
+            logger.info(f"Refresh requested for user {current_user.email}, fetching new emails from Gmail")
         
-        logger.info(f"Processing {len(emails_info)} emails for user {current_user.email}")
+        refresh_result = refresh_coupons_for_user(db, user)
         
-        # Process each email (same as main.py)
-        all_coupons = []
-        for i, id in enumerate(emails_info):
-            logger.info(f"Processing email {i+1}/{len(emails_info)}")
-            
-            email_text = emails_info[id]["email_text"]
-            email_timestamp = emails_info[id]["email_timestamp"]
-            email_subject = emails_info[id]["email_subject"]
-            email_sender = emails_info[id]["email_sender"]
-
-            if not email_text or not email_text.strip():
-                continue
-                
-            coupons_json = get_coupon_info_from_email(email_text, email_subject, email_sender, email_timestamp)
-            
-            if "error" in coupons_json:
-                logger.warning(f"Error processing email {i+1}: {coupons_json['error']}")
-                continue
-                
-            if coupons_json.get("has_coupon", False):
-                # Get company logo and domain info
-                logo_info = get_company_logo_info(email_sender)
-                
-                # Get company category based on domain
-                company_domain = logo_info.get("domain")
-                if company_domain:
-                    company_category = get_company_category(company_domain)
-                else:
-                    # Fallback: extract domain from email sender
-                    if '@' in email_sender:
-                        sender_domain = email_sender.split('@')[-1].split('>')[0]
-                        company_category = get_company_category(sender_domain)
-                    else:
-                        company_category = 'general'
-                
-                # Add unique IDs to each offer
-                if "offers" in coupons_json:
-                    for offer_idx, offer in enumerate(coupons_json["offers"]):
-                        # Generate unique ID using message_id + offer index (guaranteed unique)
-                        unique_id = f"{id}_{offer_idx}"
-                        offer["id"] = unique_id
-                
-                # Insert timestamp, subject, sender, and message_id in dict
-                coupons_json = {"timestamp": email_timestamp.isoformat() if hasattr(email_timestamp, 'isoformat') else str(email_timestamp), **coupons_json}
-                coupons_json = {"subject": email_subject, **coupons_json}
-                coupons_json = {"sender": email_sender, **coupons_json}
-                coupons_json = {"message_id": id, **coupons_json}
-                coupons_json = {"company_domain": company_domain, **coupons_json}
-                coupons_json = {"company_logo_url": logo_info.get("logo_url"), **coupons_json}
-                coupons_json = {"company_category": company_category, **coupons_json}
-
-                # has_coupon will always be True, no need to include in backend JSON
-                coupons_json.pop("has_coupon", None) 
-                
-                all_coupons.append(coupons_json)
-                
-                logger.info(f"Found coupons in email {i+1}")
-        
-        logger.info(f"Total coupons found: {len(all_coupons)} out of {len(emails_info)} emails for user {current_user.email}")
-        
-        # Save coupons to database for caching
-        if all_coupons:
-            logger.info(f"Saving {len(all_coupons)} coupons to database for user {current_user.email}")
-            save_user_coupons_batch(db, current_user.id, all_coupons)
-            logger.info("Coupons saved successfully")
+        # Newest emails first, followed by previously cached coupons
+        all_coupons = refresh_result["new_coupons"] + refresh_result["cached_coupons"]
         
         return CouponResponse(
             all_coupons=all_coupons,
-            total_emails_processed=len(emails_info),
+            total_emails_processed=refresh_result["emails_processed"],
             emails_with_coupons=len(all_coupons)
         )
         
@@ -239,6 +150,119 @@ async def get_coupons(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
         )
+    finally:
+        db.close()
+
+def start_refresh_job_for_user(user_id: int) -> RefreshJobResponse:
+    """Blocking part of POST /api/coupons/refresh, with its own session"""
+    db = SessionLocal()
+    try:
+        return RefreshJobResponse.from_job(start_refresh_job(db, user_id))
+    finally:
+        db.close()
+
+def get_refresh_job_for_user(job_id: str, user_id: int) -> Optional[RefreshJobResponse]:
+    """Blocking part of GET /api/jobs/{job_id}, with its own session; None if the user has no such job"""
+    db = SessionLocal()
+    try:
+        job = get_refresh_job_status(db, job_id)
+        if not job or job.user_id != user_id:
+            return None
+        return RefreshJobResponse.from_job(job)
+    finally:
+        db.close()
+
+def get_email_html_for_user(current_user: UserResponse, message_id: str) -> Optional[str]:
+    """Blocking part of GET /api/email_html/{message_id}, with its own session"""
+    db = SessionLocal()
+    try:
+        # Create Gmail service using USER'S tokens
+        gmail_service = create_gmail_service_for_user(current_user, db)
+    finally:
+        db.close()
+    # Get HTML content using the existing function
+    return get_html_from_message_id(gmail_service, message_id)
+
+@app.get("/api/coupons", response_model=CouponResponse)
+async def get_coupons(
+    refresh: bool = False,  # Add refresh parameter
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """
+    Extract coupon information from promotional emails for the authenticated user.
+    
+    This endpoint:
+    1. First checks the database for cached coupons
+    2. If no cached data or refresh=True, fetches emails added since the last sync
+       from Gmail (delta sync via historyId, full sync if the history ID expired)
+    3. Processes emails that were not processed before and caches results in database
+    4. Returns list of all coupons found
+    
+    Parameters:
+    - refresh: If True, fetches and processes new emails from Gmail
+    """
+    # Gmail, OCR and Gemini calls block, so keep them off the event loop
+    return await run_blocking(get_coupons_for_user, current_user, refresh)
+
+@app.get("/api/coupons/stream")
+async def stream_coupons(
+    refresh: bool = False,
+    current_user: UserResponse = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Streaming variant of GET /api/coupons, as newline-delimited JSON.
+    
+    Emits the cached coupons first, then each new coupon as soon as its email
+    is processed, with progress events in between and a final done (or error)
+    event. See coupon_stream.py for the event format.
+    """
+    user = get_user_by_id(db, current_user.id)
+    if not user or not user.gmail_connected or not user.gmail_access_token:
+        raise HTTPException(
+            status_code=400, 
+            detail="Gmail not connected. Please connect your Gmail account first."
+        )
+    
+    return StreamingResponse(
+        stream_coupon_events(current_user.id, refresh),
+        media_type="application/x-ndjson",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/coupons/refresh", response_model=RefreshJobResponse, status_code=202)
+async def refresh_coupons(
+    current_user: UserResponse = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Start a background refresh of the authenticated user's coupons.
+    
+    Returns a job right away; poll GET /api/jobs/{job_id} for progress
+    and read the new coupons from GET /api/coupons once it succeeded.
+    """
+    user = get_user_by_id(db, current_user.id)
+    if not user or not user.gmail_connected or not user.gmail_access_token:
+        raise HTTPException(
+            status_code=400, 
+            detail="Gmail not connected. Please connect your Gmail account first."
+        )
+    
+    return await run_blocking(start_refresh_job_for_user, current_user.id)
+
+@app.get("/api/jobs/{job_id}", response_model=RefreshJobResponse)
+async def get_job(
+    job_id: str,
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """
+    Get the status and progress (emails fetched, OCRed, extracted) of a refresh job.
+    """
+    job = await run_blocking(get_refresh_job_for_user, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @app.get("/api/email_html/{message_id}", response_model=EmailHtmlResponse)
 async def get_email_html(
@@ -260,11 +284,7 @@ async def get_email_html(
                 detail="Gmail not connected. Please connect your Gmail account first."
             )
         
-        # Create Gmail service using USER'S tokens
-        gmail_service = create_gmail_service_for_user(current_user, db)
-        
-        # Get HTML content using the existing function
-        html_content = get_html_from_message_id(gmail_service, message_id)
+        html_content = await run_blocking(get_email_html_for_user, current_user, message_id)
         
         if not html_content:
             raise HTTPException(
@@ -4,11 +4,13 @@ CRUD operations for authentication
 from typing import Optional
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
-from .models import User, UserCoupon
+from sqlalchemy.exc import IntegrityError
+from .models import User, UserCoupon, ProcessedEmail, PendingEmail, RefreshJob, RefreshLock
 from .schemas import UserCreate, UserUpdate, GoogleUserInfo
 from core.security import get_password_hash
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 
 def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
     """Get user by ID"""
@@ -74,6 +76,15 @@ def update_gmail_tokens(
     db.refresh(user)
     return user
 
+def update_gmail_sync_history_id(db: Session, user: User, history_id: str) -> User:
+    """Update the Gmail history ID the next delta sync starts from"""
+    user.gmail_sync_history_id = history_id
+    user.updated_at = datetime.utcnow()
+    
+    db.commit()
+    db.refresh(user)
+    return user
+
 def disconnect_gmail(db: Session, user: User) -> User:
     """Disconnect user's Gmail account"""
     user.gmail_access_token = None
@@ -149,3 +160,183 @@ def delete_all_user_coupons(db: Session, user_id: int):
     """Delete all coupons for a user (for refresh)"""
     db.query(UserCoupon).filter(UserCoupon.user_id == user_id).delete()
     db.commit()
+
+# Processed emails CRUD
+def get_processed_email_ids(db: Session, user_id: int, email_ids) -> set:
+    """Which of the given Gmail message IDs were already run through the coupon pipeline for a user"""
+    email_ids = list(email_ids)
+    if not email_ids:
+        return set()
+    processed = db.query(ProcessedEmail.email_id).filter(
+        and_(ProcessedEmail.user_id == user_id, ProcessedEmail.email_id.in_(email_ids))
+    )
+    coupons = db.query(UserCoupon.email_id).filter(
+        and_(UserCoupon.user_id == user_id, UserCoupon.email_id.in_(email_ids))
+    )
+    return {email_id for (email_id,) in processed.union(coupons)}
+
+def get_processed_campaign_dates(db: Session, user_id: int, campaign_keys) -> dict:
+    """Dates of the user's processed emails for each of the given campaign keys"""
+    campaign_keys = list(campaign_keys)
+    if not campaign_keys:
+        return {}
+    rows = db.query(ProcessedEmail.campaign_key, ProcessedEmail.email_timestamp, ProcessedEmail.created_at).filter(
+        and_(ProcessedEmail.user_id == user_id, ProcessedEmail.campaign_key.in_(campaign_keys))
+    )
+    campaign_dates = {}
+    for campaign_key, email_timestamp, created_at in rows:
+        # Rows saved before email dates were stored fall back to when they were processed
+        campaign_dates.setdefault(campaign_key, []).append(email_timestamp or created_at)
+    return campaign_dates
+
+def save_processed_emails_batch(db: Session, user_id: int, processed_list: list):
+    """Record emails that have been processed so later refreshes can skip them"""
+    processed_records = []
+    for processed in processed_list:
+        processed_record = ProcessedEmail(
+            user_id=user_id,
+            email_id=processed.get("message_id", ""),
+            sender=processed.get("sender"),
+            subject=processed.get("subject"),
+            email_timestamp=processed.get("email_timestamp") or None,
+            campaign_key=processed.get("campaign_key"),
+            has_coupon=processed.get("has_coupon", False),
+            llm_labeled=processed.get("llm_labeled", True),
+            classifier_score=processed.get("classifier_score"),
+            classifier_threshold=processed.get("classifier_threshold"),
+            classifier_features=json.dumps(processed["classifier_features"]) if processed.get("classifier_features") else None
+        )
+        processed_records.append(processed_record)
+    
+    db.add_all(processed_records)
+    db.commit()
+    return processed_records
+
+# Pending (failed) emails CRUD
+def get_pending_email_ids(db: Session, user_id: int) -> list:
+    """Get the IDs of emails a previous refresh failed on, to retry them"""
+    pending = db.query(PendingEmail.email_id).filter(PendingEmail.user_id == user_id).order_by(PendingEmail.created_at)
+    return [email_id for (email_id,) in pending]
+
+def update_pending_emails(db: Session, user_id: int, retried_ids, failed_emails: dict, max_attempts: int) -> list:
+    """
+    Record a refresh's failures: retried emails that went through are dropped,
+    failed ones count an attempt and are given up on after max_attempts.
+    Returns the IDs given up on.
+    """
+    email_ids = set(retried_ids) | set(failed_emails)
+    if not email_ids:
+        return []
+    pending = {
+        entry.email_id: entry for entry in db.query(PendingEmail).filter(
+            and_(PendingEmail.user_id == user_id, PendingEmail.email_id.in_(email_ids))
+        )
+    }
+    given_up = []
+    now = datetime.utcnow()
+    for email_id in email_ids:
+        entry = pending.get(email_id)
+        if email_id not in failed_emails:
+            if entry:
+                db.delete(entry)
+            continue
+        attempts = (entry.attempts if entry else 0) + 1
+        if attempts >= max_attempts:
+            given_up.append(email_id)
+            if entry:
+                db.delete(entry)
+            continue
+        if entry is None:
+            entry = PendingEmail(user_id=user_id, email_id=email_id, created_at=now)
+            db.add(entry)
+        entry.attempts = attempts
+        entry.last_error = str(failed_emails[email_id])[:1000]
+        entry.updated_at = now
+    db.commit()
+    return given_up
+
+def create_refresh_job(db: Session, user_id: int) -> RefreshJob:
+    """Create a queued coupon refresh job"""
+    job = RefreshJob(id=str(uuid.uuid4()), user_id=user_id, status="queued", updated_at=datetime.utcnow())
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def get_refresh_job(db: Session, job_id: str) -> Optional[RefreshJob]:
+    """Get a refresh job by ID"""
+    return db.query(RefreshJob).filter(RefreshJob.id == job_id).first()
+
+def get_active_refresh_job(db: Session, user_id: int) -> Optional[RefreshJob]:
+    """Get the user's most recent queued or running refresh job"""
+    return db.query(RefreshJob).filter(
+        and_(RefreshJob.user_id == user_id, RefreshJob.status.in_(("queued", "running")))
+    ).order_by(RefreshJob.created_at.desc()).first()
+
+def update_refresh_job(db: Session, job_id: str, **fields) -> Optional[RefreshJob]:
+    """Update a refresh job's status/progress fields"""
+    job = get_refresh_job(db, job_id)
+    if not job:
+        return None
+    for field, value in fields.items():
+        setattr(job, field, value)
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    return job
+
+def touch_refresh_jobs(db: Session, job_ids: list, statuses: tuple):
+    """Mark refresh jobs that are still in one of statuses as alive"""
+    db.query(RefreshJob).filter(
+        and_(RefreshJob.id.in_(job_ids), RefreshJob.status.in_(statuses))
+    ).update({"updated_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+
+def fail_stale_refresh_job(db: Session, job_id: str, statuses: tuple, updated_before: datetime, error: str) -> bool:
+    """Mark a refresh job failed if it is still in one of statuses and wasn't updated since updated_before"""
+    failed = db.query(RefreshJob).filter(
+        and_(RefreshJob.id == job_id, RefreshJob.status.in_(statuses), RefreshJob.updated_at < updated_before)
+    ).update(
+        {"status": "failed", "error": error, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.commit()
+    return failed > 0
+
+def acquire_refresh_lock(db: Session, user_id: int, owner: str, ttl: timedelta) -> bool:
+    """Take the user's refresh lock (or an expired one); False if another refresh holds it"""
+    now = datetime.utcnow()
+    taken_over = db.query(RefreshLock).filter(
+        and_(RefreshLock.user_id == user_id, RefreshLock.expires_at < now)
+    ).update({"owner": owner, "acquired_at": now, "expires_at": now + ttl}, synchronize_session=False)
+    if taken_over:
+        db.commit()
+        return True
+    try:
+        db.add(RefreshLock(user_id=user_id, owner=owner, acquired_at=now, expires_at=now + ttl))
+        db.commit()
+        return True
+    except IntegrityError:
+        # Another worker holds the lock
+        db.rollback()
+        return False
+
+def renew_refresh_lock(db: Session, user_id: int, owner: str, ttl: timedelta) -> bool:
+    """Extend the user's refresh lock if this owner still holds it; False if it was lost"""
+    renewed = db.query(RefreshLock).filter(
+        and_(RefreshLock.user_id == user_id, RefreshLock.owner == owner)
+    ).update({"expires_at": datetime.utcnow() + ttl}, synchronize_session=False)
+    db.commit()
+    return renewed > 0
+
+def is_refresh_locked(db: Session, user_id: int) -> bool:
+    """Whether a refresh for the user holds an unexpired lock"""
+    return db.query(RefreshLock).filter(
+        and_(RefreshLock.user_id == user_id, RefreshLock.expires_at >= datetime.utcnow())
+    ).count() > 0
+
+def release_refresh_lock(db: Session, user_id: int, owner: str):
+    """Release the user's refresh lock if this owner still holds it"""
+    db.query(RefreshLock).filter(
+        and_(RefreshLock.user_id == user_id, RefreshLock.owner == owner)
+    ).delete(synchronize_session=False)
+    db.commit()
@@ -1,7 +1,7 @@
 """
 Database models for authentication
 """
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Float, UniqueConstraint
 from sqlalchemy.sql import func
 from database.connection import Base
 
@@ -21,6 +21,7 @@ class User(Base):
     gmail_refresh_token = Column(Text, nullable=True)  # Encrypted
     gmail_token_expiry = Column(DateTime, nullable=True)
     gmail_history_id = Column(String, nullable=True)  # Last processed Gmail history ID
+    gmail_sync_history_id = Column(String, nullable=True)  # History ID the last completed coupon sync read up to
     gmail_watch_expiration = Column(DateTime, nullable=True)  # When Gmail watch expires
     
     # Timestamps
@@ -46,3 +47,126 @@ class UserCoupon(Base):
     
     def __repr__(self):
         return f"<UserCoupon(user_id={self.user_id}, email_id='{self.email_id}')>"
+
+class ProcessedEmail(Base):
+    __tablename__ = "user_processed_emails"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)  # Foreign key to User
+    email_id = Column(String, nullable=False, index=True)  # Gmail message ID
+    sender = Column(String, nullable=True)
+    subject = Column(String, nullable=True)
+    email_timestamp = Column(DateTime, nullable=True)  # Email date, to tell re-sends of a campaign from new editions
+    campaign_key = Column(String, nullable=True, index=True)  # get_campaign_key(sender, subject), to look re-sends up
+    has_coupon = Column(Boolean, default=False)  # Gemini label for this email
+    llm_labeled = Column(Boolean, default=True)  # False when the pre-classifier skipped Gemini
+    classifier_score = Column(Float, nullable=True)  # Pre-classifier coupon probability
+    classifier_threshold = Column(Float, nullable=True)  # Threshold the score was compared to, to spot shadow samples
+    classifier_features = Column(Text, nullable=True)  # JSON feature vector, for retraining and reports
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    
+    def __repr__(self):
+        return f"<ProcessedEmail(user_id={self.user_id}, email_id='{self.email_id}')>"
+
+class PendingEmail(Base):
+    __tablename__ = "user_pending_emails"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)  # Foreign key to User
+    email_id = Column(String, nullable=False)  # Gmail message ID that failed to fetch or extract
+    attempts = Column(Integer, nullable=False, default=0)  # Refreshes that failed on this email so far
+    last_error = Column(Text, nullable=True)
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now())
+    
+    __table_args__ = (UniqueConstraint("user_id", "email_id"),)
+    
+    def __repr__(self):
+        return f"<PendingEmail(user_id={self.user_id}, email_id='{self.email_id}', attempts={self.attempts})>"
+
+class OcrCacheEntry(Base):
+    __tablename__ = "ocr_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True, nullable=False)  # "url:<sha256>" or "content:<sha256>"
+    status = Column(String, nullable=False)  # ok, no_text, not_image, download_failed
+    text = Column(Text, nullable=True)  # OCR text (empty for negative results)
+    etag = Column(String, nullable=True)  # ETag of the image response, to revalidate URL entries
+    last_modified = Column(String, nullable=True)  # Last-Modified of the image response
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    last_used_at = Column(DateTime, server_default=func.now(), index=True)  # For LRU eviction
+    
+    def __repr__(self):
+        return f"<OcrCacheEntry(cache_key='{self.cache_key}', status='{self.status}')>"
+
+class CompanyLogoEntry(Base):
+    __tablename__ = "company_logos"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    domain = Column(String, unique=True, index=True, nullable=False)  # Root domain, e.g. potbelly.com
+    logo_url = Column(String, nullable=True)  # None if no logo source worked (default logo is used)
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    last_used_at = Column(DateTime, server_default=func.now(), index=True)  # For LRU eviction
+    
+    def __repr__(self):
+        return f"<CompanyLogoEntry(domain='{self.domain}', logo_url='{self.logo_url}')>"
+
+class ExtractionCacheEntry(Base):
+    __tablename__ = "extraction_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True, nullable=False)  # sha256 of prompt version, model and normalized email
+    prompt_version = Column(String, nullable=False)
+    model_name = Column(String, nullable=False)
+    result_data = Column(Text, nullable=False)  # JSON string of the parsed offer info
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    last_used_at = Column(DateTime, server_default=func.now(), index=True)  # For LRU eviction
+    
+    def __repr__(self):
+        return f"<ExtractionCacheEntry(cache_key='{self.cache_key}', prompt_version='{self.prompt_version}')>"
+
+class RefreshJob(Base):
+    __tablename__ = "refresh_jobs"
+    
+    id = Column(String, primary_key=True, index=True)  # UUID
+    user_id = Column(Integer, nullable=False, index=True)  # Foreign key to User
+    status = Column(String, nullable=False, default="queued")  # queued, running, succeeded, failed
+    stage = Column(String, nullable=True)  # fetching, extracting, saving
+    
+    # Progress
+    emails_total = Column(Integer, nullable=True)  # Known once fetching is done
+    emails_fetched = Column(Integer, default=0)
+    emails_ocred = Column(Integer, default=0)  # Emails whose images went through OCR
+    emails_extracted = Column(Integer, default=0)
+    coupons_found = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, server_default=func.now())  # Last progress write, to detect dead workers
+    
+    def __repr__(self):
+        return f"<RefreshJob(id='{self.id}', user_id={self.user_id}, status='{self.status}')>"
+
+class RefreshLock(Base):
+    __tablename__ = "refresh_locks"
+    
+    user_id = Column(Integer, primary_key=True)  # One refresh per user at a time, across API workers
+    owner = Column(String, nullable=False)  # host:pid:uuid of the refresh holding the lock
+    acquired_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)  # Lets another worker take over if the holder died
+    
+    def __repr__(self):
+        return f"<RefreshLock(user_id={self.user_id}, owner='{self.owner}')>"
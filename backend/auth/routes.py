@@ -139,13 +139,14 @@ async def test_oauth_callback():
     return {"message": "OAuth callback route is working", "timestamp": str(datetime.now())}
 
 @router.get("/google/callback")
-async def google_oauth_callback_redirect(
+def google_oauth_callback_redirect(
     code: str,
     state: str = None,
     db: Session = Depends(get_db)
 ):
     """
     Handle Google OAuth callback and redirect to mobile app
+    (plain def: the token exchange and Gmail watch setup block, so FastAPI runs it in its threadpool)
     """
     logger.info("=== GOOGLE OAUTH CALLBACK STARTED ===")
     logger.info(f"Received authorization code: {code[:20]}...")  # Log first 20 chars for security
@@ -359,12 +360,13 @@ async def google_oauth_callback_redirect(
         return RedirectResponse(url=error_url)
 
 @router.post("/google", response_model=TokenResponse)
-async def google_auth(
+def google_auth(
     auth_request: GoogleAuthRequest,
     db: Session = Depends(get_db)
 ):
     """
     Authenticate user with Google ID token
+    (plain def: verifying the token may fetch Google's certificates, so FastAPI runs it in its threadpool)
     """
     try:
         # Verify the Google ID token
@@ -0,0 +1,54 @@
+"""
+Gemini client setup microbenchmark
+Measures the per-call setup that happened before every OCR and extraction
+request (genai.configure, a new GenerativeModel and, because configure drops
+the cached clients, a new GenerativeServiceClient) against getting the shared
+model from core.gemini. No requests are sent.
+
+The fresh client per call also meant a new gRPC channel, so every request paid
+a new TLS handshake on top of what is measured here.
+
+Usage:
+    python benchmark_gemini_setup.py [calls]
+"""
+import os
+import sys
+import time
+
+import google.generativeai as genai
+from google.generativeai import client
+
+from core import gemini
+
+MODEL_NAME = "gemini-2.5-flash-lite"
+
+def setup_per_call():
+    """What every call did before: configure, build a model, build its client"""
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY", "benchmark"))
+    model = genai.GenerativeModel(MODEL_NAME)
+    model._client = client.get_default_generative_client()
+    return model
+
+def setup_shared():
+    """Registry lookup; the model keeps the client it created on first use"""
+    model = gemini.get_model(MODEL_NAME, "benchmark")
+    if model._client is None:
+        model._client = client.get_default_generative_client()
+    return model
+
+def time_calls(setup, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        setup()
+    return (time.perf_counter() - start) / calls
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+    per_call = time_calls(setup_per_call, calls)
+    shared = time_calls(setup_shared, calls)
+    print(f"Setup per call, {calls} calls:")
+    print(f"  configure + new model + new client: {per_call * 1000:.3f} ms")
+    print(f"  shared model from core.gemini:      {shared * 1000:.4f} ms")
+    print(f"  saved per 1000 Gemini calls: {(per_call - shared) * 1000 * 1000:.0f} ms of CPU (plus a TLS handshake each)")
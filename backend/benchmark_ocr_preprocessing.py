@@ -0,0 +1,92 @@
+"""
+OCR image preprocessing benchmark
+Compares what each email image costs before and after prepare_image_for_ocr:
+memory held while waiting for OCR, bytes uploaded to Gemini and CPU time.
+
+Before: the full-resolution RGB bitmap is kept in memory and google.generativeai
+uploads it as a lossless WebP. After: only the downscaled, re-encoded blob is kept
+and uploaded as is.
+
+Usage:
+    python benchmark_ocr_preprocessing.py [image_directory]
+
+Without a directory a synthetic corpus of retina-sized banners is generated.
+"""
+import os
+import sys
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw
+
+from get_emails_info import prepare_image_for_ocr
+
+def synthetic_corpus():
+    """Retina hero banners, product shots and an animated GIF, as encoded bytes"""
+    corpus = []
+    for width, height, image_format in [(2400, 1200, "JPEG"), (3000, 1500, "JPEG"), (1800, 2400, "PNG"), (1200, 600, "PNG")]:
+        image = Image.effect_noise((width, height), 40).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for line in range(8):
+            draw.text((width // 10, height // 10 + line * 40), "SUMMER SALE 40% OFF WITH CODE SUN40", fill=(255, 255, 255))
+        encoded = BytesIO()
+        image.save(encoded, format=image_format, quality=92)
+        corpus.append((f"banner_{width}x{height}.{image_format.lower()}", encoded.getvalue()))
+
+    frames = [Image.effect_noise((1000, 500), 20 + frame * 10).convert("P") for frame in range(12)]
+    encoded = BytesIO()
+    frames[0].save(encoded, format="GIF", save_all=True, append_images=frames[1:], duration=100)
+    corpus.append(("animated_1000x500.gif", encoded.getvalue()))
+    return corpus
+
+def directory_corpus(directory):
+    """Every file in a directory, as (name, bytes)"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as image_file:
+                corpus.append((name, image_file.read()))
+    return corpus
+
+def measure_before(image_bytes):
+    """Old path: full-size RGB bitmap in memory, lossless WebP upload"""
+    start = time.perf_counter()
+    image = Image.open(BytesIO(image_bytes))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    upload = BytesIO()
+    image.save(upload, format="webp", lossless=True)
+    held_bytes = image.width * image.height * len(image.getbands())
+    return held_bytes, upload.tell(), time.perf_counter() - start
+
+def measure_after(image_bytes):
+    """New path: only the prepared blob is held and uploaded"""
+    start = time.perf_counter()
+    blob = prepare_image_for_ocr(image_bytes)
+    return len(blob["data"]), len(blob["data"]), time.perf_counter() - start
+
+def run_benchmark(corpus):
+    totals = {"before": [0, 0, 0.0], "after": [0, 0, 0.0]}
+    print(f"{'image':<28} {'held before':>12} {'held after':>11} {'upload before':>14} {'upload after':>13}")
+    for name, image_bytes in corpus:
+        try:
+            before = measure_before(image_bytes)
+            after = measure_after(image_bytes)
+        except Exception as e:
+            print(f"{name:<28} skipped ({e})")
+            continue
+        for key, result in (("before", before), ("after", after)):
+            for index in range(3):
+                totals[key][index] += result[index]
+        print(f"{name[:28]:<28} {before[0] / 1024:>10.0f}KB {after[0] / 1024:>9.0f}KB {before[1] / 1024:>12.0f}KB {after[1] / 1024:>11.0f}KB")
+
+    held_before, upload_before, time_before = totals["before"]
+    held_after, upload_after, time_after = totals["after"]
+    print()
+    print(f"Memory held for OCR: {held_before / 1024 / 1024:.1f} MB -> {held_after / 1024 / 1024:.1f} MB")
+    print(f"Bytes uploaded:      {upload_before / 1024 / 1024:.1f} MB -> {upload_after / 1024 / 1024:.1f} MB")
+    print(f"CPU time:            {time_before:.2f} s -> {time_after:.2f} s")
+
+if __name__ == "__main__":
+    corpus = directory_corpus(sys.argv[1]) if len(sys.argv) > 1 else synthetic_corpus()
+    run_benchmark(corpus)
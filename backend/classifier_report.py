@@ -0,0 +1,103 @@
+"""
+Pre-classifier precision/recall report
+Scores every processed email that has a Gemini label with the current
+classifier weights and prints precision, recall and the share of emails that
+would still go to Gemini at a range of thresholds.
+
+Emails the classifier skipped only have a Gemini label when they were shadow
+sampled (scored below the threshold stored with them), so those rows are
+weighted by 1 / classifier_shadow_rate to stand in for all skipped emails.
+
+Usage:
+    python classifier_report.py [--train weights.json] [--user-id ID]
+
+--train fits new weights on the labels (weighted logistic regression), writes
+them to the given file and reports with them; point CLASSIFIER_WEIGHTS_PATH at
+the file to use them in the pipeline.
+"""
+import sys
+import json
+import argparse
+
+from core.config import settings
+from database.connection import SessionLocal
+from auth.models import ProcessedEmail
+from coupon_classifier import FEATURE_NAMES, get_weights, score_features
+
+REPORT_THRESHOLDS = [0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]
+
+def load_labeled_examples(user_id=None):
+    """(features, has_coupon, weight) for every Gemini-labeled email with classifier features"""
+    db = SessionLocal()
+    try:
+        query = db.query(ProcessedEmail).filter(
+            ProcessedEmail.llm_labeled.is_(True),
+            ProcessedEmail.classifier_features.isnot(None)
+        )
+        if user_id is not None:
+            query = query.filter(ProcessedEmail.user_id == user_id)
+
+        shadow_weight = 1.0 / settings.classifier_shadow_rate if settings.classifier_shadow_rate > 0 else 1.0
+        examples = []
+        for processed in query:
+            # Rows saved before thresholds were stored are compared to the current one
+            threshold = processed.classifier_threshold
+            if threshold is None:
+                threshold = settings.classifier_threshold
+            shadow_sampled = processed.classifier_score is not None and processed.classifier_score < threshold
+            examples.append((json.loads(processed.classifier_features), bool(processed.has_coupon), shadow_weight if shadow_sampled else 1.0))
+        return examples
+    finally:
+        db.close()
+
+def train_weights(examples, iterations=2000, learning_rate=0.5, l2=0.001):
+    """Fit logistic regression weights with batch gradient descent"""
+    weights = {name: 0.0 for name in ("bias",) + FEATURE_NAMES}
+    total_weight = sum(weight for _, _, weight in examples)
+    for _ in range(iterations):
+        gradients = {name: 0.0 for name in weights}
+        for features, label, weight in examples:
+            error = (score_features(features, weights) - (1.0 if label else 0.0)) * weight
+            gradients["bias"] += error
+            for name in FEATURE_NAMES:
+                gradients[name] += error * features.get(name, 0.0)
+        for name in weights:
+            penalty = l2 * weights[name] if name != "bias" else 0.0
+            weights[name] -= learning_rate * (gradients[name] / total_weight + penalty)
+    return {name: round(value, 4) for name, value in weights.items()}
+
+def print_report(examples, weights):
+    positives = sum(weight for _, label, weight in examples if label)
+    total = sum(weight for _, _, weight in examples)
+    print(f"{len(examples)} labeled emails ({positives:.0f} of {total:.0f} weighted have coupons)")
+    print(f"Current threshold: {settings.classifier_threshold}, shadow rate: {settings.classifier_shadow_rate}\n")
+
+    scored = [(score_features(features, weights), label, weight) for features, label, weight in examples]
+    print(f"{'threshold':>9} {'precision':>10} {'recall':>7} {'sent to LLM':>12}")
+    for threshold in sorted(set(REPORT_THRESHOLDS + [settings.classifier_threshold])):
+        true_positives = sum(weight for score, label, weight in scored if score >= threshold and label)
+        sent = sum(weight for score, _, weight in scored if score >= threshold)
+        precision = true_positives / sent if sent else 0.0
+        recall = true_positives / positives if positives else 0.0
+        marker = "  <- current" if threshold == settings.classifier_threshold else ""
+        print(f"{threshold:>9.2f} {precision:>10.1%} {recall:>7.1%} {sent / total if total else 0.0:>12.1%}{marker}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-classifier precision/recall report")
+    parser.add_argument("--train", metavar="WEIGHTS_FILE", help="fit weights on the labels and write them to this file")
+    parser.add_argument("--user-id", type=int, help="only use one user's emails")
+    args = parser.parse_args()
+
+    examples = load_labeled_examples(args.user_id)
+    if not examples:
+        print("❌ No Gemini-labeled emails with classifier features yet")
+        sys.exit(1)
+
+    weights = get_weights()
+    if args.train:
+        weights = train_weights(examples)
+        with open(args.train, "w") as weights_file:
+            json.dump(weights, weights_file, indent=2)
+        print(f"✅ Wrote trained weights to {args.train}: {weights}\n")
+
+    print_report(examples, weights)
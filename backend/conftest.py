@@ -0,0 +1,19 @@
+"""
+Shared test fixtures
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database.connection import Base
+import auth.models  # noqa: F401  (registers the tables on Base)
+
+
+@pytest.fixture
+def memory_session_local():
+    """A SessionLocal bound to a fresh in-memory SQLite database with every table created"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
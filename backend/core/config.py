@@ -30,6 +30,101 @@ class Settings(BaseSettings):
         "https://www.googleapis.com/auth/userinfo.email",
         "https://www.googleapis.com/auth/userinfo.profile"
     ]
+    gmail_batch_size: int = 50  # Max messages per Gmail HTTP batch request (API limit is 100, but batches over 50 tend to hit rateLimitExceeded)
+    gmail_max_retries: int = 3  # Retries for messages a batch answered with a rate limit or 5xx error
+    gmail_backoff_base_seconds: float = 1.0  # First retry delay, doubled on each further retry
+    gmail_page_size: int = 100  # maxResults per messages().list page (API limit is 500)
+    gmail_max_messages: int = 50  # Total promotional emails read per refresh (0 = no cap)
+    gmail_query: Optional[str] = None  # Gmail search window, e.g. "newer_than:30d"
+    gmail_retry_max_attempts: int = 5  # Refreshes that retry an email which failed to fetch or extract before giving up on it
+    campaign_dedup_window_hours: int = 12  # Same sender+subject within this of a processed email counts as a re-send
+    
+    # Coupon pipeline concurrency
+    pipeline_max_workers: int = 16  # Emails processed at once across all users
+    pipeline_per_user_concurrency: int = 8  # Emails of one user processed at once
+    blocking_executor_workers: int = 32  # Threads for blocking Gmail/Gemini/DB work off the event loop
+    
+    # Image OCR cache
+    ocr_cache_enabled: bool = True
+    ocr_cache_ttl_days: int = 30  # How long OCR results (including "no text") are reused
+    ocr_cache_url_ttl_hours: int = 24  # How long a URL's result is trusted before the image is revalidated or re-downloaded
+    ocr_cache_negative_ttl_hours: int = 24  # How long "not an image"/"download failed" results are reused
+    ocr_cache_max_entries: int = 50000  # Least recently used entries beyond this are evicted
+    
+    # Company logo cache
+    logo_cache_enabled: bool = True
+    logo_cache_ttl_days: int = 30  # How long a domain's working logo URL is reused
+    logo_cache_negative_ttl_hours: int = 24  # How long "no logo found, use default" is reused
+    logo_cache_max_entries: int = 20000  # Least recently used domains beyond this are evicted
+    logo_cache_memory_entries: int = 2048  # Domains kept in each process's in-memory LRU
+    
+    # Pre-OCR image triage
+    ocr_min_image_dimension: int = 50  # Images with less area than this squared (px) are never OCRed, so 600x40 strips still are
+    ocr_probe_image_size: bool = True  # Check the real size of downloaded images, since HTML often gives none
+    
+    # Image OCR concurrency
+    ocr_global_concurrency: int = 16  # Images downloaded/OCRed at once across all emails
+    ocr_per_email_concurrency: int = 6  # Images of one email downloaded/OCRed at once
+    ocr_image_timeout_seconds: float = 30.0  # Time budget for downloading and OCRing one image
+    ocr_images_per_request: int = 6  # Images of one email sent together in one Gemini vision call (1 = one call per image)
+    ocr_request_byte_budget: int = 1536 * 1024  # Most encoded image bytes sent in one Gemini vision call
+    
+    # Image preprocessing before OCR upload
+    ocr_max_image_dimension: int = 1600  # Longest side (px) of images sent to Gemini
+    ocr_image_byte_budget: int = 300 * 1024  # Target encoded size of each image sent to Gemini
+    ocr_image_format: str = "JPEG"  # JPEG or WEBP
+    ocr_grayscale: bool = True  # Send grayscale images (text stays readable, fewer bytes)
+    
+    # When to OCR email images: "always", "never" or "adaptive" (only when the text has no offer)
+    ocr_policy: str = "adaptive"
+    ocr_min_text_chars: int = 200  # Adaptive: plain text shorter than this is "thin" and always gets OCR
+    ocr_min_offer_signals: int = 1  # Adaptive: distinct offer signals (%, currency, code) needed to skip OCR
+    
+    # Coupon extraction cache shared across users
+    extraction_cache_enabled: bool = True
+    extraction_cache_ttl_days: int = 14
+    extraction_cache_max_entries: int = 100000  # Least recently used entries beyond this are evicted
+    
+    # Batched coupon extraction
+    extraction_batch_size: int = 8  # Emails packed into one Gemini request (1 = one request per email)
+    extraction_batch_token_budget: int = 24000  # Estimated prompt tokens per batched request
+    extraction_structured_output: bool = True  # Ask Gemini for schema-constrained JSON instead of free text
+    extraction_context_cache: bool = False  # Keep the instructions in a Gemini cached content (billed per hour) instead of a plain system instruction
+    extraction_email_token_budget: int = 1500  # Estimated tokens of email text per prompt (0 = no cap)
+    extraction_trim_boilerplate: bool = True  # Drop unsubscribe/address/privacy sentences and repeats from prompts
+    
+    # Gemini rate limits shared by OCR and extraction (0 = no per-minute limit)
+    gemini_requests_per_minute: int = 1000
+    gemini_tokens_per_minute: int = 1000000
+    gemini_max_concurrency: int = 16  # Halved on 429s, grows back as calls succeed
+    gemini_min_concurrency: int = 1
+    gemini_max_retries: int = 5  # Retries for 429 and 5xx errors (daily quota errors fail right away)
+    gemini_backoff_base_seconds: float = 1.0
+    gemini_backoff_max_seconds: float = 32.0
+    gemini_context_cache_ttl_minutes: int = 60  # Cached contents are extended before they expire
+    
+    # Local pre-classifier in front of Gemini extraction
+    classifier_enabled: bool = True
+    classifier_threshold: float = 0.2  # Emails scoring below this skip Gemini (lower = higher recall)
+    classifier_shadow_rate: float = 0.05  # Share of skipped emails still sent to Gemini to measure recall
+    classifier_weights_path: Optional[str] = None  # JSON weights trained by classifier_report.py --train
+    
+    # Rule-based extraction ahead of Gemini
+    rule_extractor_enabled: bool = True
+    rule_extractor_min_confidence: float = 0.9  # Rule results at or above this skip Gemini (see evaluate_rule_extractor.py)
+    
+    # Background refresh jobs
+    refresh_job_workers: int = 4  # Refreshes running at once per API process
+    refresh_job_progress_interval_seconds: float = 1.0  # Min time between progress writes to the database
+    refresh_job_stale_minutes: int = 15  # Active jobs without progress or heartbeat for this long are reported as failed
+    refresh_job_heartbeat_seconds: float = 60.0  # How often a process marks its queued and running jobs as alive
+    refresh_job_final_write_attempts: int = 5  # Tries for writing a job's succeeded/failed status
+    coupon_stream_progress_interval_seconds: float = 0.5  # Min time between progress events on /api/coupons/stream
+    
+    # Single-flight refreshes (one refresh per user at a time)
+    refresh_lock_ttl_minutes: int = 30  # A crashed worker's lock can be taken over after this
+    refresh_lock_renew_seconds: float = 60.0  # A running refresh extends its lock on progress at most this often
+    refresh_lock_poll_seconds: float = 1.0  # How often a caller waiting on another worker's refresh checks the lock
     
     class Config:
         env_file = ".env"
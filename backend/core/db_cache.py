@@ -0,0 +1,81 @@
+"""
+Bookkeeping shared by the database-backed caches (OCR results, coupon
+extractions, company logos): writing an entry that another worker may be
+writing at the same time, and pruning expired and least recently used
+entries every so many writes.
+"""
+import logging
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Prune expired/least recently used entries every this many writes
+PRUNE_EVERY_WRITES = 200
+
+
+def upsert_entry(db, model, key_column, key, **fields):
+    """
+    Create or update the entry whose key_column equals key with fields, and commit.
+
+    Returns:
+        False if another worker inserted the same key at the same time (its entry is kept)
+    """
+    entry = db.query(model).filter(key_column == key).first()
+    if entry is None:
+        entry = model(**{key_column.key: key})
+        db.add(entry)
+    for field, value in fields.items():
+        setattr(entry, field, value)
+    try:
+        db.commit()
+        return True
+    except IntegrityError:
+        # Another worker cached the same key at the same time
+        db.rollback()
+        return False
+
+
+def prune_entries(session_factory, model, expired, max_entries, cache_name):
+    """
+    Delete the entries matching the expired filter, then the least recently used
+    ones beyond max_entries. Best effort: errors are logged, not raised.
+    """
+    db = session_factory()
+    try:
+        expired_count = db.query(model).filter(expired).delete(synchronize_session=False)
+
+        overflow = db.query(model).count() - max_entries
+        evicted = 0
+        if overflow > 0:
+            oldest_ids = [row.id for row in db.query(model.id).order_by(model.last_used_at).limit(overflow)]
+            evicted = db.query(model).filter(model.id.in_(oldest_ids)).delete(synchronize_session=False)
+
+        db.commit()
+        if expired_count or evicted:
+            logger.info(f"Pruned {cache_name} cache: {expired_count} expired, {evicted} evicted")
+    except Exception as e:
+        logger.warning(f"Could not prune {cache_name} cache: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+class PruneSchedule:
+    """Calls a cache's prune function once every PRUNE_EVERY_WRITES writes in this process"""
+
+    def __init__(self, prune, every_writes=PRUNE_EVERY_WRITES):
+        self.prune = prune
+        self.every_writes = every_writes
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def record_write(self):
+        with self.lock:
+            self.writes += 1
+            due = self.writes >= self.every_writes
+            if due:
+                self.writes = 0
+        if due:
+            self.prune()
@@ -0,0 +1,19 @@
+"""
+Execution layer for blocking work (googleapiclient, google.generativeai,
+requests, database) so it never runs on the FastAPI event loop
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .config import settings
+
+# Dedicated pool, so long refreshes can't exhaust the threadpool FastAPI uses for dependencies
+blocking_executor = ThreadPoolExecutor(
+    max_workers=settings.blocking_executor_workers,
+    thread_name_prefix="blocking-io"
+)
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function on the dedicated executor and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
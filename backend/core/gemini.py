@@ -0,0 +1,147 @@
+"""
+Process-level Gemini client registry
+google.generativeai is configured once, lazily, and one GenerativeModel is
+kept per model name and purpose (each purpose has its own generation config),
+so OCR and extraction calls reuse the same client and transport.
+A purpose's system instruction can also be kept in a Gemini cached content,
+shared by every worker and extended before it expires.
+Tests can swap the model factory for a local fake with set_model_factory.
+"""
+import os
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import google.generativeai as genai
+from google.generativeai import caching
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Cached contents are extended when less than this is left
+CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+
+_configured = False
+_models = {}
+_cached_content_models = {}  # (model_name, purpose) -> (model, CachedContent)
+_cache_unavailable = set()  # Purposes whose cached content couldn't be created (e.g. too few tokens)
+_lock = threading.RLock()
+_model_factory = None
+
+
+def configure_gemini():
+    """Configure google.generativeai with GEMINI_API_KEY (once per process)"""
+    global _configured
+    if _configured:
+        return
+    with _lock:
+        if not _configured:
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+            _configured = True
+
+
+def _expires_soon(cached_content):
+    expire_time = cached_content.expire_time
+    if expire_time.tzinfo is None:
+        expire_time = expire_time.replace(tzinfo=timezone.utc)
+    return expire_time - datetime.now(timezone.utc) < CACHE_REFRESH_MARGIN
+
+
+def _get_cached_content_model(model_name, purpose, system_instruction, generation_config=None):
+    """Model backed by a cached content holding the system instruction, created or extended as needed"""
+    key = (model_name, purpose)
+    entry = _cached_content_models.get(key)
+    if entry is not None and not _expires_soon(entry[1]):
+        return entry[0]
+
+    with _lock:
+        entry = _cached_content_models.get(key)
+        if entry is not None and not _expires_soon(entry[1]):
+            return entry[0]
+
+        configure_gemini()
+        ttl = timedelta(minutes=settings.gemini_context_cache_ttl_minutes)
+        cached_content = entry[1] if entry is not None else None
+        if cached_content is None:
+            # Another worker may have created it already; the purpose is the display name
+            cached_content = next(
+                (cached for cached in caching.CachedContent.list(page_size=100)
+                 if cached.display_name == purpose and not _expires_soon(cached)),
+                None
+            )
+        if cached_content is not None:
+            try:
+                cached_content.update(ttl=ttl)
+            except Exception as e:
+                logger.info(f"Could not extend cached content {purpose}, creating a new one: {e}")
+                cached_content = None
+        if cached_content is None:
+            cached_content = caching.CachedContent.create(
+                model=model_name, display_name=purpose, system_instruction=system_instruction, ttl=ttl
+            )
+            logger.info(f"Created Gemini cached content {purpose}")
+
+        model = genai.GenerativeModel.from_cached_content(cached_content, generation_config=generation_config)
+        _cached_content_models[key] = (model, cached_content)
+        return model
+
+
+def get_model(model_name, purpose="default", cache_system_instruction=False, **model_kwargs):
+    """
+    Get the shared model for a model name and purpose.
+
+    Args:
+        model_name: Gemini model name, e.g. "gemini-2.5-flash-lite"
+        purpose: Name of the use ("ocr", "extraction", ...); each purpose keeps its own model
+        cache_system_instruction: Keep model_kwargs["system_instruction"] in a Gemini
+            cached content instead of sending it with every request. Falls back to a
+            plain system instruction if the cache can't be created.
+        model_kwargs: GenerativeModel arguments (generation_config, system_instruction, ...),
+            only used the first time the purpose is requested
+
+    Returns:
+        google.generativeai.GenerativeModel, or whatever the configured fake factory returns
+    """
+    key = (model_name, purpose)
+    if cache_system_instruction and _model_factory is None and key not in _cache_unavailable:
+        try:
+            return _get_cached_content_model(
+                model_name, purpose, model_kwargs.get("system_instruction"), model_kwargs.get("generation_config")
+            )
+        except Exception as e:
+            logger.warning(f"Gemini context cache unavailable for {purpose}, using a system instruction: {e}")
+            _cache_unavailable.add(key)
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        if key not in _models:
+            if _model_factory is not None:
+                _models[key] = _model_factory(model_name, **model_kwargs)
+            else:
+                configure_gemini()
+                _models[key] = genai.GenerativeModel(model_name, **model_kwargs)
+        return _models[key]
+
+
+def set_model_factory(factory):
+    """
+    Replace how models are created, e.g. with a fake for tests (None restores Gemini).
+    factory(model_name, **model_kwargs) must return an object with generate_content.
+    """
+    global _model_factory
+    with _lock:
+        _model_factory = factory
+        _models.clear()
+        _cached_content_models.clear()
+
+
+def reset_models():
+    """Drop cached models, e.g. after a prompt or config change"""
+    with _lock:
+        _models.clear()
+        _cached_content_models.clear()
+        _cache_unavailable.clear()
@@ -0,0 +1,214 @@
+"""
+Process-wide rate limiting for Gemini calls (OCR and coupon extraction)
+Token buckets keep requests and tokens per minute under the quota, an
+adaptive concurrency limit halves on 429s and grows back slowly on successes,
+and throttled or transient failures are retried with exponential backoff and
+jitter. A daily quota exhaustion won't clear within the retries, so it fails
+right away. Calls with a deadline stop waiting and retrying once it passes.
+"""
+import re
+import time
+import random
+import logging
+import threading
+
+from google.api_core import exceptions as google_exceptions
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+TRANSIENT_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError)
+
+# Quota errors that last until the daily quota resets rather than the next minute
+# (quota IDs like "GenerateRequestsPerDayPerProjectPerModel"; per-minute 429s share the rest of the message)
+HARD_QUOTA_PATTERN = re.compile(r"per[ _-]?day|daily", re.IGNORECASE)
+
+
+class TokenBucket:
+    """Refills continuously up to per_minute units; acquire blocks until enough are available"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self.refill_per_second = per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount=1, deadline=None):
+        """Take amount units; False if they aren't available before deadline (a time.monotonic() value)"""
+        if self.capacity <= 0:
+            return True
+        # A single request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return True
+                wait = (amount - self.available) / self.refill_per_second
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, amount):
+        """Give back (positive) or charge extra (negative) units once the real usage is known"""
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available + amount)
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits calls in flight. Additive increase, multiplicative decrease: the
+    limit halves on a 429 (at most once per second) and grows by ~1 per
+    limit successful calls, up to max_limit.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.last_decrease_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """Start a call; False if no slot frees up before deadline (a time.monotonic() value)"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled=False, succeeded=True):
+        """End a call; only successful calls grow the limit"""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.last_decrease_at >= 1.0:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease_at = now
+                    logger.warning(f"Gemini rate limited, concurrency limit lowered to {int(self.limit)}")
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+def is_rate_limit_error(error):
+    return isinstance(error, RATE_LIMIT_ERRORS) or "429" in str(error) or "quota" in str(error).lower()
+
+
+def is_hard_quota_error(error):
+    """Rate limit errors that retrying within minutes can't fix (daily quota)"""
+    return is_rate_limit_error(error) and HARD_QUOTA_PATTERN.search(str(error)) is not None
+
+
+class GeminiRateLimiter:
+    """Shared limiter every Gemini call goes through (see call)"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency, min_concurrency=1):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency, min_concurrency)
+
+    def acquire(self, estimated_tokens, deadline=None):
+        """Wait for a request, its tokens and a concurrency slot; False (holding none) if deadline passes first"""
+        if not self.requests.acquire(1, deadline):
+            return False
+        if not self.tokens.acquire(estimated_tokens, deadline):
+            self.requests.adjust(1)
+            return False
+        if not self.concurrency.acquire(deadline):
+            self.requests.adjust(1)
+            self.tokens.adjust(estimated_tokens)
+            return False
+        return True
+
+    def call(self, func, *args, estimated_tokens=0, deadline=None, **kwargs):
+        """
+        Call a Gemini API function within the limits, retrying 429s and transient errors.
+
+        Args:
+            func: Function making one Gemini request (e.g. model.generate_content)
+            estimated_tokens: Input plus expected output tokens, charged against
+                the tokens-per-minute budget and corrected from usage_metadata
+            deadline: Optional time.monotonic() value the call must finish by.
+                Each attempt's request_options timeout is what is left of it, and
+                no attempt, wait or backoff goes past it.
+
+        Raises:
+            TimeoutError if the deadline passes before an attempt could start,
+            otherwise the last error if it isn't retryable or retries are exhausted
+        """
+        max_retries = settings.gemini_max_retries
+        for attempt in range(max_retries + 1):
+            if not self.acquire(estimated_tokens, deadline):
+                raise TimeoutError("Gemini call deadline passed while waiting for rate limits")
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.requests.adjust(1)
+                    self.tokens.adjust(estimated_tokens)
+                    self.concurrency.release(succeeded=False)
+                    raise TimeoutError("Gemini call deadline passed")
+                request_options = kwargs.get("request_options", {})
+                kwargs["request_options"] = {**request_options, "timeout": min(request_options.get("timeout", remaining), remaining)}
+            throttled = False
+            error = None
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+                # Failed calls don't use their token estimate
+                self.tokens.adjust(estimated_tokens)
+                if is_hard_quota_error(e):
+                    logger.error(f"Gemini quota exhausted, not retrying: {e}")
+                    raise
+                throttled = is_rate_limit_error(e)
+                if not (throttled or isinstance(e, TRANSIENT_ERRORS)) or attempt == max_retries:
+                    raise
+            else:
+                usage = getattr(response, "usage_metadata", None)
+                used_tokens = getattr(usage, "total_token_count", None) if usage is not None else None
+                if isinstance(used_tokens, int) and used_tokens > 0:
+                    self.tokens.adjust(estimated_tokens - used_tokens)
+                return response
+            finally:
+                self.concurrency.release(throttled, succeeded=error is None)
+
+            # Exponential backoff with jitter, so throttled workers don't retry in lockstep
+            delay = min(settings.gemini_backoff_max_seconds, settings.gemini_backoff_base_seconds * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logger.warning(f"Gemini call failed ({error.__class__.__name__}), no time left to retry")
+                raise error
+            logger.warning(f"Gemini call failed ({error.__class__.__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+gemini_limiter = GeminiRateLimiter(
+    requests_per_minute=settings.gemini_requests_per_minute,
+    tokens_per_minute=settings.gemini_tokens_per_minute,
+    max_concurrency=settings.gemini_max_concurrency,
+    min_concurrency=settings.gemini_min_concurrency,
+)
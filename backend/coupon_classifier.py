@@ -0,0 +1,104 @@
+"""
+Local coupon pre-classifier.
+Scores how likely an email is to carry a monetary offer from cheap text
+features, so newsletters, "new arrivals" and event invites can skip the Gemini
+extraction call. A small logistic model over offer signals; its weights can be
+retrained from past Gemini labels (see classifier_report.py).
+"""
+import re
+import json
+import math
+import random
+import logging
+
+from core.config import settings
+from offer_signals import detect_offer_signals
+
+logger = logging.getLogger(__name__)
+
+# Words that usually mean a promo email has no monetary offer
+NON_OFFER_PATTERN = re.compile(
+    r"\b(?:newsletter|new arrivals?|just (?:dropped|landed|arrived)|now available|back in stock|webinar|rsvp"
+    r"|you'?re invited|join us|event|livestream|podcast|survey|review your|rate your|your order|has shipped"
+    r"|receipt|password|verify your|account update|privacy policy update|terms of service)\b",
+    re.IGNORECASE,
+)
+
+FEATURE_NAMES = (
+    "percent", "currency", "code", "keywords", "subject_strong", "subject_keyword", "non_offer",
+)
+
+# Hand-tuned defaults, used until weights trained from Gemini labels are configured
+DEFAULT_WEIGHTS = {
+    "bias": -2.5,
+    "percent": 2.0,
+    "currency": 1.2,
+    "code": 2.2,
+    "keywords": 1.1,
+    "subject_strong": 1.5,
+    "subject_keyword": 1.0,
+    "non_offer": -0.6,
+}
+
+_weights = None
+
+
+def get_weights():
+    """Classifier weights: settings.classifier_weights_path if set, otherwise the defaults"""
+    global _weights
+    if _weights is None:
+        weights = dict(DEFAULT_WEIGHTS)
+        if settings.classifier_weights_path:
+            try:
+                with open(settings.classifier_weights_path) as weights_file:
+                    weights.update(json.load(weights_file))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not load classifier weights, using defaults: {e}")
+        _weights = weights
+    return _weights
+
+
+def extract_features(email_text, email_subject=""):
+    """
+    Feature vector of an email.
+
+    Returns:
+        Dict of feature name -> value (see FEATURE_NAMES)
+    """
+    body_signals = detect_offer_signals(email_text)
+    subject_signals = detect_offer_signals(email_subject)
+    return {
+        "percent": 1.0 if body_signals["percent"] or subject_signals["percent"] else 0.0,
+        "currency": 1.0 if body_signals["currency"] or subject_signals["currency"] else 0.0,
+        "code": 1.0 if body_signals["code"] or subject_signals["code"] else 0.0,
+        "keywords": math.log1p(min(body_signals["keyword"] + subject_signals["keyword"], 20)),
+        "subject_strong": 1.0 if subject_signals["percent"] or subject_signals["currency"] or subject_signals["code"] else 0.0,
+        "subject_keyword": 1.0 if subject_signals["keyword"] else 0.0,
+        "non_offer": math.log1p(min(len(NON_OFFER_PATTERN.findall(f"{email_subject}\n{email_text or ''}")), 10)),
+    }
+
+
+def score_features(features, weights=None):
+    """Probability (0-1) that an email with these features has a coupon"""
+    weights = weights or get_weights()
+    logit = weights.get("bias", 0.0) + sum(weights.get(name, 0.0) * value for name, value in features.items())
+    return 1.0 / (1.0 + math.exp(-max(min(logit, 50.0), -50.0)))
+
+
+def screen_email(email_text, email_subject=""):
+    """
+    Decide whether an email goes to Gemini.
+
+    Emails scoring below settings.classifier_threshold are skipped, except a
+    random settings.classifier_shadow_rate share of them which is still sent so
+    the classifier's recall can be measured against Gemini labels.
+
+    Returns:
+        Dict with the score, the features, the threshold it was compared to
+        (0.0 with the classifier disabled, as every email is sent) and send_to_llm
+    """
+    features = extract_features(email_text, email_subject)
+    score = score_features(features)
+    threshold = settings.classifier_threshold if settings.classifier_enabled else 0.0
+    send_to_llm = score >= threshold or random.random() < settings.classifier_shadow_rate
+    return {"score": score, "features": features, "threshold": threshold, "send_to_llm": send_to_llm}
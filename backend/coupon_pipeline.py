@@ -0,0 +1,305 @@
+"""
+Coupon extraction pipeline.
+Turns fetched email info into coupon entries, running the blocking Gemini,
+logo and category lookups for many emails at once on a bounded thread pool.
+Emails the local pre-classifier rejects skip Gemini, as do emails the rule
+extractor handles confidently; the rest are sent in batches (see
+get_coupon_info_from_batch) as they are fetched. Rejected emails are not
+recorded as processed, so a later full sync screens them again (e.g. with
+retrained weights).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from core.config import settings
+from get_coupon_info_from_email import get_coupon_info_from_email, get_coupon_info_from_batch, ExtractionBatchPacker
+from get_company_logo import get_company_logo_info
+from company_categorization import get_company_category
+from coupon_classifier import screen_email
+from rule_extractor import extract_offers_with_rules
+
+logger = logging.getLogger(__name__)
+
+# Shared by every refresh in the process, so its size is the global concurrency limit
+_executor = ThreadPoolExecutor(
+    max_workers=settings.pipeline_max_workers,
+    thread_name_prefix="coupon-pipeline"
+)
+
+# Per-user limits, shared by concurrent refreshes of the same user
+_user_semaphores = {}
+_user_semaphores_lock = threading.Lock()
+
+
+def get_user_semaphore(user_id):
+    """Get the semaphore bounding how many emails of one user are processed at once"""
+    with _user_semaphores_lock:
+        if user_id not in _user_semaphores:
+            _user_semaphores[user_id] = threading.BoundedSemaphore(settings.pipeline_per_user_concurrency)
+        return _user_semaphores[user_id]
+
+
+def enrich_coupon(message_id, email_info, coupons_json):
+    """
+    Add company logo, domain, category and email metadata to an extracted coupon.
+
+    Args:
+        message_id: Gmail message ID
+        email_info: Email info dict from get_emails_info
+        coupons_json: Coupon info returned by get_coupon_info_from_email
+
+    Returns:
+        Coupon dict in the format stored in user_coupons
+    """
+    email_timestamp = email_info["email_timestamp"]
+    email_subject = email_info["email_subject"]
+    email_sender = email_info["email_sender"]
+
+    # Get company logo and domain info
+    logo_info = get_company_logo_info(email_sender)
+
+    # Get company category based on domain
+    company_domain = logo_info.get("domain")
+    if company_domain:
+        company_category = get_company_category(company_domain)
+    else:
+        # Fallback: extract domain from email sender
+        if '@' in email_sender:
+            sender_domain = email_sender.split('@')[-1].split('>')[0]
+            company_category = get_company_category(sender_domain)
+        else:
+            company_category = 'general'
+
+    # Add unique IDs to each offer
+    if "offers" in coupons_json:
+        for offer_idx, offer in enumerate(coupons_json["offers"]):
+            # Generate unique ID using message_id + offer index (guaranteed unique)
+            unique_id = f"{message_id}_{offer_idx}"
+            offer["id"] = unique_id
+
+    # Insert timestamp, subject, sender, and message_id in dict
+    coupons_json = {"timestamp": email_timestamp.isoformat() if hasattr(email_timestamp, 'isoformat') else str(email_timestamp), **coupons_json}
+    coupons_json = {"subject": email_subject, **coupons_json}
+    coupons_json = {"sender": email_sender, **coupons_json}
+    coupons_json = {"message_id": message_id, **coupons_json}
+    coupons_json = {"company_domain": company_domain, **coupons_json}
+    coupons_json = {"company_logo_url": logo_info.get("logo_url"), **coupons_json}
+    coupons_json = {"company_category": company_category, **coupons_json}
+
+    # has_coupon will always be True, no need to include in backend JSON
+    coupons_json.pop("has_coupon", None)
+    return coupons_json
+
+
+def extract_with_rules(email_info):
+    """Rule-based coupon info for an email if the rule extractor is confident enough, otherwise None"""
+    if not settings.rule_extractor_enabled:
+        return None
+    coupons_json, confidence = extract_offers_with_rules(
+        email_info["email_text"], email_info["email_subject"], email_info["email_sender"], email_info["email_timestamp"]
+    )
+    if coupons_json is None or confidence < settings.rule_extractor_min_confidence:
+        return None
+    return coupons_json
+
+
+def process_email(message_id, email_info, coupons_json=None, screening=None, rule_based=False):
+    """
+    Run one email through the pre-classifier, extraction and, if it has a coupon, enrichment.
+
+    Args:
+        message_id: Gmail message ID
+        email_info: Email info dict from get_emails_info
+        coupons_json: Already extracted coupon info (e.g. from a batch), or None to extract it here
+        screening: Result of coupon_classifier.screen_email, or None to screen here
+        rule_based: Whether coupons_json came from the rule extractor rather than Gemini
+
+    Returns:
+        Dict with the message_id, the coupon (or None), the processed-email
+        record to store (or None if it should be retried) and any error.
+    """
+    email_text = email_info["email_text"]
+    email_subject = email_info["email_subject"]
+    email_sender = email_info["email_sender"]
+    processed = {
+        "message_id": message_id, "sender": email_sender, "subject": email_subject,
+        "email_timestamp": email_info["email_timestamp"], "has_coupon": False
+    }
+    result = {"message_id": message_id, "coupon": None, "processed": processed, "error": None}
+
+    if not email_text or not email_text.strip():
+        return result
+
+    if screening is None:
+        screening = screen_email(email_text, email_subject)
+    processed["classifier_score"] = screening["score"]
+    processed["classifier_features"] = screening["features"]
+    processed["classifier_threshold"] = screening["threshold"]
+    if coupons_json is None and not screening["send_to_llm"]:
+        # Rejected by the pre-classifier: screening is cheap, so it is not recorded and a
+        # false negative gets another chance rather than being skipped for good
+        return {**result, "processed": None}
+
+    if coupons_json is None:
+        coupons_json = extract_with_rules(email_info)
+        rule_based = coupons_json is not None
+    if rule_based:
+        processed["llm_labeled"] = False
+
+    try:
+        # Stage 1: AI extraction
+        if coupons_json is None:
+            coupons_json = get_coupon_info_from_email(email_text, email_subject, email_sender, email_info["email_timestamp"])
+        if "error" in coupons_json:
+            # Not recorded as processed, so the next refresh retries it
+            return {**result, "processed": None, "error": coupons_json["error"]}
+
+        processed["has_coupon"] = bool(coupons_json.get("has_coupon", False))
+
+        # Stage 2: company enrichment, only for emails with coupons
+        if processed["has_coupon"]:
+            result["coupon"] = enrich_coupon(message_id, email_info, coupons_json)
+        return result
+    except Exception as e:
+        return {**result, "processed": None, "error": str(e)}
+
+
+class EmailPipeline:
+    """
+    Runs emails through the pipeline on the shared pool as they are fetched.
+
+    add() screens each email right away: emails that skip Gemini go straight to
+    enrichment, the rest are packed into extraction batches and a batch is
+    submitted as soon as it is full. A batch's emails are enriched once the
+    batch completes, so results stream out while later emails are still being
+    fetched. finish() submits the last partial batch and waits for every email.
+
+    At most settings.pipeline_per_user_concurrency tasks of one user are in flight
+    at a time, and at most settings.pipeline_max_workers across all users.
+    """
+
+    def __init__(self, user_id=None, on_result=None):
+        """
+        Args:
+            user_id: ID of the user the emails belong to (None for an unshared limit)
+            on_result: Optional callback, called with each process_email result as it finishes
+        """
+        if user_id is None:
+            self.slots = threading.BoundedSemaphore(settings.pipeline_per_user_concurrency)
+        else:
+            self.slots = get_user_semaphore(user_id)
+        self.on_result = on_result
+        self.packer = ExtractionBatchPacker()
+        self.message_ids = []  # In the order emails were added
+        self.screenings = {}
+        self.futures = {}  # message_id -> process_email future
+        self.batch_futures = {}  # extraction future -> batch of emails
+        self.sent_to_llm = 0
+        self.rule_extracted = 0
+
+    def submit(self, func, *args):
+        # Block here rather than in a pool thread, so a busy user never holds global workers idle
+        self.slots.acquire()
+        try:
+            future = _executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def add(self, message_id, email_info):
+        """Start processing one fetched email"""
+        self.enrich_finished_batches()
+        self.message_ids.append(message_id)
+
+        # Stage 1: local pre-classifier (emails without text skip it and extraction)
+        if not email_info["email_text"] or not email_info["email_text"].strip():
+            self.enrich(message_id, email_info)
+            return
+        screening = self.screenings[message_id] = screen_email(email_info["email_text"], email_info["email_subject"])
+        if not screening["send_to_llm"]:
+            self.enrich(message_id, email_info, screening=screening)
+            return
+        self.sent_to_llm += 1
+
+        # Emails with one clear offer are extracted with patterns instead
+        coupons_json = extract_with_rules(email_info)
+        if coupons_json is not None:
+            self.rule_extracted += 1
+            self.enrich(message_id, email_info, coupons_json, screening, True)
+            return
+
+        # Stage 2: batched AI extraction
+        for batch in self.packer.add(message_id, email_info):
+            self.batch_futures[self.submit(get_coupon_info_from_batch, batch)] = batch
+
+    def enrich(self, message_id, email_info, coupons_json=None, screening=None, rule_based=False):
+        """Stage 3: per-email enrichment (and extraction, if a batch didn't answer for the email)"""
+        future = self.submit(process_email, message_id, email_info, coupons_json, screening, rule_based)
+        if self.on_result:
+            def report(future):
+                if future.exception() is None:
+                    self.on_result(future.result())
+            future.add_done_callback(report)
+        self.futures[message_id] = future
+
+    def enrich_batch(self, batch_future):
+        batch = self.batch_futures.pop(batch_future)
+        try:
+            extracted = batch_future.result()
+        except Exception as e:
+            # These emails are extracted one by one in stage 3
+            logger.warning(f"Batch extraction failed: {e}")
+            extracted = {}
+        for message_id, email_info in batch.items():
+            self.enrich(message_id, email_info, extracted.get(message_id), self.screenings[message_id])
+
+    def enrich_finished_batches(self):
+        for batch_future in [future for future in self.batch_futures if future.done()]:
+            self.enrich_batch(batch_future)
+
+    def finish(self):
+        """
+        Wait for every added email.
+
+        Returns:
+            List of process_email results in the order the emails were added
+        """
+        last_batch = self.packer.flush()
+        if last_batch:
+            self.batch_futures[self.submit(get_coupon_info_from_batch, last_batch)] = last_batch
+        for batch_future in as_completed(list(self.batch_futures)):
+            self.enrich_batch(batch_future)
+
+        if self.screenings:
+            logger.info(f"Pre-classifier sent {self.sent_to_llm}/{len(self.screenings)} emails to Gemini")
+        if self.rule_extracted:
+            logger.info(f"Rule extractor handled {self.rule_extracted} emails without Gemini")
+
+        results = [self.futures[message_id].result() for message_id in self.message_ids if message_id in self.futures]
+        for index, result in enumerate(results):
+            if result["error"]:
+                logger.warning(f"Error processing email {index+1}: {result['error']}")
+            elif result["coupon"]:
+                logger.info(f"Found coupons in email {index+1}")
+        return results
+
+
+def process_emails(emails_info, user_id=None, on_result=None):
+    """
+    Process already fetched emails concurrently on the shared pipeline pool (see EmailPipeline).
+
+    Args:
+        emails_info: Dict of message_id -> email info from get_emails_info
+        user_id: ID of the user the emails belong to (None for an unshared limit)
+        on_result: Optional callback, called with each process_email result as it finishes
+
+    Returns:
+        List of process_email results in the same order as emails_info
+    """
+    pipeline = EmailPipeline(user_id=user_id, on_result=on_result)
+    for message_id, email_info in emails_info.items():
+        pipeline.add(message_id, email_info)
+    return pipeline.finish()
@@ -0,0 +1,295 @@
+"""
+Coupon refresh for one user: fetch new promotional emails from Gmail, run them
+through the coupon pipeline and save the results. Used by GET /api/coupons,
+the coupon stream and background refresh jobs (see refresh_jobs.py).
+
+Refreshes are single-flight per user: a caller arriving while the user's
+refresh runs in this process joins it and gets its result, and a database
+lock row keeps other API workers from starting a second one. The lock is
+extended as the refresh makes progress, so long refreshes keep it.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import timedelta
+from concurrent.futures import Future
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+
+from get_emails_info import get_new_emails_info_for_user, get_campaign_key
+from coupon_pipeline import EmailPipeline
+from core.config import settings
+from database.connection import SessionLocal
+from auth.crud import (
+    get_user_by_id, update_gmail_sync_history_id, get_all_user_coupons, save_user_coupons_batch,
+    get_processed_email_ids, get_processed_campaign_dates, save_processed_emails_batch, get_pending_email_ids, update_pending_emails,
+    acquire_refresh_lock, renew_refresh_lock, is_refresh_locked, release_refresh_lock
+)
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process's refreshes in the refresh_locks table
+LOCK_OWNER_PREFIX = f"{socket.gethostname()}:{os.getpid()}"
+
+_flights = {}  # user_id -> RefreshFlight running in this process
+_flights_lock = threading.Lock()
+
+class RefreshFlight:
+    """
+    A refresh in progress in this process. Callers that join it wait on future.
+    Their progress listeners are first replayed the progress so far, then
+    receive the refresh's progress as it happens.
+    """
+
+    def __init__(self):
+        self.future = Future()
+        self.listeners = []
+        self.events = []  # (method name, args) of every progress event so far, for replay
+        # Held while events are delivered, so a joining listener sees them in order and exactly once
+        self.lock = threading.RLock()
+
+    def add_listener(self, listener):
+        with self.lock:
+            for method, args in self.events:
+                getattr(listener, method)(*args)
+            self.listeners.append(listener)
+
+    def _emit(self, method, *args):
+        with self.lock:
+            self.events.append((method, args))
+            for listener in self.listeners:
+                getattr(listener, method)(*args)
+
+    def set_stage(self, stage, total=None):
+        self._emit("set_stage", stage, total)
+
+    def on_email_fetched(self, message_id, email_info):
+        self._emit("on_email_fetched", message_id, email_info)
+
+    def on_email_processed(self, result):
+        self._emit("on_email_processed", result)
+
+class RefreshLockRenewal:
+    """Progress listener that extends the refresh lock while the refresh makes progress"""
+
+    def __init__(self, user_id, owner):
+        self.user_id = user_id
+        self.owner = owner
+        self.renewed_at = time.monotonic()
+
+    def renew_if_due(self):
+        now = time.monotonic()
+        if now - self.renewed_at < settings.refresh_lock_renew_seconds:
+            return
+        self.renewed_at = now
+        db = SessionLocal()
+        try:
+            if not renew_refresh_lock(db, self.user_id, self.owner, timedelta(minutes=settings.refresh_lock_ttl_minutes)):
+                logger.warning(f"Refresh lock for user {self.user_id} was taken over by another worker")
+        except Exception as e:
+            # Renewal is retried on the next progress event
+            db.rollback()
+            logger.warning(f"Could not renew refresh lock for user {self.user_id}: {e}")
+        finally:
+            db.close()
+
+    def set_stage(self, stage, total=None):
+        self.renew_if_due()
+
+    def on_email_fetched(self, message_id, email_info):
+        self.renew_if_due()
+
+    def on_email_processed(self, result):
+        self.renew_if_due()
+
+class ProcessedEmailLookup:
+    """
+    Looks up which emails of a batch the user already processed, so they are
+    skipped before their bodies are downloaded. Queried one Gmail batch at a
+    time rather than loading every processed email up front.
+    """
+
+    def __init__(self, db: Session, user_id: int):
+        self.db = db
+        self.user_id = user_id
+
+    def known_message_ids(self, message_ids):
+        return get_processed_email_ids(self.db, self.user_id, message_ids)
+
+    def known_campaigns(self, campaign_keys):
+        return get_processed_campaign_dates(self.db, self.user_id, campaign_keys)
+
+def create_gmail_service_for_user(current_user, db: Session):
+    """Create a Gmail service using the user's stored tokens"""
+    # Get full user object to access Gmail tokens (UserResponse excludes sensitive fields)
+    user = get_user_by_id(db, current_user.id)
+
+    if not user or not user.gmail_access_token:
+        raise HTTPException(status_code=400, detail="No Gmail access token found")
+
+    user_creds = Credentials(
+        token=user.gmail_access_token,
+        refresh_token=user.gmail_refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        scopes=[
+            'https://www.googleapis.com/auth/gmail.readonly',
+            'https://www.googleapis.com/auth/gmail.modify'
+        ]
+    )
+
+    return build('gmail', 'v1', credentials=user_creds)
+
+def refresh_coupons_for_user(db: Session, user, progress=None):
+    """
+    Refresh the user's coupons, or join the refresh already running for them.
+
+    Args:
+        db: Database session
+        user: User model with Gmail connected
+        progress: Optional progress listener (see run_refresh)
+
+    Returns:
+        Dict with new_coupons, cached_coupons (saved before this refresh) and emails_processed
+    """
+    with _flights_lock:
+        flight = _flights.get(user.id)
+        is_leader = flight is None
+        if is_leader:
+            flight = _flights[user.id] = RefreshFlight()
+        if progress:
+            flight.add_listener(progress)
+
+    if not is_leader:
+        logger.info(f"Refresh already running for user {user.email}, waiting for its result")
+        return flight.future.result()
+
+    try:
+        result = run_refresh_with_lock(db, user, flight)
+    except BaseException as e:
+        flight.future.set_exception(e)
+        raise
+    else:
+        flight.future.set_result(result)
+        return result
+    finally:
+        with _flights_lock:
+            _flights.pop(user.id, None)
+
+def run_refresh_with_lock(db: Session, user, flight: RefreshFlight):
+    """Run the refresh holding the user's database lock, or wait for another worker's refresh"""
+    owner = f"{LOCK_OWNER_PREFIX}:{uuid.uuid4()}"
+    if not acquire_refresh_lock(db, user.id, owner, timedelta(minutes=settings.refresh_lock_ttl_minutes)):
+        return wait_for_refresh_elsewhere(db, user, flight)
+
+    flight.add_listener(RefreshLockRenewal(user.id, owner))
+    try:
+        return run_refresh(db, user, flight)
+    finally:
+        # Own session, db may be unusable if the refresh failed
+        lock_db = SessionLocal()
+        try:
+            release_refresh_lock(lock_db, user.id, owner)
+        finally:
+            lock_db.close()
+
+def wait_for_refresh_elsewhere(db: Session, user, progress=None):
+    """Wait until another worker's refresh for the user ends, then return what it saved"""
+    logger.info(f"Refresh for user {user.email} is running on another worker, waiting for it")
+    if progress:
+        progress.set_stage("waiting")
+    while is_refresh_locked(db, user.id):
+        time.sleep(settings.refresh_lock_poll_seconds)
+
+    coupon_data = [json.loads(coupon.coupon_data) for coupon in get_all_user_coupons(db, user.id)]
+    return {"new_coupons": [], "cached_coupons": coupon_data, "emails_processed": 0}
+
+def run_refresh(db: Session, user, progress=None):
+    """
+    Process the user's promotional emails added since the last sync.
+
+    Args:
+        db: Database session
+        user: User model with Gmail connected
+        progress: Optional progress listener with set_stage(stage, total=None),
+            on_email_fetched(message_id, email_info) and on_email_processed(result)
+
+    Returns:
+        Dict with new_coupons, cached_coupons (saved before this refresh) and emails_processed
+    """
+    cached_coupons = get_all_user_coupons(db, user.id)
+    cached_coupon_data = [json.loads(coupon.coupon_data) for coupon in cached_coupons]
+
+    # Create Gmail service using USER'S tokens (not static files!)
+    gmail_service = create_gmail_service_for_user(user, db)
+    logger.info(f"Created Gmail service for user {user.email}")
+
+    # Emails an earlier refresh failed on are read again along with the new ones
+    retry_message_ids = get_pending_email_ids(db, user.id)
+
+    logger.info(f"Fetching emails for user {user.email}...")
+    if progress:
+        progress.set_stage("fetching")
+
+    # Emails go through the pipeline as they are fetched, so coupons are found
+    # (and reported) while later emails are still being read and OCRed
+    pipeline = EmailPipeline(user_id=user.id, on_result=progress.on_email_processed if progress else None)
+
+    def on_email(message_id, email_info):
+        if progress:
+            progress.on_email_fetched(message_id, email_info)
+        pipeline.add(message_id, email_info)
+
+    emails_info, history_id, failed_emails = get_new_emails_info_for_user(
+        gmail_service,
+        start_history_id=user.gmail_sync_history_id,
+        processed=ProcessedEmailLookup(db, user.id),
+        on_email=on_email,
+        retry_message_ids=retry_message_ids
+    )
+    logger.info(f"Retrieved {len(emails_info) if emails_info else 0} new emails for user {user.email}")
+
+    if progress:
+        progress.set_stage("extracting", total=len(emails_info))
+    # Results keep the order emails were fetched in
+    results = pipeline.finish()
+    new_coupons = [result["coupon"] for result in results if result["coupon"]]
+    processed_records = [result["processed"] for result in results if result["processed"]]
+    failed_emails.update((result["message_id"], result["error"]) for result in results if result["error"])
+
+    if emails_info:
+        logger.info(f"Total coupons found: {len(new_coupons)} out of {len(emails_info)} new emails for user {user.email}")
+    else:
+        logger.info(f"No new promotional emails found for user {user.email}")
+
+    if progress:
+        progress.set_stage("saving")
+    # Save coupons to database for caching
+    if new_coupons:
+        logger.info(f"Saving {len(new_coupons)} coupons to database for user {user.email}")
+        save_user_coupons_batch(db, user.id, new_coupons)
+        logger.info("Coupons saved successfully")
+    if processed_records:
+        for record in processed_records:
+            record["campaign_key"] = get_campaign_key(record["sender"], record["subject"])
+        save_processed_emails_batch(db, user.id, processed_records)
+
+    # Failed emails are retried by the next refreshes instead of holding the delta
+    # sync back, so one email that always fails cannot stall it
+    given_up = update_pending_emails(
+        db, user.id, retry_message_ids, failed_emails, settings.gmail_retry_max_attempts
+    )
+    if given_up:
+        logger.warning(f"Giving up on {len(given_up)} emails for user {user.email} after {settings.gmail_retry_max_attempts} failed attempts")
+    if history_id:
+        update_gmail_sync_history_id(db, user, history_id)
+
+    return {"new_coupons": new_coupons, "cached_coupons": cached_coupon_data, "emails_processed": len(emails_info)}
@@ -0,0 +1,242 @@
+"""
+Typed coupon extraction output.
+Pydantic models the Gemini extraction response is validated into, the matching
+response schemas for Gemini's structured output mode, and a tolerant JSON
+parser that salvages truncated or fenced responses instead of discarding them.
+"""
+import json
+import logging
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+logger = logging.getLogger(__name__)
+
+
+class OfferType(str, Enum):
+    discount = "discount"
+    coupon = "coupon"
+    free_shipping = "free_shipping"
+    bogo = "bogo"
+    free_gift = "free_gift"
+    loyalty_points = "loyalty_points"
+
+
+class Offer(BaseModel):
+    offer_brand: Optional[str] = None
+    offer_type: OfferType
+    discount_amount: Optional[str] = None
+    coupon_code: Optional[str] = None
+    expiry_date: Optional[str] = None
+    expiry_inferred: bool = False
+    offer_title: str
+    offer_description: Optional[str] = None
+    minimum_purchase: Optional[str] = None
+    terms_conditions: Optional[str] = None
+    call_to_action: Optional[str] = None
+
+    @field_validator(
+        "offer_brand", "discount_amount", "coupon_code", "expiry_date", "offer_description",
+        "minimum_purchase", "terms_conditions", "call_to_action", mode="before"
+    )
+    @classmethod
+    def normalize_optional_text(cls, value):
+        # Free-text responses spell missing values as "null"; numbers come back for amounts
+        if value is None or (isinstance(value, str) and value.strip().lower() in ("", "null", "none", "n/a")):
+            return None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        return value
+
+    @field_validator("offer_type", mode="before")
+    @classmethod
+    def normalize_offer_type(cls, value):
+        if isinstance(value, str):
+            return value.strip().lower().replace(" ", "_").replace("-", "_")
+        return value
+
+
+class CouponExtraction(BaseModel):
+    has_coupon: bool
+    email_sender_company: Optional[str] = None
+    offers: List[Offer] = []
+
+
+# Gemini response schemas (OpenAPI subset) matching the models above
+OFFER_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "offer_brand": {"type": "string", "nullable": True},
+        "offer_type": {"type": "string", "enum": [offer_type.value for offer_type in OfferType]},
+        "discount_amount": {"type": "string", "nullable": True},
+        "coupon_code": {"type": "string", "nullable": True},
+        "expiry_date": {"type": "string", "nullable": True},
+        "expiry_inferred": {"type": "boolean"},
+        "offer_title": {"type": "string"},
+        "offer_description": {"type": "string", "nullable": True},
+        "minimum_purchase": {"type": "string", "nullable": True},
+        "terms_conditions": {"type": "string", "nullable": True},
+        "call_to_action": {"type": "string", "nullable": True},
+    },
+    "required": ["offer_type", "offer_title", "expiry_inferred"],
+}
+
+EXTRACTION_PROPERTIES = {
+    "has_coupon": {"type": "boolean"},
+    "email_sender_company": {"type": "string", "nullable": True},
+    "offers": {"type": "array", "items": OFFER_RESPONSE_SCHEMA},
+}
+
+EXTRACTION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": EXTRACTION_PROPERTIES,
+    "required": ["has_coupon", "offers"],
+}
+
+BATCH_EXTRACTION_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"email_key": {"type": "string"}, **EXTRACTION_PROPERTIES},
+        "required": ["email_key", "has_coupon", "offers"],
+    },
+}
+
+
+def strip_code_fences(response_text):
+    """Remove a surrounding markdown code block (```json ... ```) if present"""
+    response_text = response_text.strip()
+    if response_text.startswith("```"):
+        response_text = response_text[3:]
+        if response_text.lower().startswith("json"):
+            response_text = response_text[4:]
+        if response_text.rstrip().endswith("```"):
+            response_text = response_text.rstrip()[:-3]
+    return response_text.strip()
+
+
+def scan_json_document(text):
+    """
+    Find the first JSON document in text, which may be surrounded by prose.
+
+    Returns:
+        (document, repairs): document is the first balanced object or array, or
+        None if the text ends before it closes. repairs are then the candidate
+        cut-and-closed versions of the truncated document, best first.
+    """
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    if not starts:
+        return None, []
+    start = min(starts)
+
+    closers = []
+    cut_points = []
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+            cut_points.append((index + 1, "".join(reversed(closers))))
+        elif char in "}]":
+            if not closers or closers[-1] != char:
+                break
+            closers.pop()
+            if not closers:
+                return text[start:index + 1], []
+            cut_points.append((index + 1, "".join(reversed(closers))))
+        elif char == ",":
+            cut_points.append((index, "".join(reversed(closers))))
+
+    return None, [text[start:cut] + closing for cut, closing in reversed(cut_points)]
+
+
+def repair_truncated_json(text):
+    """
+    Candidate repairs of a truncated JSON document, best first.
+
+    Each candidate cuts the text after the last complete value (or an opening
+    bracket) and closes whatever objects and arrays are still open, so a
+    response cut off by the token limit keeps every offer it finished. A
+    document that is complete is returned as the only candidate.
+    """
+    document, repairs = scan_json_document(text)
+    return [document] if document is not None else repairs
+
+
+def parse_json_response(response_text):
+    """
+    Parse a JSON model response, repairing fences, surrounding prose and truncation.
+
+    Returns:
+        (data, repaired): repaired is True if the text had to be cut and closed,
+        in which case the data may be missing whatever came after the cut.
+        A complete document that only needed fences or prose removed is not repaired.
+
+    Raises:
+        json.JSONDecodeError: If nothing parseable can be recovered
+    """
+    text = strip_code_fences(response_text)
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as error:
+        first_error = error
+
+    document, repairs = scan_json_document(text)
+    if document is not None:
+        try:
+            return json.loads(document), False
+        except json.JSONDecodeError:
+            pass
+
+    for candidate in repairs:
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        logger.info(f"Repaired malformed JSON response ({len(text)} chars -> {len(candidate)} chars)")
+        return parsed, True
+    raise first_error
+
+
+def validate_extraction(data):
+    """
+    Validate one extraction object into the stored dict format.
+
+    Offers that fail validation (e.g. an unknown offer_type) are dropped
+    individually instead of failing the whole email.
+
+    Raises:
+        ValueError: If data isn't an extraction object at all
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+
+    offers = []
+    for offer in data.get("offers") or []:
+        try:
+            offers.append(Offer.model_validate(offer))
+        except ValidationError as e:
+            logger.info(f"Dropping invalid offer: {e.errors()[0].get('msg')}")
+
+    try:
+        extraction = CouponExtraction.model_validate({**data, "offers": []})
+    except ValidationError as e:
+        raise ValueError(f"Invalid extraction response: {e.errors()[0].get('msg')}") from e
+
+    extraction.offers = offers
+    # A coupon without a single usable offer can't be shown
+    extraction.has_coupon = extraction.has_coupon and bool(offers)
+    return extraction.model_dump(mode="json")
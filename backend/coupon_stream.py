@@ -0,0 +1,110 @@
+"""
+Streaming coupon refresh for GET /api/coupons/stream
+The refresh runs on the blocking executor and reports to the event loop as it
+goes, so the client gets each coupon as soon as its email is processed instead
+of waiting for the whole refresh. Events are newline-delimited JSON:
+
+    {"type": "cached", "coupons": [...]}                 coupons saved before this refresh
+    {"type": "progress", "stage": ..., "emails_fetched": ..., "emails_extracted": ..., "emails_total": ...}
+    {"type": "coupon", "coupon": {...}}                  a new coupon, same shape as in all_coupons
+    {"type": "done", "total_emails_processed": ..., "emails_with_coupons": ...}
+    {"type": "error", "detail": "..."}
+"""
+import json
+import time
+import asyncio
+import logging
+import threading
+
+from core.config import settings
+from core.executor import run_blocking
+from database.connection import SessionLocal
+from auth.crud import get_user_by_id, get_all_user_coupons
+from coupon_refresh import refresh_coupons_for_user
+
+logger = logging.getLogger(__name__)
+
+class RefreshEventStream:
+    """Progress listener for refresh_coupons_for_user that turns progress into stream events"""
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.progress = {"stage": None, "emails_fetched": 0, "emails_extracted": 0, "emails_total": None}
+        self.lock = threading.Lock()
+        self.progress_sent_at = 0.0
+
+    def emit(self, event):
+        """Hand an event to the event loop (called from refresh and pipeline threads)"""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def emit_progress(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.progress_sent_at < settings.coupon_stream_progress_interval_seconds:
+                return
+            self.progress_sent_at = now
+            event = {"type": "progress", **self.progress}
+        self.emit(event)
+
+    def set_stage(self, stage, total=None):
+        with self.lock:
+            self.progress["stage"] = stage
+            if total is not None:
+                self.progress["emails_total"] = total
+        self.emit_progress(force=True)
+
+    def on_email_fetched(self, message_id, email_info):
+        with self.lock:
+            self.progress["emails_fetched"] += 1
+        self.emit_progress()
+
+    def on_email_processed(self, result):
+        with self.lock:
+            self.progress["emails_extracted"] += 1
+        if result.get("coupon"):
+            self.emit({"type": "coupon", "coupon": result["coupon"]})
+        self.emit_progress()
+
+def run_streamed_refresh(user_id: int, refresh: bool, events: RefreshEventStream):
+    """Blocking part of the stream: same flow as GET /api/coupons, reported through events"""
+    db = SessionLocal()
+    try:
+        user = get_user_by_id(db, user_id)
+        if not user or not user.gmail_connected or not user.gmail_access_token:
+            events.emit({"type": "error", "detail": "Gmail not connected. Please connect your Gmail account first."})
+            return
+
+        cached_coupon_data = [json.loads(coupon.coupon_data) for coupon in get_all_user_coupons(db, user_id)]
+        events.emit({"type": "cached", "coupons": cached_coupon_data})
+        if not refresh and cached_coupon_data:
+            events.emit({"type": "done", "total_emails_processed": len(cached_coupon_data), "emails_with_coupons": len(cached_coupon_data)})
+            return
+
+        refresh_result = refresh_coupons_for_user(db, user, progress=events)
+        events.emit({
+            "type": "done",
+            "total_emails_processed": refresh_result["emails_processed"],
+            "emails_with_coupons": len(refresh_result["new_coupons"]) + len(refresh_result["cached_coupons"])
+        })
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Streamed refresh failed for user {user_id}: {e}")
+        events.emit({"type": "error", "detail": str(getattr(e, "detail", e))})
+    finally:
+        db.close()
+        events.emit(None)
+
+async def stream_coupon_events(user_id: int, refresh: bool):
+    """Async generator of NDJSON lines for a StreamingResponse"""
+    queue = asyncio.Queue()
+    events = RefreshEventStream(asyncio.get_running_loop(), queue)
+    # Keeps running if the client disconnects, so the refresh still gets saved
+    refresh_task = asyncio.ensure_future(run_blocking(run_streamed_refresh, user_id, refresh, events))
+
+    while True:
+        event = await queue.get()
+        if event is None:
+            break
+        yield json.dumps(event, default=str) + "\n"
+    await refresh_task
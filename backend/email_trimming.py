@@ -0,0 +1,105 @@
+"""
+Email content reduction for the extraction prompt.
+Drops footer boilerplate (unsubscribe, address, privacy) and repeated
+sentences, then, if the email is still over the token budget, keeps the
+sentences most likely to describe an offer.
+"""
+import re
+
+from core.config import settings
+from offer_signals import detect_offer_signals, count_strong_signals
+
+# Rough token estimate (Gemini averages ~4 characters per token)
+CHARS_PER_TOKEN = 4
+
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?])\s+|\s+\|\s+|\n+")
+
+BOILERPLATE_PATTERN = re.compile(
+    r"\b(?:unsubscribe|opt[- ]out|manage (?:your )?(?:email )?preferences|update your preferences"
+    r"|view (?:it |this email )?(?:in|on) (?:your |a )?(?:browser|web)|privacy (?:policy|notice|statement)"
+    r"|all rights reserved|copyright|this (?:email|message) was sent to|you(?: are|'re) receiving this"
+    r"|add us to your address book|please do not reply|do not reply to this|follow us on|download (?:our|the) app"
+    r"|customer service|contact us|terms of (?:use|service))\b"
+    r"|©"
+    r"|\b\d{1,5}\s+(?:[A-Z][a-z]+\s+){1,3}(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr|Lane|Ln|Way|Suite)\b",
+    re.IGNORECASE,
+)
+
+# Sections of the text built by get_email_info_from_message
+SECTION_LABELS = ("Plain Text:", "Image Text:")
+
+
+def estimate_tokens(text):
+    """Rough token count of a piece of text"""
+    return len(text or "") // CHARS_PER_TOKEN + 1
+
+
+def score_sentence(sentence):
+    """Offer relevance of a sentence: strong offer signals count most, then offer keywords"""
+    signals = detect_offer_signals(sentence)
+    return 3 * count_strong_signals(signals) + min(signals["keyword"], 3)
+
+
+def split_sections(email_text):
+    """[(label, text)] for the plain text and image text sections (label "" if unlabeled)"""
+    label_pattern = "|".join(re.escape(label) for label in SECTION_LABELS)
+    parts = re.split(rf"\s*({label_pattern})", email_text)
+    if len(parts) == 1:
+        return [("", email_text)]
+    sections = [("", parts[0])] if parts[0].strip() else []
+    for index in range(1, len(parts) - 1, 2):
+        sections.append((parts[index], parts[index + 1]))
+    return sections
+
+
+def trim_email_text(email_text, token_budget=None):
+    """
+    Reduce email text to what matters for coupon extraction.
+
+    Args:
+        email_text: Email text from get_email_info_from_message
+        token_budget: Max estimated tokens (default settings.extraction_email_token_budget, 0 = no cap)
+
+    Returns:
+        (trimmed text, estimated tokens saved)
+    """
+    token_budget = settings.extraction_email_token_budget if token_budget is None else token_budget
+    original_tokens = estimate_tokens(email_text)
+    if not email_text:
+        return email_text, 0
+
+    # Sentences per section, without boilerplate and sentences already seen (OCR often repeats the plain text)
+    seen = set()
+    sentences = []  # (section index, position, sentence)
+    sections = split_sections(email_text)
+    for section_index, (_, section_text) in enumerate(sections):
+        for sentence in SENTENCE_SPLIT_PATTERN.split(section_text):
+            sentence = sentence.strip()
+            normalized = " ".join(sentence.lower().split())
+            if not sentence or normalized in seen:
+                continue
+            seen.add(normalized)
+            if settings.extraction_trim_boilerplate and BOILERPLATE_PATTERN.search(sentence) and not score_sentence(sentence):
+                continue
+            sentences.append((section_index, len(sentences), sentence))
+
+    label_tokens = sum(estimate_tokens(label) for label, _ in sections)
+    if token_budget and sum(estimate_tokens(sentence) for _, _, sentence in sentences) + label_tokens > token_budget:
+        # Keep the most offer-relevant sentences, earlier ones first on ties, in their original order
+        ranked = sorted(sentences, key=lambda item: (-score_sentence(item[2]), item[1]))
+        kept = []
+        used_tokens = label_tokens
+        for item in ranked:
+            sentence_tokens = estimate_tokens(item[2])
+            if used_tokens + sentence_tokens > token_budget:
+                continue
+            kept.append(item)
+            used_tokens += sentence_tokens
+        sentences = sorted(kept, key=lambda item: item[1])
+
+    trimmed_sections = []
+    for section_index, (label, _) in enumerate(sections):
+        section_sentences = " ".join(sentence for index, _, sentence in sentences if index == section_index)
+        trimmed_sections.append(f"{label} {section_sentences}".strip())
+    trimmed_text = "\n ".join(trimmed_sections)
+    return trimmed_text, max(original_tokens - estimate_tokens(trimmed_text), 0)
@@ -0,0 +1,119 @@
+"""
+Rule extractor evaluation
+Runs the rule-based extractor over a fixture corpus of labeled emails and
+reports coverage (emails it would take away from Gemini at the configured
+confidence) and field-by-field agreement with the fixture labels.
+
+The committed labels are hand-written, so agreement only says the rules match
+what a person read in those emails. Measure agreement with Gemini itself by
+re-labeling first with --refresh-llm.
+
+Usage:
+    python evaluate_rule_extractor.py [fixtures.json] [--min-confidence 0.9] [--refresh-llm]
+
+--refresh-llm re-labels the corpus with the live Gemini extraction
+(needs GEMINI_API_KEY) and writes it back before evaluating.
+"""
+import json
+import argparse
+from datetime import datetime
+
+from core.config import settings
+from rule_extractor import extract_offers_with_rules
+
+DEFAULT_FIXTURES = "fixtures/coupon_emails.json"
+COMPARED_FIELDS = ("offer_type", "discount_amount", "coupon_code", "minimum_purchase", "expiry_date")
+
+def load_fixtures(path):
+    with open(path) as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    for email in fixtures["emails"]:
+        email["email_timestamp"] = datetime.fromisoformat(email["email_timestamp"])
+    return fixtures
+
+def refresh_llm_labels(path, fixtures):
+    """Replace llm_output with what Gemini extracts today"""
+    from get_coupon_info_from_email import get_coupon_info_from_email
+
+    for email in fixtures["emails"]:
+        email["llm_output"] = get_coupon_info_from_email(
+            email["email_text"], email["email_subject"], email["email_sender"], email["email_timestamp"]
+        )
+    fixtures["label_source"] = "Gemini labels"
+    serializable = {
+        **fixtures,
+        "emails": [{**email, "email_timestamp": email["email_timestamp"].isoformat()} for email in fixtures["emails"]],
+    }
+    with open(path, "w") as fixtures_file:
+        json.dump(serializable, fixtures_file, indent=2, ensure_ascii=False)
+    print(f"✅ Re-labeled {len(fixtures['emails'])} emails with Gemini")
+
+def main_offer(coupon_info):
+    """The offer compared field by field: the first discount/coupon offer, else the first offer"""
+    offers = (coupon_info or {}).get("offers") or []
+    for offer in offers:
+        if offer.get("offer_type") in ("discount", "coupon"):
+            return offer
+    return offers[0] if offers else {}
+
+def normalize_field(value):
+    if value is None or (isinstance(value, str) and value.strip().lower() in ("", "null")):
+        return None
+    return str(value).strip().upper()
+
+def evaluate(fixtures, min_confidence):
+    emails = fixtures["emails"]
+    covered = 0
+    has_coupon_agreements = 0
+    offer_count_agreements = 0
+    field_agreements = {field: 0 for field in COMPARED_FIELDS}
+    disagreements = []
+
+    print(f"{'email':<45} {'confidence':>10}  result")
+    for email in emails:
+        coupon_info, confidence = extract_offers_with_rules(
+            email["email_text"], email["email_subject"], email["email_sender"], email["email_timestamp"]
+        )
+        is_covered = coupon_info is not None and confidence >= min_confidence
+        label = f"{email['email_sender'].split('<')[0].strip()}: {email['email_subject']}"[:45]
+        print(f"{label:<45} {confidence:>10.2f}  {'skips Gemini' if is_covered else 'sent to Gemini'}")
+        if not is_covered:
+            continue
+
+        covered += 1
+        llm_output = email["llm_output"]
+        if bool(coupon_info["has_coupon"]) == bool(llm_output.get("has_coupon")):
+            has_coupon_agreements += 1
+        if len(coupon_info["offers"]) == len(llm_output.get("offers") or []):
+            offer_count_agreements += 1
+        else:
+            disagreements.append((label, "offer count", len(coupon_info["offers"]), len(llm_output.get("offers") or [])))
+        rule_offer, llm_offer = main_offer(coupon_info), main_offer(llm_output)
+        for field in COMPARED_FIELDS:
+            if normalize_field(rule_offer.get(field)) == normalize_field(llm_offer.get(field)):
+                field_agreements[field] += 1
+            else:
+                disagreements.append((label, field, rule_offer.get(field), llm_offer.get(field)))
+
+    label_source = fixtures.get("label_source", "hand-written labels")
+    print(f"\nCoverage: {covered}/{len(emails)} emails ({covered / len(emails):.0%}) skip Gemini at confidence >= {min_confidence}")
+    if covered:
+        print(f"Agreement with the {label_source} on covered emails:")
+        print(f"  has_coupon: {has_coupon_agreements}/{covered}")
+        print(f"  offer count: {offer_count_agreements}/{covered}")
+        for field in COMPARED_FIELDS:
+            print(f"  {field}: {field_agreements[field]}/{covered}")
+    for label, field, rule_value, llm_value in disagreements:
+        print(f"  ⚠️  {label} - {field}: rules {rule_value!r}, label {llm_value!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rule extractor coverage and agreement with the fixture labels")
+    parser.add_argument("fixtures", nargs="?", default=DEFAULT_FIXTURES)
+    parser.add_argument("--min-confidence", type=float, default=settings.rule_extractor_min_confidence)
+    parser.add_argument("--refresh-llm", action="store_true", help="re-label the corpus with Gemini first")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    if args.refresh_llm:
+        refresh_llm_labels(args.fixtures, fixtures)
+    evaluate(fixtures, args.min_confidence)
@@ -0,0 +1,143 @@
+"""
+Content-addressed coupon extraction cache shared across users.
+The same marketing blast lands in many inboxes, so parsed Gemini results are
+stored under a hash of the normalized sender, subject and body, with
+per-recipient details removed first, and versioned by prompt and model.
+Extractions whose coupon code came from one of those removed details are
+personal codes and are not shared.
+"""
+import re
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from core.config import settings
+from core.db_cache import upsert_entry, prune_entries, PruneSchedule
+from database.connection import SessionLocal
+from auth.models import ExtractionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Per-recipient details that differ between copies of the same campaign
+EMAIL_ADDRESS_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+URL_PATTERN = re.compile(r"\S*(?:https?://|www\.)\S+", re.IGNORECASE)
+GREETING_PATTERN = re.compile(r"\b(hi|hey|hello|dear|welcome back|thanks|thank you),?\s+[A-Z][\w'-]*\s*[,!.:]", re.IGNORECASE)
+SUBJECT_NAME_PREFIX_PATTERN = re.compile(r"^[A-Z][a-z'-]+\s*[,:!]\s+")
+UNSUBSCRIBE_PATTERN = re.compile(r"[^.!?]*\b(unsubscribe|manage (your )?preferences|this email was sent to|view (it )?in (your )?browser|you are receiving this)\b[^.!?]*[.!?]?", re.IGNORECASE)
+# Long tokens mixing letters and digits: tracking IDs, member numbers, unsubscribe tokens
+TOKEN_PATTERN = re.compile(r"\b(?=[A-Za-z0-9_-]*\d)(?=[A-Za-z0-9_-]*[A-Za-z])[A-Za-z0-9_-]{16,}\b")
+
+
+def normalize_campaign_text(text):
+    """Remove per-recipient details from email text and normalize whitespace and case"""
+    text = URL_PATTERN.sub(" ", text or "")
+    text = EMAIL_ADDRESS_PATTERN.sub(" ", text)
+    text = GREETING_PATTERN.sub(" ", text)
+    text = UNSUBSCRIBE_PATTERN.sub(" ", text)
+    text = TOKEN_PATTERN.sub(" ", text)
+    return " ".join(text.split()).lower()
+
+
+def get_stripped_fragments(text):
+    """Tokens and URLs normalize_campaign_text removes from text as per-recipient details"""
+    text = text or ""
+    return [match.group(0) for pattern in (URL_PATTERN, TOKEN_PATTERN) for match in pattern.finditer(text)]
+
+
+def is_shareable_extraction(result, email_text, email_subject):
+    """
+    Whether an extraction can be shared with other recipients of the campaign.
+
+    Not if a coupon code was extracted from a part of the email left out of the
+    cache key (a long unique token or a link): that is likely a personal,
+    single-use code, and other recipients' copies map to the same key.
+    """
+    fragments = [fragment.upper() for fragment in get_stripped_fragments(email_text) + get_stripped_fragments(email_subject)]
+    if not fragments:
+        return True
+    for offer in result.get("offers") or []:
+        code = (offer.get("coupon_code") or "").strip().upper()
+        if code and any(code in fragment for fragment in fragments):
+            return False
+    return True
+
+
+def get_extraction_cache_key(email_text, email_subject, email_sender, email_timestamp, prompt_version, model_name):
+    """
+    Cache key for one email's extraction.
+
+    The email date is part of the key because relative expiry dates
+    ("ends Sunday", "Summer") are resolved against it.
+    """
+    sender_match = re.search(r'<(.+?)>', email_sender or "")
+    sender_address = (sender_match.group(1) if sender_match else (email_sender or "")).strip().lower()
+    subject = SUBJECT_NAME_PREFIX_PATTERN.sub("", (email_subject or "").strip())
+    email_date = email_timestamp.date().isoformat() if hasattr(email_timestamp, "date") else str(email_timestamp)[:10]
+
+    key_parts = [
+        prompt_version,
+        model_name,
+        email_date,
+        sender_address,
+        normalize_campaign_text(subject),
+        normalize_campaign_text(email_text),
+    ]
+    return hashlib.sha256("\x1f".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_extraction(cache_key):
+    """Get a cached extraction result (parsed JSON dict), or None on a miss or expired entry"""
+    if not settings.extraction_cache_enabled:
+        return None
+
+    db = SessionLocal()
+    try:
+        entry = db.query(ExtractionCacheEntry).filter(ExtractionCacheEntry.cache_key == cache_key).first()
+        now = datetime.utcnow()
+        if not entry or entry.created_at is None or entry.created_at + timedelta(days=settings.extraction_cache_ttl_days) < now:
+            return None
+
+        entry.last_used_at = now
+        db.commit()
+        return json.loads(entry.result_data)
+    except Exception as e:
+        logger.warning(f"Extraction cache lookup failed: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def store_extraction(cache_key, result, prompt_version, model_name):
+    """Store a successful extraction result"""
+    if not settings.extraction_cache_enabled:
+        return
+
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        upsert_entry(
+            db, ExtractionCacheEntry, ExtractionCacheEntry.cache_key, cache_key,
+            prompt_version=prompt_version, model_name=model_name, result_data=json.dumps(result),
+            created_at=now, last_used_at=now
+        )
+    except Exception as e:
+        logger.warning(f"Extraction cache write failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    _prune_schedule.record_write()
+
+
+def prune_extraction_cache():
+    """Delete expired entries, then the least recently used ones beyond extraction_cache_max_entries"""
+    cutoff = datetime.utcnow() - timedelta(days=settings.extraction_cache_ttl_days)
+    prune_entries(
+        SessionLocal, ExtractionCacheEntry, ExtractionCacheEntry.created_at < cutoff,
+        settings.extraction_cache_max_entries, "extraction"
+    )
+
+
+_prune_schedule = PruneSchedule(lambda: prune_extraction_cache())
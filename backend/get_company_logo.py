@@ -3,8 +3,12 @@ import requests
 import logging
 from typing import Optional, List
 
+import logo_cache
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_LOGO_URL = "https://cdn-icons-png.flaticon.com/512/295/295144.png"
+
 def extract_root_domain(domain: str) -> str:
     """
     Extract root domain from a subdomain.
@@ -85,9 +89,9 @@ def get_company_logo_from_sender(sender_email: str) -> Optional[str]:
     
     This function:
     1. Extracts domain from sender email
-    2. Tries multiple logo sources
-    3. Tests each source to ensure it works
-    4. Returns first working logo URL
+    2. Returns the cached result for the domain, if any
+    3. Otherwise tries multiple logo sources, testing each to ensure it works
+    4. Caches and returns the first working logo URL (or that none worked)
     """
     try:
         logger.info(f"Getting logo for sender: {sender_email}")
@@ -98,6 +102,11 @@ def get_company_logo_from_sender(sender_email: str) -> Optional[str]:
             logger.warning(f"Could not extract domain from: {sender_email}")
             return None
         
+        # Repeat domains skip the probes, including ones where no source worked
+        cached_logo_url = logo_cache.get_cached_logo(domain)
+        if cached_logo_url is not None:
+            return cached_logo_url or DEFAULT_LOGO_URL
+        
         # Get logo sources
         logo_sources = get_logo_sources(domain)
         
@@ -105,14 +114,16 @@ def get_company_logo_from_sender(sender_email: str) -> Optional[str]:
         for logo_url in logo_sources:
             if test_logo_url(logo_url):
                 logger.info(f"Found working logo for {domain}: {logo_url}")
+                logo_cache.store_logo(domain, logo_url)
                 return logo_url
         
         logger.warning(f"No working logo found for domain: {domain}. Returning default logo.")
-        return "https://cdn-icons-png.flaticon.com/512/295/295144.png" # Default logo
+        logo_cache.store_logo(domain, logo_cache.NO_LOGO)
+        return DEFAULT_LOGO_URL
 
     except Exception as e:
         logger.error(f"Error getting logo for {sender_email}: {str(e)}. Returning default logo.")
-        return "https://cdn-icons-png.flaticon.com/512/295/295144.png" # Default logo
+        return DEFAULT_LOGO_URL
 
 def get_company_logo_info(sender_email: str) -> dict:
     """
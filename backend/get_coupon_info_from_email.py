@@ -1,32 +1,22 @@
-import os
-import json
-import google.generativeai as genai
+import hashlib
 from dotenv import load_dotenv
 from company_categorization import get_company_category
+from core.config import settings
+from coupon_schema import (
+    EXTRACTION_RESPONSE_SCHEMA, BATCH_EXTRACTION_RESPONSE_SCHEMA, parse_json_response, validate_extraction
+)
+from email_trimming import estimate_tokens, trim_email_text
+from core.rate_limiter import gemini_limiter
+from core.gemini import get_model
+import extraction_cache
 
 # Load environment variables
 load_dotenv()
 
-def get_coupon_info_from_email(email_text, email_subject, email_sender, email_timestamp):
-    """
-    Extracts comprehensive coupon information from email text using Gemini AI.
-    """
-    # Configure Gemini API
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    
-    try:
-        # Get the model
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        
-        # Focused prompt for coupon extraction
-        prompt = f"""
-        Extract actionable coupon offers from this email. ONLY classify as coupon if it provides immediate monetary savings.
-
-        Email: {email_sender} | {email_subject}
-        Email Timestamp: {email_timestamp}
-        Content: {email_text}
+EXTRACTION_MODEL = 'gemini-2.5-flash-lite'
 
-        STRICT CRITERIA FOR offer_type - Must have ALL required fields:
+# Instructions shared by the single-email and batch prompts (str.format template text)
+EXTRACTION_RULES = """        STRICT CRITERIA FOR offer_type - Must have ALL required fields:
         • discount: Specific % or $ off + shopping method (e.g., "20% off", "Shop Now")
         • coupon: Promotional code (e.g., "SAVE20", "Use Code")  
         • free_shipping: Free delivery terms (e.g., "Free shipping on $50+")
@@ -43,11 +33,11 @@ def get_coupon_info_from_email(email_text, email_subject, email_sender, email_ti
         - Reward points/cashback with specific percentages or values
 
         EXPIRY DATE RULES:
-        - Use the email timestamp above to determine the current year and context
+        - Use the Email Timestamp given with each email to determine the current year and context
         - Explicit dates: extract exact date (YYYY-MM-DD)
         - For temporal expressions without specific dates:
           • Convert time references to descriptive text (e.g., "all summer long" → "Summer 2025")
-          • For seasons, use "Season Year" format based on email timestamp year
+          • For seasons, use "Season Year" format based on the Email Timestamp year
           • For indefinite terms, keep descriptive (e.g., "Limited Time", "While supplies last")
         - Always look for temporal clues and convert them to user-friendly expiry descriptions
         - Mark inferred dates clearly for UI display
@@ -72,34 +62,359 @@ def get_coupon_info_from_email(email_text, email_subject, email_sender, email_ti
             "call_to_action": "Shop Now|Use Code|etc"
         }}
         """
+
+# Static instructions, set once as the model's system instruction instead of resent in every prompt
+EXTRACTION_SYSTEM_INSTRUCTION = """
+        Extract actionable coupon offers from the email in each request. ONLY classify as coupon if it provides immediate monetary savings.
+
+""" + EXTRACTION_RULES.format()
+
+# Several emails in one request: the rules are sent once instead of once per email
+BATCH_EXTRACTION_SYSTEM_INSTRUCTION = """
+        Extract actionable coupon offers from each of the emails in each request. ONLY classify as coupon if it provides immediate monetary savings.
+        Judge every email on its own and never move offers from one email to another.
+
+""" + EXTRACTION_RULES.format() + """
+        Respond with a JSON array containing exactly one element per email. Each element follows the
+        JSON Response Structure above plus the key of the email it describes:
+        [{"email_key": "1", "has_coupon": true/false, "email_sender_company": "Company Name", "offers": [...]}]
+        """
+
+# Per-email part of the prompt (str.format template)
+EXTRACTION_PROMPT_TEMPLATE = """
+        Email: {email_sender} | {email_subject}
+        Email Timestamp: {email_timestamp}
+        Content: {email_text}
+"""
+
+BATCH_EXTRACTION_PROMPT_TEMPLATE = """
+        Emails:
+{emails}
+        """
+
+BATCH_EMAIL_TEMPLATE = """
+        === Email key: {email_key} ===
+        Email: {email_sender} | {email_subject}
+        Email Timestamp: {email_timestamp}
+        Content: {email_text}
+"""
+
+# Expected response size, charged against the tokens-per-minute budget up front
+OUTPUT_TOKENS_PER_EMAIL = 400
+
+# Changes whenever the prompt text changes, so cached extractions are never reused across prompts
+PROMPT_VERSION = hashlib.sha256("".join([
+    EXTRACTION_SYSTEM_INSTRUCTION, BATCH_EXTRACTION_SYSTEM_INSTRUCTION,
+    EXTRACTION_PROMPT_TEMPLATE, BATCH_EXTRACTION_PROMPT_TEMPLATE, BATCH_EMAIL_TEMPLATE
+]).encode("utf-8")).hexdigest()[:12]
+
+def get_generation_config(response_schema):
+    """Gemini generation config: native JSON output constrained to the schema, when enabled"""
+    if not settings.extraction_structured_output:
+        return None
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+
+def get_extraction_model(batch=False):
+    """
+    Shared extraction model with the static instructions as its system instruction.
+    Keyed by PROMPT_VERSION, so a prompt change gets a new model (and context cache).
+    """
+    if batch:
+        purpose, system_instruction, response_schema = "extraction-batch", BATCH_EXTRACTION_SYSTEM_INSTRUCTION, BATCH_EXTRACTION_RESPONSE_SCHEMA
+    else:
+        purpose, system_instruction, response_schema = "extraction", EXTRACTION_SYSTEM_INSTRUCTION, EXTRACTION_RESPONSE_SCHEMA
+    return get_model(
+        EXTRACTION_MODEL, f"{purpose}-{PROMPT_VERSION}",
+        cache_system_instruction=settings.extraction_context_cache,
+        system_instruction=system_instruction,
+        generation_config=get_generation_config(response_schema)
+    )
+
+
+def is_truncated_response(response):
+    """Whether Gemini stopped the response at the output token limit"""
+    for candidate in getattr(response, "candidates", None) or []:
+        finish_reason = getattr(candidate, "finish_reason", None)
+        if getattr(finish_reason, "name", finish_reason) == "MAX_TOKENS":
+            return True
+    return False
+
+
+def get_email_cache_key(email):
+    """Extraction cache key for an email info dict"""
+    return extraction_cache.get_extraction_cache_key(
+        email["email_text"], email["email_subject"], email["email_sender"], email["email_timestamp"],
+        PROMPT_VERSION, EXTRACTION_MODEL
+    )
+
+def store_extraction(cache_key, coupon_info, email_text, email_subject):
+    """Cache an extraction for every recipient of the campaign, unless it carries a personal code"""
+    if not extraction_cache.is_shareable_extraction(coupon_info, email_text, email_subject):
+        print("Not caching extraction: its coupon code is personal to the recipient")
+        return
+    extraction_cache.store_extraction(cache_key, coupon_info, PROMPT_VERSION, EXTRACTION_MODEL)
+
+def get_coupon_info_from_email(email_text, email_subject, email_sender, email_timestamp, prompt_text=None):
+    """
+    Extracts comprehensive coupon information from email text using Gemini AI.
+    Results are cached by normalized email content, so a campaign sent to many
+    users is only sent to Gemini once per prompt version. prompt_text is the
+    already trimmed email text, if the caller has it (see trim_email_text).
+    """
+    cache_key = get_email_cache_key({
+        "email_text": email_text, "email_subject": email_subject,
+        "email_sender": email_sender, "email_timestamp": email_timestamp
+    })
+    cached_info = extraction_cache.get_cached_extraction(cache_key)
+    if cached_info is not None:
+        return cached_info
+
+    try:
+        # Shared model holding the static instructions
+        model = get_extraction_model()
+        
+        # Drop boilerplate and low-relevance sentences beyond the token budget
+        if prompt_text is None:
+            prompt_text, tokens_saved = trim_email_text(email_text)
+            if tokens_saved:
+                print(f"Trimmed email text by ~{tokens_saved} tokens ({estimate_tokens(email_text)} -> {estimate_tokens(prompt_text)})")
+
+        # Only the email itself is sent per call
+        prompt = EXTRACTION_PROMPT_TEMPLATE.format(
+            email_sender=email_sender,
+            email_subject=email_subject,
+            email_timestamp=email_timestamp,
+            email_text=prompt_text
+        )
         
         # Generate content
-        response = model.generate_content(prompt)
+        response = gemini_limiter.call(
+            model.generate_content, prompt,
+            estimated_tokens=estimate_tokens(EXTRACTION_SYSTEM_INSTRUCTION + prompt) + OUTPUT_TOKENS_PER_EMAIL
+        )
         
-        # Parse the JSON response
+        # Parse the JSON response, repairing truncated output, and validate it
         try:
-            response_text = response.text.strip()
-            
-            # Check if response is wrapped in markdown code blocks
-            if response_text.startswith("```json") and response_text.endswith("```"):
-                # Extract JSON from markdown code blocks
-                json_text = response_text[7:-3].strip()  # Remove ```json and ```
-            elif response_text.startswith("```") and response_text.endswith("```"):
-                # Generic code block
-                json_text = response_text[3:-3].strip()  # Remove ``` and ```
-            else:
-                # Plain JSON
-                json_text = response_text
-
-            coupon_info = json.loads(json_text)
+            data, repaired = parse_json_response(response.text)
+            coupon_info = validate_extraction(data)
+            if repaired or is_truncated_response(response):
+                # A cut-off response may have lost offers (or all of them): neither cached
+                # nor recorded as processed, so the next refresh retries the email
+                print(f"Truncated AI response ({len(coupon_info.get('offers', []))} offers recovered), will retry")
+                return {"has_coupon": False, "error": "Truncated AI response"}
+            store_extraction(cache_key, coupon_info, email_text, email_subject)
             return coupon_info
-        except json.JSONDecodeError as e:
-            # If JSON parsing fails, try to extract structured info manually
-            print(f"Failed to parse JSON response. JSON Error: {e}")
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too
+            print(f"Failed to parse JSON response. Error: {e}")
             print("Raw response:")
             print(response.text)
             return {"has_coupon": False, "error": "Failed to parse AI response"}
             
     except Exception as e:
         print(f"Error processing email with Gemini: {e}")
-        return {"has_coupon": False, "error": str(e)}
\ No newline at end of file
+        return {"has_coupon": False, "error": str(e)}
+
+
+def prepare_batch_email(message_id, email):
+    """Copy of an email info dict with its trimmed text as "prompt_text", ready for a batch prompt"""
+    # Drop boilerplate and low-relevance sentences beyond the token budget
+    prompt_text, tokens_saved = trim_email_text(email["email_text"])
+    if tokens_saved:
+        print(f"Trimmed email {message_id} by ~{tokens_saved} tokens ({estimate_tokens(email['email_text'])} -> {estimate_tokens(prompt_text)})")
+    return {**email, "prompt_text": prompt_text}
+
+
+def render_batch_email(email_key, email):
+    """Render one email (from prepare_batch_email) of a batch prompt"""
+    return BATCH_EMAIL_TEMPLATE.format(
+        email_key=email_key,
+        email_sender=email["email_sender"],
+        email_subject=email["email_subject"],
+        email_timestamp=email["email_timestamp"],
+        email_text=email["prompt_text"]
+    )
+
+
+class ExtractionBatchPacker:
+    """
+    Packs emails into extraction batches as they arrive.
+
+    Emails are added in order until either settings.extraction_batch_size
+    emails or settings.extraction_batch_token_budget estimated prompt tokens
+    are reached. An email too large for the budget on its own gets its own batch.
+    Emails are trimmed once here, and batches hold them as prepare_batch_email
+    returns them, ready for get_coupon_info_from_batch.
+    """
+
+    def __init__(self, max_batch_size=None, token_budget=None):
+        self.max_batch_size = max_batch_size or settings.extraction_batch_size
+        self.token_budget = token_budget or settings.extraction_batch_token_budget
+        self.instruction_tokens = estimate_tokens(BATCH_EXTRACTION_SYSTEM_INSTRUCTION + BATCH_EXTRACTION_PROMPT_TEMPLATE)
+        self.batch = {}
+        self.batch_tokens = self.instruction_tokens
+
+    def add(self, message_id, email):
+        """Add an email; returns the batches it completed (closed to make room, or now full)"""
+        completed = []
+        email = prepare_batch_email(message_id, email)
+        email_tokens = estimate_tokens(render_batch_email(len(self.batch) + 1, email))
+        if self.batch and self.batch_tokens + email_tokens > self.token_budget:
+            completed.append(self.flush())
+        self.batch[message_id] = email
+        self.batch_tokens += email_tokens
+        if len(self.batch) >= self.max_batch_size:
+            completed.append(self.flush())
+        return completed
+
+    def flush(self):
+        """Close and return the batch being packed, or None if it is empty"""
+        batch = self.batch or None
+        self.batch = {}
+        self.batch_tokens = self.instruction_tokens
+        return batch
+
+
+def pack_extraction_batches(emails, max_batch_size=None, token_budget=None):
+    """
+    Split emails into batches that each fit in one extraction request (see ExtractionBatchPacker).
+
+    Args:
+        emails: Dict of message_id -> email info (email_text, email_subject, email_sender, email_timestamp)
+
+    Returns:
+        List of dicts of message_id -> email info (with prompt_text, see prepare_batch_email)
+    """
+    packer = ExtractionBatchPacker(max_batch_size, token_budget)
+    batches = []
+    for message_id, email in emails.items():
+        batches.extend(packer.add(message_id, email))
+    last_batch = packer.flush()
+    if last_batch:
+        batches.append(last_batch)
+    return batches
+
+
+def extract_batch(emails):
+    """
+    Send one batch of emails to Gemini in a single request. Emails are trimmed
+    here unless they come from a packed batch (see prepare_batch_email).
+
+    Returns:
+        Dict of message_id -> coupon info for every email the response covered
+        with a parseable object; emails missing from it are left out.
+    """
+    message_ids = list(emails)
+    email_keys = {str(index + 1): message_id for index, message_id in enumerate(message_ids)}
+
+    rendered_emails = []
+    for email_key, message_id in email_keys.items():
+        email = emails[message_id]
+        if "prompt_text" not in email:
+            email = prepare_batch_email(message_id, email)
+        rendered_emails.append(render_batch_email(email_key, email))
+    prompt = BATCH_EXTRACTION_PROMPT_TEMPLATE.format(emails="".join(rendered_emails))
+
+    model = get_extraction_model(batch=True)
+    response = gemini_limiter.call(
+        model.generate_content, prompt,
+        estimated_tokens=estimate_tokens(BATCH_EXTRACTION_SYSTEM_INSTRUCTION + prompt) + OUTPUT_TOKENS_PER_EMAIL * len(emails)
+    )
+
+    try:
+        items, repaired = parse_json_response(response.text)
+    except ValueError as e:
+        print(f"Failed to parse batch JSON response for {len(emails)} emails: {e}")
+        return {}
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        return {}
+    if repaired or is_truncated_response(response):
+        # Items before the last were complete in the response; the last one may
+        # have been cut off, so it is left to the per-email fallback
+        print("Truncated batch response, dropping its last item")
+        items = items[:-1]
+
+    results = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        message_id = email_keys.get(str(item.pop("email_key", "")).strip())
+        if message_id is None or message_id in results:
+            continue
+        try:
+            results[message_id] = validate_extraction(item)
+        except ValueError as e:
+            # Retried on its own by the caller
+            print(f"Invalid batch item for email {message_id}: {e}")
+    return results
+
+
+def get_coupon_info_from_batch(batch):
+    """
+    Extract coupon information for one packed batch (see ExtractionBatchPacker)
+    with at most one batch request.
+
+    Cached emails are answered from the extraction cache and the rest are sent
+    together. Emails the batch response doesn't cover or that fail to parse fall
+    back to get_coupon_info_from_email.
+
+    Returns:
+        Dict of message_id -> coupon info, in the same shape as get_coupon_info_from_email
+    """
+    results = {}
+    cache_keys = {}
+    uncached = {}
+    for message_id, email in batch.items():
+        cache_keys[message_id] = get_email_cache_key(email)
+        cached_info = extraction_cache.get_cached_extraction(cache_keys[message_id])
+        if cached_info is not None:
+            results[message_id] = cached_info
+        else:
+            uncached[message_id] = email
+
+    batch_results = {}
+    if len(uncached) > 1:
+        try:
+            batch_results = extract_batch(uncached)
+        except Exception as e:
+            print(f"Error processing email batch with Gemini: {e}")
+
+    for message_id, email in uncached.items():
+        coupon_info = batch_results.get(message_id)
+        if coupon_info is None:
+            # Single emails, failed batches and items the batch response missed
+            results[message_id] = get_coupon_info_from_email(
+                email["email_text"], email["email_subject"], email["email_sender"], email["email_timestamp"],
+                prompt_text=email.get("prompt_text")
+            )
+            continue
+        store_extraction(cache_keys[message_id], coupon_info, email["email_text"], email["email_subject"])
+        results[message_id] = coupon_info
+
+    if len(uncached) > 1:
+        print(f"Batch extraction: {len(batch_results)}/{len(uncached)} emails answered in one request")
+
+    return {message_id: results[message_id] for message_id in batch}
+
+
+def get_coupon_info_from_emails(emails):
+    """
+    Extract coupon information from several emails with as few Gemini requests as possible.
+
+    Emails are packed into batch prompts (see pack_extraction_batches), so the
+    shared instructions are sent once per batch instead of once per email, and
+    each batch goes through get_coupon_info_from_batch.
+
+    Args:
+        emails: Dict of message_id -> email info (email_text, email_subject, email_sender, email_timestamp)
+
+    Returns:
+        Dict of message_id -> coupon info, in the same shape as get_coupon_info_from_email
+    """
+    results = {}
+    for batch in pack_extraction_batches(emails):
+        results.update(get_coupon_info_from_batch(batch))
+    return {message_id: results[message_id] for message_id in emails}
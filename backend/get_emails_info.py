@@ -1,12 +1,20 @@
 import os
+import re
+import time
+import threading
+import random
+import itertools
 import requests
 import base64
 from bs4 import BeautifulSoup
 from PIL import Image
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-import google.generativeai as genai
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -15,12 +23,57 @@ from googleapiclient.errors import HttpError
 
 from dotenv import load_dotenv
 
+from core.config import settings
+from core.rate_limiter import gemini_limiter
+from core.gemini import get_model
+from offer_signals import has_offer_signals
+from email_trimming import estimate_tokens
+import ocr_cache
+
 # Load environment variables from .env file
 load_dotenv()
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Headers used when downloading email images
+IMAGE_REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+}
+
+# Images that can't hold offer text: open-tracking beacons and spacers (tracking hosts,
+# tracking paths, spacer file names), social icons and store badges (by file or folder name).
+# Anchored to hosts, path segments and file names so product images merely mentioning
+# "transparent" or "youtube" are still OCRed.
+SOCIAL_NAMES = r"(?:facebook|fb|twitter|x|instagram|ig|pinterest|youtube|yt|tiktok|linkedin|snapchat|threads|social)"
+NON_OFFER_IMAGE_PATTERN = re.compile(
+    r"^https?://(?:[^/?#]*\.)?(?:doubleclick\.net|google-analytics\.com|facebook\.com/tr)(?:[/?#]|$)"
+    r"|/(?:track(?:ing)?|beacon|pixel|open|wf/open)(?:[/?#]|\.(?:gif|png)|$)"
+    r"|/[ot]\.gif(?:[?#]|$)"
+    r"|/(?:spacer|blank|clear|transparent|pixel|1x1)(?:[_-]?\d+x\d+)?\.(?:gif|png)(?:[?#]|$)"
+    r"|/(?:social(?:[_-]?icons?)?|icons?)/"
+    rf"|/(?:icons?[_-])?{SOCIAL_NAMES}(?:[_-](?:icon|logo|circle|square|white|black|gr[ae]y|colou?r|\d+))*\.(?:png|gif|jpe?g)(?:[?#]|$)"
+    r"|/[^/?#]*(?:app[_-]?store|google[_-]?play)[^/?#]*\.(?:png|gif|jpe?g)(?:[?#]|$)",
+    re.IGNORECASE,
+)
+
+# Pooled HTTP session shared by all image downloads, sized for the OCR pool
+image_http_session = requests.Session()
+image_http_session.headers.update(IMAGE_REQUEST_HEADERS)
+_image_http_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=settings.ocr_global_concurrency)
+image_http_session.mount("http://", _image_http_adapter)
+image_http_session.mount("https://", _image_http_adapter)
+
+# Shared by every email, so its size is the global image download/OCR concurrency limit
+_ocr_executor = ThreadPoolExecutor(
+    max_workers=settings.ocr_global_concurrency,
+    thread_name_prefix="image-ocr"
+)
+
+# First-pass fetch: only the headers needed to decide whether a message is worth a full fetch
+METADATA_HEADERS = ["From", "Subject", "Date"]
+METADATA_FIELDS = "id,threadId,labelIds,internalDate,payload/headers"
+
 def get_email_text_and_html(message):
     """Returns plain text and HTML from a Gmail message.
     If HTML is missing, returns empty string for HTML.
@@ -98,6 +151,55 @@ def get_img_links_from_html(html):
     img_tags = soup.find_all("img")
     return [img.get("src") for img in img_tags if img.get("src")]
 
+def get_img_dimension(img, attribute):
+    """Returns an <img> width/height in px from its attribute or inline style, or None."""
+    value = img.get(attribute)
+    if value is None:
+        style_match = re.search(rf"(?:^|;)\s*{attribute}\s*:\s*(\d+)px", img.get("style", ""), re.IGNORECASE)
+        value = style_match.group(1) if style_match else None
+    if value is None:
+        return None
+    value_match = re.fullmatch(r"\s*(\d+)(?:px)?\s*", str(value))
+    return int(value_match.group(1)) if value_match else None
+
+def is_too_small_for_ocr(width, height):
+    """Whether a width x height image is too small to hold offer text (area under settings.ocr_min_image_dimension squared)"""
+    return width * height < settings.ocr_min_image_dimension ** 2
+
+def get_ocr_image_links_from_html(html):
+    """Returns (img_links, skipped_count): the image links worth OCRing.
+
+    Drops duplicates, inline/SVG images, tracking pixels, spacers and social icons
+    by URL pattern, and images whose width/height attributes make them too small.
+    Images without both attributes are size-checked after download instead
+    (see download_image_for_ocr).
+    """
+    soup = BeautifulSoup(html, "html.parser")
+
+    img_links = []
+    skipped = 0
+    for img in soup.find_all("img"):
+        src = (img.get("src") or "").strip()
+        if not src:
+            continue
+        if (
+            src in img_links
+            or not src.lower().startswith(("http://", "https://"))
+            or urlsplit(src).path.lower().endswith(".svg")
+            or NON_OFFER_IMAGE_PATTERN.search(src)
+        ):
+            skipped += 1
+            continue
+
+        width = get_img_dimension(img, "width")
+        height = get_img_dimension(img, "height")
+        if width is not None and height is not None and is_too_small_for_ocr(width, height):
+            skipped += 1
+            continue
+
+        img_links.append(src)
+    return img_links, skipped
+
 def preprocess_plain_text(plain_text):
     """Preprocesses plain text."""
     import re
@@ -134,59 +236,284 @@ def run_authorization_server():
             token.write(creds.to_json())
     return creds
 
-def gemini_image_ocr(image_url):
+OCR_PROMPT = "Extract all text from this image. Return only the text content as a string, nothing else. If there is no readable text, return an empty string."
+
+MULTI_IMAGE_OCR_PROMPT = """You are given {count} images, numbered 1 to {count} in the order they appear.
+Extract all text from each image. Respond with exactly {count} sections, in order, each starting with its own header line:
+### IMAGE <number>
+followed by only the text content of that image. If an image has no readable text, leave its section empty. Return nothing else."""
+
+MULTI_IMAGE_SECTION_PATTERN = re.compile(r"^\s*#+\s*IMAGE\s+(\d+)\s*$", re.IGNORECASE | re.MULTILINE)
+
+OCR_MODEL = 'gemini-1.5-flash'
+
+# Input tokens per image plus a typical amount of transcribed text, for the tokens-per-minute budget
+OCR_TOKENS_PER_IMAGE = 258 + 150
+
+def prepare_image_for_ocr(image_bytes):
     """
-    Extract text from an image URL using Google Gemini OCR.
+    Downscale and re-encode image bytes for a Gemini vision call.
+
+    Only the first frame of animated images is used. The longest side is capped
+    at settings.ocr_max_image_dimension, the image is optionally converted to
+    grayscale, and it is encoded as JPEG/WebP, lowering quality (then size)
+    until it fits settings.ocr_image_byte_budget.
+
+    Returns:
+        {"mime_type": ..., "data": bytes} blob accepted by generate_content
     """
-    # Configure Gemini API
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    
+    max_dimension = settings.ocr_max_image_dimension
+    image_format = settings.ocr_image_format.upper()
+
+    with Image.open(BytesIO(image_bytes)) as source:
+        # Animated GIF/WebP: keep only the first frame
+        if getattr(source, "is_animated", False):
+            source.seek(0)
+        # JPEG can decode straight to a smaller size, which avoids the full-size bitmap
+        source.draft("L" if settings.ocr_grayscale else "RGB", (max_dimension, max_dimension))
+        image = source.convert("L" if settings.ocr_grayscale else "RGB")
+
+    image.thumbnail((max_dimension, max_dimension))
+
+    while True:
+        for quality in (85, 70, 55, 40):
+            encoded = BytesIO()
+            image.save(encoded, format=image_format, quality=quality)
+            if encoded.tell() <= settings.ocr_image_byte_budget:
+                break
+        if encoded.tell() <= settings.ocr_image_byte_budget or max(image.size) <= 256:
+            break
+        # Still too big at the lowest quality: shrink and try again
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)))
+
+    return {"mime_type": f"image/{image_format.lower()}", "data": encoded.getvalue()}
+
+def download_image_for_ocr(image_url, timeout=None):
+    """
+    Download an image and get it ready for OCR, unless its result is already known.
+
+    Returns a dict with "text" set when the result came from the cache or the URL
+    is not a usable image (negative results are cached; "skipped" is set too when
+    the downloaded image is too small to be worth OCR), otherwise "image" (an
+    encoded image blob from prepare_image_for_ocr), "cache_keys" and "validators"
+    for storing the OCR result, and "deadline" (time.monotonic) by which its OCR
+    must be done.
+    """
+    deadline = time.monotonic() + (timeout or settings.ocr_image_timeout_seconds)
+    url_key = ocr_cache.url_cache_key(image_url)
+    cached = ocr_cache.get_cached_url_ocr(url_key)
+    if cached is not None and cached["fresh"]:
+        return {"text": cached["text"]}
+
+    # Download the image (the shared session sends headers to mimic a browser request),
+    # conditionally if an older result can be revalidated
     try:
-        # Add headers to mimic a browser request
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        }
-
-        # Download the image
-        response = requests.get(image_url, headers=headers, timeout=10)
+        response = image_http_session.get(
+            image_url, headers=ocr_cache.revalidation_headers(cached),
+            timeout=max(0.1, min(10, deadline - time.monotonic()))
+        )
         response.raise_for_status()  # Will throw an error for 4xx/5xx responses
+    except requests.exceptions.RequestException:
+        ocr_cache.store_ocr_result([url_key], ocr_cache.STATUS_DOWNLOAD_FAILED)
+        return {"text": ""}
+
+    validators = ocr_cache.response_validators(response)
+    if response.status_code == 304 and cached is not None:
+        # Image unchanged since it was OCRed
+        ocr_cache.store_ocr_result([url_key], cached["status"], cached["text"], validators=cached["validators"])
+        return {"text": cached["text"]}
+
+    # Check if the response is actually an image
+    content_type = response.headers.get('Content-Type', '')
+    if 'image' not in content_type:
+        ocr_cache.store_ocr_result([url_key], ocr_cache.STATUS_NOT_IMAGE)
+        return {"text": ""}
+
+    # The same image is often served from different URLs
+    content_key = ocr_cache.content_cache_key(response.content)
+    cached = ocr_cache.get_cached_ocr(content_key)
+    if cached is not None:
+        ocr_cache.store_ocr_result([url_key], *cached, validators=validators)
+        return {"text": cached[1]}
+
+    # Shrink and re-encode the image before it is held in memory and uploaded
+    try:
+        if settings.ocr_probe_image_size:
+            # PIL opens lazily, so the size comes from the header of the bytes already downloaded
+            with Image.open(BytesIO(response.content)) as source:
+                if is_too_small_for_ocr(*source.size):
+                    store_image_ocr_text([url_key, content_key], "", validators)
+                    return {"text": "", "skipped": True}
+        image = prepare_image_for_ocr(response.content)
+    except Exception:
+        ocr_cache.store_ocr_result([url_key, content_key], ocr_cache.STATUS_NOT_IMAGE, validators=validators)
+        return {"text": ""}
+
+    return {
+        "text": None, "image": image, "cache_keys": [url_key, content_key], "validators": validators, "deadline": deadline
+    }
+
+def store_image_ocr_text(cache_keys, text, validators=None):
+    """Cache the OCR text (or "no text") for a downloaded image."""
+    status = ocr_cache.STATUS_OK if text else ocr_cache.STATUS_NO_TEXT
+    ocr_cache.store_ocr_result(cache_keys, status, text, validators=validators)
+
+def gemini_ocr_images(images, deadline=None):
+    """
+    OCR one or more images (PIL images or blobs from prepare_image_for_ocr) in a single Gemini vision call.
+    The call, including rate limit waits and retries, ends by deadline (a time.monotonic() value).
 
-        # Check if the response is actually an image
-        content_type = response.headers.get('Content-Type', '')
-        if 'image' not in content_type:
-            raise ValueError(f"URL did not return an image. Content-Type: {content_type}")
-
-        # Open the image with PIL
-        image = Image.open(BytesIO(response.content))
-        
-        # Convert to RGB if necessary (some formats might cause issues)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-
-        # Get the Gemini model
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # Perform OCR using Gemini
-        prompt = "Extract all text from this image. Return only the text content as a string, nothing else. If there is no readable text, return an empty string."
-        
-        response = model.generate_content([prompt, image])
-        
-        return ' '.join(response.text.split()).strip() if response.text else ""
-    except requests.exceptions.RequestException as e:
-        return ""
-    except Exception as e:
-        return ""
+    Returns:
+        List of text segments, one per image in order, or None if the
+        response could not be split back into one section per image.
+    """
+    # Shared model, configured once per process
+    model = get_model(OCR_MODEL, "ocr")
+    request_options = {"timeout": settings.ocr_image_timeout_seconds}
+
+    # Charged against the tokens-per-minute budget before the call
+    estimated_tokens = OCR_TOKENS_PER_IMAGE * len(images) + estimate_tokens(MULTI_IMAGE_OCR_PROMPT)
+
+    if len(images) == 1:
+        response = gemini_limiter.call(
+            model.generate_content, [OCR_PROMPT, images[0]],
+            request_options=request_options, estimated_tokens=estimated_tokens, deadline=deadline
+        )
+        return [' '.join(response.text.split()).strip() if response.text else ""]
+
+    # Label every image so each section can be matched back to it
+    parts = [MULTI_IMAGE_OCR_PROMPT.format(count=len(images))]
+    for number, image in enumerate(images, start=1):
+        parts.extend([f"IMAGE {number}:", image])
+    response = gemini_limiter.call(
+        model.generate_content, parts, request_options=request_options, estimated_tokens=estimated_tokens,
+        deadline=deadline
+    )
+
+    sections = MULTI_IMAGE_SECTION_PATTERN.split(response.text or "")
+    # split() gives [preamble, number, text, number, text, ...]
+    texts = {}
+    for number, text in zip(sections[1::2], sections[2::2]):
+        texts[int(number)] = ' '.join(text.split()).strip()
+    if sorted(texts) != list(range(1, len(images) + 1)):
+        return None
+    return [texts[number] for number in range(1, len(images) + 1)]
+
+def ocr_downloaded_images(downloads):
+    """
+    OCR downloaded images (from download_image_for_ocr) in one Gemini call,
+    falling back to one call per image if the combined answer can't be split.
+    Each call must end by the earliest deadline of its images. Results are
+    cached. Returns the text for each image in order.
+    """
+    def earliest_deadline(chunk):
+        return min(download["deadline"] for download in chunk)
+
+    deadline = earliest_deadline(downloads)
+    if deadline <= time.monotonic():
+        # Out of time before the call: not cached, so a later refresh tries again
+        return [""] * len(downloads)
+    try:
+        texts = gemini_ocr_images([download["image"] for download in downloads], deadline=deadline)
+    except Exception:
+        # Gemini errors may be transient, so they are not cached
+        return [""] * len(downloads)
+
+    if texts is None:
+        texts = []
+        for download in downloads:
+            deadline = download["deadline"]
+            try:
+                texts.append(gemini_ocr_images([download["image"]], deadline=deadline)[0] if deadline > time.monotonic() else None)
+            except Exception:
+                texts.append(None)
+
+    for download, text in zip(downloads, texts):
+        if text is not None:
+            store_image_ocr_text(download["cache_keys"], text, download.get("validators"))
+    return [text or "" for text in texts]
+
+def gemini_image_ocr(image_url, timeout=None):
+    """
+    Extract text from an image URL using Google Gemini OCR.
+    Results, including negative ones, are cached by normalized URL and by image content hash.
+    """
+    download = download_image_for_ocr(image_url, timeout=timeout)
+    if download["text"] is not None:
+        return download["text"]
+    return ocr_downloaded_images([download])[0]
+
+def submit_bounded(slots, func, *args):
+    """Submit work to the shared OCR pool once one of the caller's slots is free"""
+    slots.acquire()
+    try:
+        future = _ocr_executor.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
 
 def get_text_from_images(img_links):
-    """Use OCR to extract text from image links."""
+    """Use OCR to extract text from image links.
+
+    Images are downloaded concurrently and the ones not already cached are
+    grouped as they arrive into Gemini calls of up to settings.ocr_images_per_request
+    images and settings.ocr_request_byte_budget bytes. Downloads are only started
+    a few at a time, so an email's images are never all held in memory at once.
+    Text is joined in the original image order.
+
+    Returns:
+        (text, images_skipped): images_skipped counts downloaded images too small to OCR
+    """
+    # Per-email limit; the shared executor's size is the global limit
+    slots = threading.BoundedSemaphore(settings.ocr_per_email_concurrency)
+    images_per_request = max(1, settings.ocr_images_per_request)
+
+    texts = [""] * len(img_links)
+    images_skipped = 0
+    ocr_futures = []
+    chunk, chunk_bytes = [], 0
+
+    def submit_chunk():
+        indexes = [index for index, _ in chunk]
+        future = submit_bounded(slots, ocr_downloaded_images, [download for _, download in chunk])
+        ocr_futures.append((indexes, future))
+
+    pending = deque()
+    next_index = 0
+    while next_index < len(img_links) or pending:
+        while next_index < len(img_links) and len(pending) < settings.ocr_per_email_concurrency:
+            pending.append((next_index, submit_bounded(slots, download_image_for_ocr, img_links[next_index])))
+            next_index += 1
+
+        index, future = pending.popleft()
+        download = future.result()
+        if download["text"] is not None:
+            texts[index] = download["text"]
+            images_skipped += int(download.get("skipped", False))
+            continue
+
+        image_bytes = len(download["image"]["data"])
+        if chunk and (len(chunk) >= images_per_request or chunk_bytes + image_bytes > settings.ocr_request_byte_budget):
+            submit_chunk()
+            chunk, chunk_bytes = [], 0
+        chunk.append((index, download))
+        chunk_bytes += image_bytes
+    if chunk:
+        submit_chunk()
+
+    for indexes, future in ocr_futures:
+        for index, img_text in zip(indexes, future.result()):
+            texts[index] = img_text
+
     text = ""
-    for img_link in img_links:
-        img_text = gemini_image_ocr(img_link)
+    for img_text in texts:
         img_text = img_text.replace('"', '')
         img_text = img_text.replace('`', '')
         if img_text:
             text += " " + img_text
-    return text.strip()
+    return text.strip(), images_skipped
 
 def get_email_sender(service, message_id):
     """Fetch the email sender from the Gmail API."""
@@ -221,49 +548,427 @@ def get_email_timestamp(message):
         return datetime.fromtimestamp(int(timestamp_ms) / 1000)
     return ""
 
-def get_emails_info_for_user(gmail_service):
-    """Reads emails using a provided Gmail service (user-specific credentials)."""
-    try:
-        # Call the Gmail API using the provided service
-        results = (
-            gmail_service.users().messages().list(userId="me", labelIds=["CATEGORY_PROMOTIONS"]).execute()
-        )
-        messages = results.get("messages", [])
-        emails_info = {}
+def is_retryable_gmail_error(error):
+    """Rate limit and server errors, which usually go away when the request is repeated a bit later"""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or status >= 500 or (status == 403 and "ratelimitexceeded" in str(error).lower())
+
+def fetch_messages_batch(gmail_service, message_ids, batch_size=None, **get_kwargs):
+    """Fetch many Gmail messages using the HTTP batch endpoint.
+
+    Messages are requested in chunks of up to `batch_size` (default
+    settings.gmail_batch_size, max 100) per HTTP request. A failure for one
+    message is recorded instead of failing the whole fetch; messages that got
+    a rate limit or server error are retried with exponential backoff (up to
+    settings.gmail_max_retries times) first.
+
+    Returns:
+        (messages, errors): dicts keyed by message ID holding the message
+        object or the exception raised for that message.
+    """
+    batch_size = min(batch_size or settings.gmail_batch_size, 100)
+    message_ids = list(dict.fromkeys(message_ids))  # Batch request IDs must be unique
+    messages = {}
+    errors = {}
+
+    def handle_response(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            messages[request_id] = response
+
+    pending_ids = message_ids
+    for attempt in range(settings.gmail_max_retries + 1):
+        for start in range(0, len(pending_ids), batch_size):
+            chunk = pending_ids[start:start + batch_size]
+            batch = gmail_service.new_batch_http_request(callback=handle_response)
+            for message_id in chunk:
+                batch.add(
+                    gmail_service.users().messages().get(userId="me", id=message_id, **get_kwargs),
+                    request_id=message_id,
+                )
+            try:
+                batch.execute()
+            except Exception as error:
+                # The whole HTTP request failed, so every message in the chunk is missing
+                for message_id in chunk:
+                    if message_id not in messages:
+                        errors.setdefault(message_id, error)
+
+        pending_ids = [message_id for message_id in pending_ids if is_retryable_gmail_error(errors.get(message_id))]
+        if not pending_ids or attempt == settings.gmail_max_retries:
+            break
+        # Exponential backoff with jitter, as the Gmail API asks for on rate limits
+        delay = settings.gmail_backoff_base_seconds * 2 ** attempt
+        delay = random.uniform(delay / 2, delay)
+        print(f"Retrying {len(pending_ids)} messages after rate limit or server errors in {delay:.1f}s")
+        time.sleep(delay)
+        for message_id in pending_ids:
+            del errors[message_id]
+
+    if errors:
+        print(f"Failed to fetch {len(errors)} of {len(message_ids)} messages")
+
+    # Keep the caller's message order
+    ordered_messages = {message_id: messages[message_id] for message_id in message_ids if message_id in messages}
+    return ordered_messages, errors
+
+def should_ocr_email(plain_text, email_subject=""):
+    """Decides whether an email's images need OCR, according to settings.ocr_policy.
+
+    The adaptive policy skips OCR when the plain text is substantial and already
+    carries offer signals (percentages, currency amounts, codes plus offer keywords).
+    """
+    policy = settings.ocr_policy.lower()
+    if policy == "never":
+        return False
+    if policy != "adaptive":
+        return True
+
+    if len(plain_text) < settings.ocr_min_text_chars:
+        return True
+    return not has_offer_signals(f"{email_subject}\n{plain_text}", settings.ocr_min_offer_signals)
+
+def get_email_info_from_message(message_object):
+    """Builds the email info dict (text, sender, subject, timestamp) for one Gmail message."""
+    # Get both plain text and html
+    plain_text, html_text = get_email_text_and_html(message_object)
+
+    # remove extra spaces and newlines from outside and within the text
+    plain_text = preprocess_plain_text(plain_text)
+
+    # sender, email_subject, timestamp
+    email_sender = get_email_sender(message_object)
+    email_subject = get_email_subject(message_object)
+    email_timestamp = get_email_timestamp(message_object)
+
+    img_text = ""
+    images_skipped = 0
+    ocr_skipped = not should_ocr_email(plain_text, email_subject)
+    if not ocr_skipped:
+        # Extract img src links worth OCRing
+        img_links, images_skipped = get_ocr_image_links_from_html(html_text)
+
+        # Get text from images using OCR
+        if img_links:
+            img_text, small_images_skipped = get_text_from_images(img_links)
+            images_skipped += small_images_skipped
+            # Append the image text to the plain text
+            plain_text += "\n" + img_text
+        if images_skipped:
+            print(f"Skipped {images_skipped} OCR calls for tracking/decorative images")
+
+    all_text = "Plain Text: " + plain_text.strip() + "\n Image Text:" + img_text.strip()
+    return {
+        "email_text": all_text,
+        "email_sender": email_sender,
+        "email_subject": email_subject,
+        "email_timestamp": email_timestamp,
+        "ocr_images_skipped": images_skipped,
+        "ocr_skipped": ocr_skipped,
+    }
+
+def iter_promotional_message_ids(gmail_service, query=None, page_size=None, max_messages=None):
+    """Lazily yields promotional message IDs, following nextPageToken across pages.
+
+    Args:
+        query: Gmail search query such as "newer_than:30d" (default settings.gmail_query)
+        page_size: maxResults per list page (default settings.gmail_page_size)
+        max_messages: total number of IDs to yield (default settings.gmail_max_messages, 0 = no cap)
+    """
+    query = query if query is not None else settings.gmail_query
+    page_size = min(page_size or settings.gmail_page_size, 500)
+    max_messages = max_messages if max_messages is not None else settings.gmail_max_messages
+
+    yielded = 0
+    page_token = None
+    while True:
+        list_kwargs = {"userId": "me", "labelIds": ["CATEGORY_PROMOTIONS"], "maxResults": page_size}
+        if max_messages:
+            # Don't ask for more than we still need
+            list_kwargs["maxResults"] = min(page_size, max_messages - yielded)
+        if query:
+            list_kwargs["q"] = query
+        if page_token:
+            list_kwargs["pageToken"] = page_token
+
+        results = gmail_service.users().messages().list(**list_kwargs).execute()
+        for message in results.get("messages", []):
+            yield message["id"]
+            yielded += 1
+            if max_messages and yielded >= max_messages:
+                return
+
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
+
+def get_campaign_key(email_sender, email_subject):
+    """Normalized "sender address|subject" string identifying one marketing campaign."""
+    import re
 
-        for message in messages[:50]:
-            message_id = message["id"]
+    sender_match = re.search(r'<(.+?)>', email_sender or "")
+    sender_address = sender_match.group(1) if sender_match else (email_sender or "")
+    return f"{sender_address.strip().lower()}|{' '.join((email_subject or '').split()).lower()}"
 
-            message_object = gmail_service.users().messages().get(userId="me", id=message_id).execute()
+def is_known_campaign(campaign_key, email_timestamp, known_campaigns):
+    """Whether an email re-sends an already processed campaign.
 
-            # Get both plain text and html
-            plain_text, html_text = get_email_text_and_html(message_object)
+    Only emails with the same sender and subject within settings.campaign_dedup_window_hours
+    count, so recurring mail ("Your weekly deals") is still read every time.
+    """
+    processed_timestamps = known_campaigns.get(campaign_key)
+    if not processed_timestamps or not isinstance(email_timestamp, datetime):
+        return False
+    window = timedelta(hours=settings.campaign_dedup_window_hours)
+    return any(
+        isinstance(processed_timestamp, datetime) and abs(email_timestamp - processed_timestamp) <= window
+        for processed_timestamp in processed_timestamps
+    )
+
+def filter_candidate_messages(metadata_messages, known_message_ids=None, known_campaigns=None):
+    """Returns the IDs of metadata-only messages that still need a full fetch.
+
+    Messages whose ID was already processed are dropped, as are re-sends of a
+    processed campaign (see is_known_campaign).
+
+    Args:
+        known_campaigns: Dict of get_campaign_key -> dates of the processed emails with that key
+    """
+    known_message_ids = known_message_ids or set()
+    known_campaigns = known_campaigns or {}
+
+    candidate_ids = []
+    for message_id, message in metadata_messages.items():
+        if message_id in known_message_ids:
+            continue
+        campaign_key = get_campaign_key(get_email_sender(message), get_email_subject(message))
+        if is_known_campaign(campaign_key, get_email_timestamp(message), known_campaigns):
+            continue
+        candidate_ids.append(message_id)
+    return candidate_ids
+
+def iter_emails_info_for_message_ids(gmail_service, message_ids, processed=None, failed_messages=None):
+    """Yields (message_id, email_info) pairs for an iterable of message IDs, one batch at a time.
+
+    When a processed lookup is given, messages are fetched in two phases:
+    already-processed message IDs are dropped straight away, then a cheap
+    format=metadata pass drops re-sends of campaigns that were already processed.
+    Only the survivors are fetched with format=full. The lookup is queried for
+    each batch's IDs and campaigns only, through
+    processed.known_message_ids(message_ids) -> set of IDs and
+    processed.known_campaigns(campaign_keys) -> dict of campaign key -> dates.
+
+    Messages that could not be fetched or parsed are added to the failed_messages
+    dict (message ID -> error) when one is given, so the caller can retry them.
+    Messages deleted since they were listed (404) are skipped for good.
+    """
+    chunk = []
+    ocr_stats = {"emails": 0, "ocr_skipped": 0}
+
+    def process_chunk(message_ids):
+        known_message_ids = processed.known_message_ids(message_ids) if processed else set()
+        candidate_ids = [message_id for message_id in message_ids if message_id not in known_message_ids]
+
+        if candidate_ids and processed:
+            metadata_messages, metadata_errors = fetch_messages_batch(
+                gmail_service,
+                candidate_ids,
+                format="metadata",
+                metadataHeaders=METADATA_HEADERS,
+                fields=METADATA_FIELDS,
+            )
+            known_campaigns = processed.known_campaigns({
+                get_campaign_key(get_email_sender(message), get_email_subject(message))
+                for message in metadata_messages.values()
+            })
+            surviving_ids = set(filter_candidate_messages(metadata_messages, known_message_ids, known_campaigns))
+            # Messages whose metadata could not be read still get a full fetch
+            candidate_ids = [
+                message_id for message_id in candidate_ids
+                if message_id in surviving_ids or message_id in metadata_errors
+            ]
+
+        if len(candidate_ids) < len(message_ids):
+            print(f"Skipping {len(message_ids) - len(candidate_ids)} already processed messages")
+        if not candidate_ids:
+            return
+
+        # Fetch all remaining messages in as few HTTP requests as possible
+        message_objects, fetch_errors = fetch_messages_batch(gmail_service, candidate_ids, format="full")
+        for message_id, error in fetch_errors.items():
+            print(f"Skipping message {message_id}: {error}")
+            if failed_messages is not None and not (isinstance(error, HttpError) and error.resp.status == 404):
+                failed_messages[message_id] = error
+
+        for message_id, message_object in message_objects.items():
+            try:
+                email_info = get_email_info_from_message(message_object)
+            except Exception as error:
+                print(f"Error processing message {message_id}: {error}")
+                if failed_messages is not None:
+                    failed_messages[message_id] = error
+                continue
+            ocr_stats["emails"] += 1
+            ocr_stats["ocr_skipped"] += int(email_info["ocr_skipped"])
+            yield message_id, email_info
+
+    for message_id in message_ids:
+        chunk.append(message_id)
+        if len(chunk) >= settings.gmail_batch_size:
+            yield from process_chunk(chunk)
+            chunk = []
+
+    if chunk:
+        yield from process_chunk(chunk)
+
+    if ocr_stats["emails"]:
+        print(f"OCR skipped for {ocr_stats['ocr_skipped']} of {ocr_stats['emails']} emails (offer found in text, policy={settings.ocr_policy})")
+
+def iter_emails_info_for_user(gmail_service, query=None, max_messages=None, page_size=None, processed=None):
+    """Yields (message_id, email_info) pairs as each batch of messages is fetched.
+
+    Message IDs are pulled lazily page by page, so the first batch is fetched and
+    processed before later list pages are requested.
+    """
+    message_ids = iter_promotional_message_ids(gmail_service, query=query, page_size=page_size, max_messages=max_messages)
+    yield from iter_emails_info_for_message_ids(gmail_service, message_ids, processed)
 
-            # remove extra spaces and newlines from outside and within the text
-            plain_text = preprocess_plain_text(plain_text)
+def get_emails_info_for_user(gmail_service, query=None, max_messages=None, page_size=None, processed=None):
+    """Reads emails using a provided Gmail service (user-specific credentials).
 
-            # Extract img src links
-            img_links = get_img_links_from_html(html_text)
+    Emails the processed lookup knows, or re-sends of a campaign it knows (see
+    iter_emails_info_for_message_ids), are skipped without a full fetch.
+    """
+    emails_info = {}
+    try:
+        for message_id, email_info in iter_emails_info_for_user(
+            gmail_service,
+            query=query,
+            max_messages=max_messages,
+            page_size=page_size,
+            processed=processed,
+        ):
+            emails_info[message_id] = email_info
+        return emails_info
 
-            img_text = ""
-            # Get text from images using OCR
-            if img_links:
-                img_text = get_text_from_images(img_links)
-                # Append the image text to the plain text
-                plain_text += "\n" + img_text
+    except Exception as error:
+        print(f"An error occurred: {error}")
+        return emails_info
 
-            all_text = "Plain Text: " + plain_text.strip() + "\n Image Text:" + img_text.strip()
-            # sender, email_subject, timestamp
-            email_sender = get_email_sender(message_object)
-            email_subject = get_email_subject(message_object)
-            email_timestamp = get_email_timestamp(message_object)
-            emails_info[message_id] = {"email_text": all_text, "email_sender": email_sender, "email_subject": email_subject, "email_timestamp": email_timestamp}
+def get_mailbox_history_id(gmail_service):
+    """Returns the mailbox's current Gmail historyId."""
+    return gmail_service.users().getProfile(userId="me").execute().get("historyId")
 
-        return emails_info
+def list_history_message_ids(gmail_service, start_history_id, max_messages=None):
+    """Returns IDs of promotional messages added since start_history_id, newest first.
 
+    When more than max_messages were added, the oldest max_messages are returned
+    along with the history ID of the last one, so the next delta sync resumes
+    right after them instead of skipping the rest.
+
+    Returns:
+        (message_ids, resume_history_id): resume_history_id is None if every added
+        message was returned
+
+    Raises googleapiclient HttpError with status 404 when start_history_id is too
+    old for Gmail to answer (the caller should fall back to a full sync).
+    """
+    max_messages = max_messages if max_messages is not None else settings.gmail_max_messages
+
+    added = {}  # message ID -> history ID of the record that added it, oldest first
+    page_token = None
+    while True:
+        history_kwargs = {
+            "userId": "me",
+            "startHistoryId": start_history_id,
+            "labelId": "CATEGORY_PROMOTIONS",
+            "historyTypes": ["messageAdded"],
+        }
+        if page_token:
+            history_kwargs["pageToken"] = page_token
+
+        history_response = gmail_service.users().history().list(**history_kwargs).execute()
+        for record in history_response.get("history", []):
+            for message_added in record.get("messagesAdded", []):
+                message = message_added.get("message", {})
+                if "CATEGORY_PROMOTIONS" in message.get("labelIds", []) and message.get("id"):
+                    added.setdefault(message["id"], record["id"])
+
+        page_token = history_response.get("nextPageToken")
+        # One message past the cap is enough to know the list is truncated
+        if not page_token or (max_messages and len(added) > max_messages):
+            break
+
+    added = list(added.items())
+    resume_history_id = None
+    if max_messages and len(added) > max_messages:
+        added = added[:max_messages]
+        resume_history_id = added[-1][1]
+    # Newest first, like messages().list
+    return [message_id for message_id, _ in reversed(added)], resume_history_id
+
+def get_new_emails_info_for_user(gmail_service, start_history_id=None, processed=None, on_email=None,
+                                 retry_message_ids=None):
+    """Reads only the promotional emails added since start_history_id (delta sync).
+
+    Falls back to a full sync of the newest promotional emails when there is no
+    stored history ID or Gmail returns 404 for a stale one. Messages listed in
+    retry_message_ids (earlier failures) are read along with the new ones, and
+    already processed ones are skipped (see iter_emails_info_for_message_ids).
+    on_email(message_id, email_info) is called as each email is read, e.g. to report progress.
+
+    Returns:
+        (emails_info, history_id, failed_messages): history_id is the mailbox historyId
+        to store for the next delta sync, or None if the sync failed and should be
+        retried. failed_messages maps IDs of messages that could not be read to the
+        error, so they can be retried without holding the history ID back.
+    """
+    try:
+        # Read the current historyId before listing so mail arriving mid-sync is picked up next time
+        history_id = get_mailbox_history_id(gmail_service)
+    except Exception as error:
+        print(f"Could not read mailbox history ID: {error}")
+        history_id = None
+
+    message_ids = None
+    if start_history_id:
+        try:
+            message_ids, resume_history_id = list_history_message_ids(gmail_service, start_history_id)
+            print(f"Delta sync found {len(message_ids)} new promotional messages since history ID {start_history_id}")
+            if resume_history_id:
+                # More mail than one refresh reads: continue after the last message read
+                print(f"Delta sync capped at {len(message_ids)} messages, next sync resumes at history ID {resume_history_id}")
+                history_id = resume_history_id
+        except HttpError as error:
+            if error.resp.status != 404:
+                print(f"An error occurred: {error}")
+                return {}, None, {}
+            print(f"History ID {start_history_id} is no longer valid, falling back to full sync")
+
+    if message_ids is None:
+        message_ids = iter_promotional_message_ids(gmail_service)
+    if retry_message_ids:
+        print(f"Retrying {len(retry_message_ids)} messages that failed in earlier refreshes")
+        # dict.fromkeys drops retried messages that were listed again
+        message_ids = dict.fromkeys(itertools.chain(message_ids, retry_message_ids))
+
+    emails_info = {}
+    failed_messages = {}
+    try:
+        for message_id, email_info in iter_emails_info_for_message_ids(
+            gmail_service, message_ids, processed, failed_messages
+        ):
+            emails_info[message_id] = email_info
+            if on_email:
+                on_email(message_id, email_info)
     except Exception as error:
+        # Keep what was read, but don't advance the history ID past unread mail
         print(f"An error occurred: {error}")
-        return {}
+        return emails_info, None, failed_messages
+    return emails_info, history_id, failed_messages
 
 def get_emails_info():
     """Reads first email from Gmail and extracts text and from plain text and images."""
@@ -19,6 +19,8 @@ def create_tables():
         missing_columns = []
         if 'gmail_history_id' not in columns:
             missing_columns.append(('gmail_history_id', 'VARCHAR'))
+        if 'gmail_sync_history_id' not in columns:
+            missing_columns.append(('gmail_sync_history_id', 'VARCHAR'))
         if 'gmail_watch_expiration' not in columns:
             missing_columns.append(('gmail_watch_expiration', 'TIMESTAMP'))
         
@@ -33,6 +35,51 @@ def create_tables():
                     except Exception as e:
                         print(f"Could not add column {col_name}: {e}")
     
+    # Pre-classifier and campaign matching columns on processed emails
+    if 'user_processed_emails' in inspector.get_table_names():
+        columns = [col['name'] for col in inspector.get_columns('user_processed_emails')]
+        missing_columns = [
+            (col_name, col_type) for col_name, col_type in
+            [('llm_labeled', 'BOOLEAN DEFAULT TRUE'), ('classifier_score', 'FLOAT'), ('classifier_features', 'TEXT'),
+             ('email_timestamp', 'TIMESTAMP'), ('classifier_threshold', 'FLOAT'), ('campaign_key', 'VARCHAR')]
+            if col_name not in columns
+        ]
+        if missing_columns:
+            print(f"Adding missing columns: {[col[0] for col in missing_columns]}")
+            with engine.connect() as conn:
+                for col_name, col_type in missing_columns:
+                    try:
+                        conn.execute(text(f"ALTER TABLE user_processed_emails ADD COLUMN {col_name} {col_type}"))
+                        conn.commit()
+                        print(f"Added column: {col_name}")
+                    except Exception as e:
+                        print(f"Could not add column {col_name}: {e}")
+        if any(col_name == 'campaign_key' for col_name, _ in missing_columns):
+            with engine.connect() as conn:
+                try:
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_processed_emails_campaign_key ON user_processed_emails (campaign_key)"))
+                    conn.commit()
+                except Exception as e:
+                    print(f"Could not index campaign_key: {e}")
+    
+    # Image response validators on OCR cache entries
+    if 'ocr_cache' in inspector.get_table_names():
+        columns = [col['name'] for col in inspector.get_columns('ocr_cache')]
+        missing_columns = [
+            (col_name, col_type) for col_name, col_type in [('etag', 'VARCHAR'), ('last_modified', 'VARCHAR')]
+            if col_name not in columns
+        ]
+        if missing_columns:
+            print(f"Adding missing columns: {[col[0] for col in missing_columns]}")
+            with engine.connect() as conn:
+                for col_name, col_type in missing_columns:
+                    try:
+                        conn.execute(text(f"ALTER TABLE ocr_cache ADD COLUMN {col_name} {col_type}"))
+                        conn.commit()
+                        print(f"Added column: {col_name}")
+                    except Exception as e:
+                        print(f"Could not add column {col_name}: {e}")
+    
     print("Database tables initialized successfully!")
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+"""
+Event loop load test
+Runs several /api/coupons?refresh=true requests at once and measures how fast
+/api/health and cached /api/coupons reads answer while they are in flight.
+
+Usage (against a running API):
+    API_URL=http://localhost:8000 API_TOKENS=<jwt>,<jwt>,... python load_test.py [refreshes] [probe_seconds]
+
+Refreshes for the same user join that user's running refresh job instead of
+starting another, so each token in API_TOKENS should belong to a different
+user. Refreshes are spread over the tokens round robin; with fewer tokens than
+refreshes, only as many refreshes as there are users actually run at once.
+API_TOKEN (a single token) still works, for measuring one refresh.
+
+A token for local testing can be created with GET /api/debug/generate-token.
+"""
+import os
+import sys
+import time
+import statistics
+import threading
+import requests
+
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+API_TOKENS = [token.strip() for token in os.getenv("API_TOKENS", os.getenv("API_TOKEN", "")).split(",") if token.strip()]
+
+def timed_get(session, path, headers=None, timeout=600):
+    """GET a path and return (latency in seconds, status code)"""
+    start = time.perf_counter()
+    try:
+        response = session.get(f"{API_URL}{path}", headers=headers, timeout=timeout)
+        status = response.status_code
+    except requests.RequestException:
+        status = None
+    return time.perf_counter() - start, status
+
+def summarize(name, samples):
+    """Print latency percentiles for a list of (latency, status) samples"""
+    latencies = sorted(latency for latency, _ in samples)
+    failures = sum(1 for _, status in samples if status != 200)
+    if not latencies:
+        print(f"{name}: no samples")
+        return
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name}: {len(latencies)} requests, {failures} failed, "
+        f"p50 {statistics.median(latencies) * 1000:.0f} ms, "
+        f"p95 {p95 * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms"
+    )
+
+def run_load_test(refreshes=4, probe_seconds=30):
+    user_headers = [{"Authorization": f"Bearer {token}"} for token in API_TOKENS]
+    auth_headers = user_headers[0]
+    session = requests.Session()
+
+    # Warm the coupon cache so the probe measures cached reads
+    timed_get(session, "/api/coupons", headers=auth_headers)
+
+    print("🔍 Baseline (no refreshes running)...")
+    baseline_health = [timed_get(session, "/api/health") for _ in range(20)]
+    baseline_cached = [timed_get(session, "/api/coupons", headers=auth_headers) for _ in range(5)]
+    summarize("  /api/health", baseline_health)
+    summarize("  /api/coupons (cached)", baseline_cached)
+
+    users = min(refreshes, len(user_headers))
+    print(f"\n🔍 Starting {refreshes} concurrent refreshes for {users} users...")
+    if users < refreshes:
+        print(f"  ⚠️  Refreshes for the same user share one job: only {users} will run at once (pass more tokens in API_TOKENS)")
+    refresh_results = []
+
+    def run_refresh(headers):
+        refresh_results.append(timed_get(requests.Session(), "/api/coupons?refresh=true", headers=headers))
+
+    refresh_threads = [
+        threading.Thread(target=run_refresh, args=(user_headers[index % len(user_headers)],))
+        for index in range(refreshes)
+    ]
+    for thread in refresh_threads:
+        thread.start()
+
+    # Probe while the refreshes are in flight
+    health_samples = []
+    cached_samples = []
+    deadline = time.perf_counter() + probe_seconds
+    while time.perf_counter() < deadline and any(thread.is_alive() for thread in refresh_threads):
+        health_samples.append(timed_get(session, "/api/health", timeout=30))
+        cached_samples.append(timed_get(session, "/api/coupons", headers=auth_headers, timeout=30))
+        time.sleep(0.2)
+
+    print("\n🔍 During refreshes...")
+    summarize("  /api/health", health_samples)
+    summarize("  /api/coupons (cached)", cached_samples)
+
+    for thread in refresh_threads:
+        thread.join()
+    summarize("  /api/coupons?refresh=true", refresh_results)
+
+if __name__ == "__main__":
+    if not API_TOKENS:
+        print("❌ Set API_TOKENS to comma-separated JWTs of different users (see /api/debug/generate-token)")
+        sys.exit(1)
+
+    refreshes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    probe_seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    run_load_test(refreshes, probe_seconds)
@@ -0,0 +1,116 @@
+"""
+Company logo cache.
+The same senders show up in every inbox and every refresh, so the logo URL
+found for a domain (or the fact that no source had one) is stored in the
+database, with an in-memory LRU in front of it in each process.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from core.config import settings
+from core.db_cache import upsert_entry, prune_entries, PruneSchedule
+from database.connection import SessionLocal
+from auth.models import CompanyLogoEntry
+
+logger = logging.getLogger(__name__)
+
+# Cached result for domains where no logo source worked
+NO_LOGO = ""
+
+_memory = OrderedDict()  # domain -> (logo_url or NO_LOGO, expires_at)
+_memory_lock = threading.Lock()
+
+
+def _expires_at(logo_url, created_at):
+    if logo_url:
+        return created_at + timedelta(days=settings.logo_cache_ttl_days)
+    return created_at + timedelta(hours=settings.logo_cache_negative_ttl_hours)
+
+
+def _remember(domain, logo_url, expires_at):
+    with _memory_lock:
+        _memory[domain] = (logo_url, expires_at)
+        _memory.move_to_end(domain)
+        while len(_memory) > settings.logo_cache_memory_entries:
+            _memory.popitem(last=False)
+
+
+def get_cached_logo(domain):
+    """
+    Look up the logo found for a domain.
+
+    Returns:
+        The logo URL, NO_LOGO if no source had one, or None on a miss or expired entry
+    """
+    if not settings.logo_cache_enabled:
+        return None
+
+    now = datetime.utcnow()
+    with _memory_lock:
+        cached = _memory.get(domain)
+        if cached is not None:
+            if cached[1] > now:
+                _memory.move_to_end(domain)
+                return cached[0]
+            del _memory[domain]
+
+    db = SessionLocal()
+    try:
+        entry = db.query(CompanyLogoEntry).filter(CompanyLogoEntry.domain == domain).first()
+        if not entry or entry.created_at is None:
+            return None
+        logo_url = entry.logo_url or NO_LOGO
+        expires_at = _expires_at(logo_url, entry.created_at)
+        if expires_at < now:
+            return None
+
+        entry.last_used_at = now
+        db.commit()
+        _remember(domain, logo_url, expires_at)
+        return logo_url
+    except Exception as e:
+        logger.warning(f"Logo cache lookup failed: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def store_logo(domain, logo_url):
+    """Store the logo URL found for a domain (None or NO_LOGO if no source had one)"""
+    if not settings.logo_cache_enabled:
+        return
+
+    now = datetime.utcnow()
+    logo_url = logo_url or NO_LOGO
+    _remember(domain, logo_url, _expires_at(logo_url, now))
+
+    db = SessionLocal()
+    try:
+        upsert_entry(
+            db, CompanyLogoEntry, CompanyLogoEntry.domain, domain,
+            logo_url=logo_url or None, created_at=now, last_used_at=now
+        )
+    except Exception as e:
+        logger.warning(f"Logo cache write failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    _prune_schedule.record_write()
+
+
+def prune_logo_cache():
+    """Delete expired entries, then the least recently used ones beyond logo_cache_max_entries"""
+    now = datetime.utcnow()
+    negative_cutoff = now - timedelta(hours=settings.logo_cache_negative_ttl_hours)
+    positive_cutoff = now - timedelta(days=settings.logo_cache_ttl_days)
+    expired = (CompanyLogoEntry.created_at < positive_cutoff) | (
+        (CompanyLogoEntry.created_at < negative_cutoff) & CompanyLogoEntry.logo_url.is_(None)
+    )
+    prune_entries(SessionLocal, CompanyLogoEntry, expired, settings.logo_cache_max_entries, "logo")
+
+
+_prune_schedule = PruneSchedule(lambda: prune_logo_cache())
@@ -0,0 +1,185 @@
+"""
+Persistent OCR result cache.
+Marketing emails reuse the same banners, logos and footer images across
+campaigns and users, so OCR text is stored in the database keyed both by the
+normalized image URL and by a hash of the image bytes. Negative results
+(no text, not an image, download failed) are cached too.
+
+The image behind a URL can change, so URL entries are only trusted for
+settings.ocr_cache_url_ttl_hours; after that they are revalidated with the
+image's ETag/Last-Modified, or the image is downloaded again and looked up
+by content hash.
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from core.config import settings
+from core.db_cache import upsert_entry, prune_entries, PruneSchedule
+from database.connection import SessionLocal
+from auth.models import OcrCacheEntry
+
+logger = logging.getLogger(__name__)
+
+STATUS_OK = "ok"
+STATUS_NO_TEXT = "no_text"
+STATUS_NOT_IMAGE = "not_image"
+STATUS_DOWNLOAD_FAILED = "download_failed"
+
+# Statuses that describe the image itself rather than a (possibly transient) fetch problem
+LONG_LIVED_STATUSES = {STATUS_OK, STATUS_NO_TEXT}
+
+# Query parameters that are the same for every recipient of a send and never change the image.
+# Recipient IDs (uid, email, subscriber_id, mc_eid, ...) can select a personalized image, so they stay in the key.
+TRACKING_PARAM_PREFIXES = ("utm_",)
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid"}
+
+
+def normalize_image_url(image_url):
+    """
+    Normalize an image URL so the same image sent to different recipients maps to one key.
+    Lowercases scheme and host, drops the fragment and tracking parameters, sorts the rest.
+    """
+    parts = urlsplit(image_url.strip())
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PARAM_PREFIXES)
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(sorted(query)), ""))
+
+
+def url_cache_key(image_url):
+    """Cache key for an image URL"""
+    return "url:" + hashlib.sha256(normalize_image_url(image_url).encode("utf-8")).hexdigest()
+
+
+def content_cache_key(image_bytes):
+    """Cache key for downloaded image bytes"""
+    return "content:" + hashlib.sha256(image_bytes).hexdigest()
+
+
+def _is_expired(entry, now):
+    if entry.status in LONG_LIVED_STATUSES:
+        ttl = timedelta(days=settings.ocr_cache_ttl_days)
+    else:
+        ttl = timedelta(hours=settings.ocr_cache_negative_ttl_hours)
+    return entry.created_at is None or entry.created_at + ttl < now
+
+
+def _get_entry(cache_key):
+    """The unexpired entry for a cache key as a dict, or None"""
+    if not settings.ocr_cache_enabled:
+        return None
+
+    db = SessionLocal()
+    try:
+        entry = db.query(OcrCacheEntry).filter(OcrCacheEntry.cache_key == cache_key).first()
+        now = datetime.utcnow()
+        if not entry or _is_expired(entry, now):
+            return None
+
+        entry.last_used_at = now
+        db.commit()
+        return {
+            "status": entry.status,
+            "text": entry.text or "",
+            "created_at": entry.created_at,
+            "validators": {"etag": entry.etag, "last_modified": entry.last_modified},
+        }
+    except Exception as e:
+        logger.warning(f"OCR cache lookup failed: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def get_cached_ocr(cache_key):
+    """
+    Look up a cached OCR result.
+
+    Returns:
+        (status, text) tuple, or None on a miss or expired entry
+    """
+    entry = _get_entry(cache_key)
+    if entry is None:
+        return None
+    return entry["status"], entry["text"]
+
+
+def get_cached_url_ocr(url_key):
+    """
+    Look up the cached OCR result for an image URL.
+
+    Returns:
+        Dict with status, text, validators and fresh (False once the result is older than
+        ocr_cache_url_ttl_hours and needs revalidating), or None on a miss, an expired entry,
+        or an old entry without validators
+    """
+    entry = _get_entry(url_key)
+    if entry is None:
+        return None
+    entry["fresh"] = (
+        entry["status"] not in LONG_LIVED_STATUSES
+        or entry["created_at"] + timedelta(hours=settings.ocr_cache_url_ttl_hours) >= datetime.utcnow()
+    )
+    if not entry["fresh"] and not any(entry["validators"].values()):
+        return None
+    return entry
+
+
+def revalidation_headers(cached):
+    """Conditional request headers for re-downloading a cached URL (see get_cached_url_ocr)"""
+    validators = (cached or {}).get("validators") or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(response):
+    """ETag/Last-Modified of an image response, for store_ocr_result"""
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+
+def store_ocr_result(cache_keys, status, text="", validators=None):
+    """
+    Store an OCR result (or negative result) under each of the given cache keys,
+    with the image response's validators (see response_validators) if known
+    """
+    if not settings.ocr_cache_enabled:
+        return
+
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        for cache_key in cache_keys:
+            upsert_entry(
+                db, OcrCacheEntry, OcrCacheEntry.cache_key, cache_key,
+                status=status, text=text, etag=(validators or {}).get("etag"),
+                last_modified=(validators or {}).get("last_modified"), created_at=now, last_used_at=now
+            )
+    except Exception as e:
+        logger.warning(f"OCR cache write failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    _prune_schedule.record_write()
+
+
+def prune_ocr_cache():
+    """Delete expired entries, then the least recently used ones beyond ocr_cache_max_entries"""
+    now = datetime.utcnow()
+    negative_cutoff = now - timedelta(hours=settings.ocr_cache_negative_ttl_hours)
+    positive_cutoff = now - timedelta(days=settings.ocr_cache_ttl_days)
+    expired = (OcrCacheEntry.created_at < positive_cutoff) | (
+        (OcrCacheEntry.created_at < negative_cutoff) & OcrCacheEntry.status.notin_(LONG_LIVED_STATUSES)
+    )
+    prune_entries(SessionLocal, OcrCacheEntry, expired, settings.ocr_cache_max_entries, "OCR")
+
+
+_prune_schedule = PruneSchedule(lambda: prune_ocr_cache())
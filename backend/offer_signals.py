@@ -0,0 +1,60 @@
+"""
+Cheap text-side offer signal detection.
+Finds percentages, currency amounts, promo codes and offer keywords in email
+text without calling an AI model.
+"""
+import re
+
+# "25% off", "up to 40 %"
+PERCENT_PATTERN = re.compile(r"\b\d{1,2}(?:\.\d+)?\s?%", re.IGNORECASE)
+
+# "$10", "€15.99", "£5", "20 USD"
+CURRENCY_PATTERN = re.compile(r"[$€£]\s?\d+(?:[.,]\d{1,2})?|\b\d+(?:\.\d{2})?\s?(?:USD|EUR|GBP)\b", re.IGNORECASE)
+
+# "code SAVE25", "promo code: WELCOME10", "use code FALL-20"
+CODE_PATTERN = re.compile(r"\bcode\b\s*[:\-]?\s*[\"'“]?([A-Z0-9][A-Z0-9\-]{2,19})\b", re.IGNORECASE)
+
+# Words that usually come with a monetary offer
+KEYWORD_PATTERN = re.compile(
+    r"\b(?:off|sale|save|savings|discount|coupon|promo|free shipping|free delivery|bogo|buy one,? get one"
+    r"|clearance|cash ?back|reward points?|free gift|gift with purchase)\b",
+    re.IGNORECASE,
+)
+
+# Signals that on their own say there is a concrete offer
+STRONG_SIGNALS = ("percent", "currency", "code")
+
+
+def detect_offer_signals(text):
+    """
+    Count offer signals in a piece of text.
+
+    Args:
+        text: Email subject and/or body text
+
+    Returns:
+        Dict with counts for percent, currency, code and keyword matches
+    """
+    text = text or ""
+    return {
+        "percent": len(PERCENT_PATTERN.findall(text)),
+        "currency": len(CURRENCY_PATTERN.findall(text)),
+        "code": sum(1 for code in CODE_PATTERN.findall(text) if any(char.isdigit() for char in code) or code.isupper()),
+        "keyword": len(KEYWORD_PATTERN.findall(text)),
+    }
+
+
+def count_strong_signals(signals):
+    """Number of distinct strong signal kinds (percent, currency, code) present"""
+    return sum(1 for kind in STRONG_SIGNALS if signals.get(kind))
+
+
+def has_offer_signals(text, min_strong_signals=1):
+    """
+    Whether text carries an offer on its own.
+
+    Requires at least min_strong_signals distinct strong signal kinds plus an
+    offer keyword, so "Call 555 1234" or "100% cotton" alone don't count.
+    """
+    signals = detect_offer_signals(text)
+    return count_strong_signals(signals) >= min_strong_signals and signals["keyword"] > 0
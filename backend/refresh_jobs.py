@@ -0,0 +1,230 @@
+"""
+Background coupon refresh jobs
+POST /api/coupons/refresh starts a job on this process's job pool and returns
+its ID right away. The job's status and progress are kept in the refresh_jobs
+table, so any API worker can answer GET /api/jobs/{id} while it runs. Each
+process keeps its queued and running jobs fresh with a heartbeat, so only jobs
+whose process went away are reported as stale.
+"""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from database.connection import SessionLocal
+from auth.crud import (
+    get_user_by_id, create_refresh_job, get_refresh_job, get_active_refresh_job, update_refresh_job,
+    touch_refresh_jobs, fail_stale_refresh_job
+)
+from coupon_refresh import refresh_coupons_for_user
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+STALE_JOB_ERROR = "Refresh stopped reporting progress"
+
+# Separate from the blocking executor, so queued refreshes never delay regular requests
+_job_executor = ThreadPoolExecutor(
+    max_workers=settings.refresh_job_workers,
+    thread_name_prefix="refresh-job"
+)
+
+# IDs of this process's queued and running jobs, kept fresh by the heartbeat thread
+_active_jobs = set()
+_active_jobs_lock = threading.Lock()
+_heartbeat_thread = None
+_heartbeat_stop = threading.Event()  # Interruptible sleep for the heartbeat thread
+
+def track_active_job(job_id):
+    """Keep a job of this process alive until it finishes, starting the heartbeat thread if needed"""
+    global _heartbeat_thread
+    with _active_jobs_lock:
+        _active_jobs.add(job_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=run_heartbeat, name="refresh-job-heartbeat", daemon=True)
+            _heartbeat_thread.start()
+
+def untrack_active_job(job_id):
+    with _active_jobs_lock:
+        _active_jobs.discard(job_id)
+
+def touch_active_jobs():
+    """
+    Mark this process's queued and running jobs as alive. Covers jobs queued
+    behind other refreshes and refreshes waiting on another worker, which
+    report no progress for a long time.
+    """
+    with _active_jobs_lock:
+        job_ids = list(_active_jobs)
+    if not job_ids:
+        return
+    db = SessionLocal()
+    try:
+        touch_refresh_jobs(db, job_ids, ACTIVE_STATUSES)
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not write refresh job heartbeat: {e}")
+    finally:
+        db.close()
+
+def run_heartbeat():
+    while not _heartbeat_stop.wait(settings.refresh_job_heartbeat_seconds):
+        touch_active_jobs()
+
+class RefreshJobProgress:
+    """
+    Collects progress from the pipeline threads and writes it to the job row,
+    at most every settings.refresh_job_progress_interval_seconds
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.counts = {
+            "emails_fetched": 0,
+            "emails_ocred": 0,
+            "emails_extracted": 0,
+            "coupons_found": 0,
+        }
+        self.fields = {}
+        self.lock = threading.Lock()
+        self.written_at = 0.0
+
+    def set_stage(self, stage, total=None):
+        with self.lock:
+            self.fields["stage"] = stage
+            if total is not None:
+                self.fields["emails_total"] = total
+        self.flush(force=True)
+
+    def on_email_fetched(self, message_id, email_info):
+        with self.lock:
+            self.counts["emails_fetched"] += 1
+            self.counts["emails_ocred"] += int(not email_info.get("ocr_skipped", True))
+        self.flush()
+
+    def on_email_processed(self, result):
+        with self.lock:
+            self.counts["emails_extracted"] += 1
+            self.counts["coupons_found"] += int(bool(result.get("coupon")))
+        self.flush()
+
+    def flush(self, force=False, **fields):
+        """Write the current progress (plus fields) to the job row if the interval passed or force is set"""
+        with self.lock:
+            now = time.monotonic()
+            if not force and not fields and now - self.written_at < settings.refresh_job_progress_interval_seconds:
+                return
+            self.written_at = now
+            values = {**self.counts, **self.fields, **fields}
+
+        db = SessionLocal()
+        try:
+            update_refresh_job(db, self.job_id, **values)
+        except Exception as e:
+            # Progress is best effort, the refresh itself carries on
+            db.rollback()
+            logger.warning(f"Could not write progress for refresh job {self.job_id}: {e}")
+        finally:
+            db.close()
+
+    def finish(self, **fields):
+        """
+        Write the job's final status with its progress. Unlike progress, this write
+        is retried (settings.refresh_job_final_write_attempts times, each on a new
+        session) and the last error is raised, since a lost final status leaves
+        the job looking active until it goes stale.
+
+        A job that already has a final status is only overwritten if it was
+        marked failed for going stale, since the real outcome replaces that guess.
+        """
+        with self.lock:
+            self.written_at = time.monotonic()
+            values = {**self.counts, **self.fields, **fields}
+
+        attempts = max(1, settings.refresh_job_final_write_attempts)
+        for attempt in range(attempts):
+            db = SessionLocal()
+            try:
+                job = get_refresh_job(db, self.job_id)
+                if job and job.status not in ACTIVE_STATUSES:
+                    if job.error != STALE_JOB_ERROR:
+                        logger.warning(f"Refresh job {self.job_id} already finished as {job.status}, not writing {values.get('status')}")
+                        return
+                    logger.warning(f"Refresh job {self.job_id} was reported stale while it ran, recording its {values.get('status')} status")
+                    values.setdefault("error", None)
+                update_refresh_job(db, self.job_id, **values)
+                return
+            except Exception as e:
+                db.rollback()
+                if attempt == attempts - 1:
+                    logger.error(f"Could not write final status {values.get('status')} for refresh job {self.job_id}: {e}")
+                    raise
+                logger.warning(f"Retrying final status write for refresh job {self.job_id}: {e}")
+            finally:
+                db.close()
+            time.sleep(min(2 ** attempt, 10))
+
+def run_refresh_job(job_id: str, user_id: int):
+    """Run a refresh job to completion (on a job pool thread), with heartbeats until it finishes"""
+    track_active_job(job_id)
+    try:
+        execute_refresh_job(job_id, user_id)
+    finally:
+        untrack_active_job(job_id)
+
+def execute_refresh_job(job_id: str, user_id: int):
+    progress = RefreshJobProgress(job_id)
+    db = SessionLocal()
+    try:
+        update_refresh_job(db, job_id, status="running", stage="starting", started_at=datetime.utcnow())
+        user = get_user_by_id(db, user_id)
+        if not user or not user.gmail_connected or not user.gmail_access_token:
+            raise ValueError("Gmail not connected")
+
+        refresh = refresh_coupons_for_user(db, user, progress=progress)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Refresh job {job_id} failed: {e}")
+        progress.finish(status="failed", error=str(getattr(e, "detail", e)), finished_at=datetime.utcnow())
+        return
+    finally:
+        db.close()
+
+    progress.finish(
+        status="succeeded", stage="done", finished_at=datetime.utcnow(),
+        emails_total=refresh["emails_processed"], coupons_found=len(refresh["new_coupons"])
+    )
+    logger.info(f"Refresh job {job_id} found {len(refresh['new_coupons'])} coupons in {refresh['emails_processed']} emails")
+
+def start_refresh_job(db: Session, user_id: int):
+    """Create a refresh job for the user and queue it on the job pool, or return the one already active"""
+    active_job = get_active_refresh_job(db, user_id)
+    if active_job:
+        active_job = get_refresh_job_status(db, active_job.id)
+        if active_job.status in ACTIVE_STATUSES:
+            logger.info(f"Refresh job {active_job.id} already active for user {user_id}")
+            return active_job
+
+    job = create_refresh_job(db, user_id)
+    # Heartbeat from the moment it is queued, the pool may be busy with other refreshes
+    track_active_job(job.id)
+    _job_executor.submit(run_refresh_job, job.id, user_id)
+    logger.info(f"Queued refresh job {job.id} for user {user_id}")
+    return job
+
+def get_refresh_job_status(db: Session, job_id: str):
+    """
+    Get a refresh job, marking it failed if its process stopped reporting
+    progress and heartbeats (e.g. it was restarted).
+    """
+    job = get_refresh_job(db, job_id)
+    if job and job.status in ACTIVE_STATUSES and job.updated_at:
+        stale_before = datetime.utcnow() - timedelta(minutes=settings.refresh_job_stale_minutes)
+        # Conditional, so a job that just finished or got a heartbeat isn't overwritten
+        if job.updated_at < stale_before and fail_stale_refresh_job(db, job_id, ACTIVE_STATUSES, stale_before, STALE_JOB_ERROR):
+            db.refresh(job)
+    return job
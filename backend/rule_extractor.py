@@ -0,0 +1,227 @@
+"""
+Deterministic coupon extraction.
+Compiled patterns for the offers marketing emails state plainly ("use code
+SAVE20", "20% off", "$10 off $50+", "free shipping on orders over $35"). When
+an email has one clear offer the result is confident enough to skip Gemini;
+anything ambiguous (several amounts, "up to", no code) is left to the LLM.
+"""
+import re
+from datetime import date, timedelta
+
+from coupon_schema import validate_extraction
+
+AMOUNT = r"\d+(?:\.\d{2})?"
+
+# Only codes introduced as one ("use code SAVE20", "enter promo code: FALL-20"),
+# so "zip code 94105" or "reference code" never become a coupon code
+OFFER_CODE_PATTERN = re.compile(
+    r"\b(?:(?:use|enter|apply|with)\s+(?:the\s+)?(?:promo\s+|coupon\s+|discount\s+|offer\s+)?code"
+    r"|(?:promo|coupon|discount|offer)\s+code)\b\s*[:\-]?\s*[\"'“]?(?P<code>[A-Z0-9][A-Z0-9\-]{2,19})\b",
+    re.IGNORECASE,
+)
+# Address wording that makes an all-digit "code" a zip ("enter code 94105 ... Main Street, CA 94105")
+ADDRESS_CONTEXT_PATTERN = re.compile(
+    r"\b(?:zip|postal|postcode|address|street|avenue|suite|blvd)\b|(?-i:\b[A-Z]{2}\s+\d{5}(?:-\d{4})?\b)", re.IGNORECASE
+)
+PERCENT_PATTERN = re.compile(r"\b(?P<amount>\d{1,2})\s?%")
+PERCENT_OFF_PATTERN = re.compile(r"(?P<up_to>\bup to\s+)?\b(?P<amount>\d{1,2})\s?%\s*off\b", re.IGNORECASE)
+DOLLAR_OFF_PATTERN = re.compile(
+    rf"(?P<up_to>\bup to\s+)?\$(?P<amount>{AMOUNT})\s*off\b"
+    rf"(?:\s+(?:(?:your|any)\s+)?(?:orders?|purchases?)?\s*(?:of|over)?\s*\$(?P<minimum>{AMOUNT})\+?)?",
+    re.IGNORECASE,
+)
+MINIMUM_PURCHASE_PATTERN = re.compile(
+    rf"\b(?:orders?|purchases?)\s+(?:of|over|above)\s+\$(?P<amount>{AMOUNT})\+?"
+    rf"|\bwhen you spend\s+\$(?P<spend>{AMOUNT})\+?"
+    rf"|\$(?P<plus>{AMOUNT})\+",
+    re.IGNORECASE,
+)
+FREE_SHIPPING_PATTERN = re.compile(r"\bfree\s+(?:standard\s+)?(?:shipping|delivery)\b", re.IGNORECASE)
+# Offers the patterns don't model (BOGO, gifts, points)
+UNMODELED_OFFER_PATTERN = re.compile(
+    r"\b(?:bogo|buy (?:one|\d+),? get (?:one|\d+)|free gift|gift with (?:any )?purchase|(?:reward |bonus |double )?points"
+    r"|double stars|cash ?back)\b",
+    re.IGNORECASE,
+)
+SITEWIDE_PATTERN = re.compile(
+    r"\b(?:sitewide|site-wide|everything|entire (?:order|purchase|site|store)|all (?:orders|items|purchases))\b", re.IGNORECASE
+)
+
+MONTHS = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+EXPIRY_PREFIX = r"\b(?:ends?|expires?|valid (?:through|thru|until)|through|thru|until|by)\s+(?:on\s+)?(?:\w+day,?\s+)?"
+NUMERIC_EXPIRY_PATTERN = re.compile(
+    EXPIRY_PREFIX + r"(?P<month>\d{1,2})/(?P<day>\d{1,2})(?:/(?P<year>\d{2}|\d{4}))?\b", re.IGNORECASE
+)
+NAMED_EXPIRY_PATTERN = re.compile(
+    EXPIRY_PREFIX + r"(?P<month>" + "|".join(MONTHS) + r")[a-z]*\.?\s+(?P<day>\d{1,2})(?:st|nd|rd|th)?(?:,?\s+(?P<year>\d{4}))?\b",
+    re.IGNORECASE,
+)
+TODAY_EXPIRY_PATTERN = re.compile(r"\b(?:ends|expires)\s+(?:tonight|today|at midnight)\b|\btoday only\b|\bone day only\b", re.IGNORECASE)
+LIMITED_TIME_PATTERN = re.compile(r"\blimited[- ]time\b", re.IGNORECASE)
+
+# Confidence of a single clear offer, by how it was found
+CONFIDENCE_WITH_CODE = 0.95
+CONFIDENCE_SITEWIDE = 0.9
+CONFIDENCE_PLAIN = 0.7
+CONFIDENCE_UP_TO = 0.5
+CONFIDENCE_AMBIGUOUS = 0.3
+
+
+def format_amount(amount, unit):
+    """'20' -> '20%', '10.00' -> '$10'"""
+    amount = amount[:-3] if amount.endswith(".00") else amount
+    return f"{amount}%" if unit == "%" else f"${amount}"
+
+
+def get_sender_company(email_sender):
+    """Display name of the sender, or its domain when there is none"""
+    name = (email_sender or "").split("<")[0].strip().strip('"')
+    if name:
+        return name
+    return (email_sender or "").split("@")[-1].strip(" >").split(".")[0].title() or None
+
+
+def find_expiry(text, email_timestamp):
+    """
+    Explicit expiry date as (YYYY-MM-DD or description, inferred) or (None, False).
+    Dates without a year use the email's year, or the next one if already past.
+    """
+    email_date = email_timestamp.date() if hasattr(email_timestamp, "date") else date.today()
+    for pattern in (NUMERIC_EXPIRY_PATTERN, NAMED_EXPIRY_PATTERN):
+        match = pattern.search(text)
+        if not match:
+            continue
+        month = match.group("month")
+        month = int(month) if month.isdigit() else MONTHS.index(month[:3].lower()) + 1
+        year = match.group("year")
+        try:
+            if year:
+                return date(int(year) + (2000 if len(year) == 2 else 0), month, int(match.group("day"))).isoformat(), False
+            expiry = date(email_date.year, month, int(match.group("day")))
+            if expiry < email_date - timedelta(days=1):
+                expiry = expiry.replace(year=email_date.year + 1)
+            return expiry.isoformat(), True
+        except ValueError:
+            continue
+
+    if TODAY_EXPIRY_PATTERN.search(text):
+        return email_date.isoformat(), True
+    if LIMITED_TIME_PATTERN.search(text):
+        return "Limited Time", True
+    return None, False
+
+
+def find_minimum_purchase(text):
+    match = MINIMUM_PURCHASE_PATTERN.search(text)
+    if not match:
+        return None
+    return format_amount(match.group("amount") or match.group("spend") or match.group("plus"), "$")
+
+
+def find_codes(text):
+    """Coupon codes introduced by a code keyword, skipping all-digit ones in an address"""
+    codes = set()
+    for match in OFFER_CODE_PATTERN.finditer(text):
+        code = match.group("code")
+        if not (any(char.isdigit() for char in code) or code.isupper()):
+            continue
+        if code.isdigit() and ADDRESS_CONTEXT_PATTERN.search(sentence_around(text, match.start(), match.end())):
+            continue
+        codes.add(code.upper())
+    return codes
+
+
+def sentence_around(text, start, end):
+    """The sentence containing text[start:end], for offer descriptions"""
+    sentence_start = max(text.rfind(".", 0, start), text.rfind("!", 0, start), text.rfind("\n", 0, start)) + 1
+    ends = [index for index in (text.find(".", end), text.find("!", end), text.find("\n", end)) if index != -1]
+    sentence = text[sentence_start:min(ends) + 1 if ends else len(text)].strip()
+    return sentence[:200]
+
+
+def extract_offers_with_rules(email_text, email_subject, email_sender, email_timestamp):
+    """
+    Extract offers with patterns only.
+
+    Args:
+        email_text: Preprocessed email text (see get_email_info_from_message)
+
+    Returns:
+        (coupon info in the get_coupon_info_from_email format, confidence 0-1),
+        or (None, 0.0) when the patterns find no offer
+    """
+    text = f"{email_subject or ''}\n{email_text or ''}"
+
+    discounts = {}
+    for pattern, unit in ((PERCENT_OFF_PATTERN, "%"), (DOLLAR_OFF_PATTERN, "$")):
+        for match in pattern.finditer(text):
+            amount = format_amount(match.group("amount"), unit)
+            discounts.setdefault(amount, match)
+    codes = find_codes(text)
+    free_shipping = FREE_SHIPPING_PATTERN.search(text)
+
+    if not discounts and not free_shipping:
+        # BOGO, gifts and points are worded too many ways to trust patterns alone
+        return None, 0.0
+
+    company = get_sender_company(email_sender)
+    expiry_date, expiry_inferred = find_expiry(text, email_timestamp)
+    code = next(iter(codes)) if len(codes) == 1 else None
+
+    offers = []
+    if len(discounts) == 1:
+        amount, match = next(iter(discounts.items()))
+        minimum = None
+        if "minimum" in match.groupdict() and match.group("minimum"):
+            minimum = format_amount(match.group("minimum"), "$")
+        minimum = minimum or find_minimum_purchase(text)
+        offers.append({
+            "offer_brand": company,
+            "offer_type": "coupon" if code else "discount",
+            "discount_amount": amount,
+            "coupon_code": code,
+            "expiry_date": expiry_date,
+            "expiry_inferred": expiry_inferred,
+            "offer_title": f"{amount} Off" + (f" ${minimum[1:]}+" if minimum else ""),
+            "offer_description": sentence_around(text, match.start(), match.end()),
+            "minimum_purchase": minimum,
+            "call_to_action": "Use Code" if code else "Shop Now",
+        })
+        if match.group("up_to"):
+            confidence = CONFIDENCE_UP_TO
+        elif code:
+            confidence = CONFIDENCE_WITH_CODE
+        elif SITEWIDE_PATTERN.search(text):
+            confidence = CONFIDENCE_SITEWIDE
+        else:
+            confidence = CONFIDENCE_PLAIN
+    elif discounts:
+        # Tiered or per-product discounts need the LLM to tell the offers apart
+        confidence = CONFIDENCE_AMBIGUOUS
+    else:
+        confidence = CONFIDENCE_WITH_CODE if code else CONFIDENCE_PLAIN
+
+    if free_shipping:
+        shipping_text = text[free_shipping.start():free_shipping.end() + 40]
+        shipping_minimum = find_minimum_purchase(shipping_text)
+        offers.append({
+            "offer_brand": company,
+            "offer_type": "free_shipping",
+            "discount_amount": None,
+            "coupon_code": code if not discounts else None,
+            "expiry_date": expiry_date,
+            "expiry_inferred": expiry_inferred,
+            "offer_title": "Free Shipping" + (f" on ${shipping_minimum[1:]}+" if shipping_minimum else ""),
+            "offer_description": sentence_around(text, free_shipping.start(), free_shipping.end()),
+            "minimum_purchase": shipping_minimum,
+            "call_to_action": "Use Code" if code and not discounts else "Shop Now",
+        })
+
+    # Percentages that are not "N% off" ("Autoship saves an extra 5%") are offers the patterns miss
+    extra_percents = {format_amount(match.group("amount"), "%") for match in PERCENT_PATTERN.finditer(text)} - set(discounts)
+    if len(codes) > 1 or extra_percents or UNMODELED_OFFER_PATTERN.search(text):
+        # Several codes, or an extra offer the patterns don't model
+        confidence = min(confidence, CONFIDENCE_AMBIGUOUS)
+
+    coupon_info = validate_extraction({"has_coupon": bool(offers), "email_sender_company": company, "offers": offers})
+    return coupon_info, confidence
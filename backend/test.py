@@ -56,7 +56,7 @@ def test_specific_email(message_id):
         img_text = ""
         # Get text from images using OCR
         if img_links:
-            img_text = get_text_from_images(img_links)
+            img_text, _ = get_text_from_images(img_links)
             # Append the image text to the plain text
             plain_text += "\n" + img_text
 
@@ -0,0 +1,83 @@
+"""
+Tests for which emails the coupon pipeline records as processed, streaming
+batches through it as emails are fetched, and for how the classifier report
+spots shadow samples
+"""
+import json
+from datetime import datetime
+
+import pytest
+
+import classifier_report
+import coupon_pipeline
+from auth.models import ProcessedEmail
+
+EMAIL_INFO = {
+    "email_text": "Plain Text: Free shipping on everything this weekend.\n Image Text:",
+    "email_subject": "This weekend",
+    "email_sender": "Shop <deals@shop.com>",
+    "email_timestamp": datetime(2026, 10, 14, 9),
+}
+
+
+def screening(score, threshold=0.2):
+    return {"score": score, "features": {"percent": 0.0}, "threshold": threshold, "send_to_llm": score >= threshold}
+
+
+def test_classifier_reject_is_left_for_a_later_retry():
+    result = coupon_pipeline.process_email("m1", EMAIL_INFO, screening=screening(0.15))
+    assert result["processed"] is None
+    assert result["error"] is None
+
+
+def test_extracted_email_records_the_threshold_it_was_screened_with(monkeypatch):
+    monkeypatch.setattr(coupon_pipeline.settings, "rule_extractor_enabled", False)
+    monkeypatch.setattr(coupon_pipeline, "get_coupon_info_from_email", lambda *args: {"has_coupon": False, "offers": []})
+    result = coupon_pipeline.process_email("m1", EMAIL_INFO, screening=screening(0.5, threshold=0.3))
+    assert result["processed"]["classifier_threshold"] == 0.3
+    assert result["processed"]["has_coupon"] is False
+
+
+def test_batches_are_enriched_while_later_emails_are_still_being_added(monkeypatch):
+    monkeypatch.setattr(coupon_pipeline.settings, "rule_extractor_enabled", False)
+    monkeypatch.setattr(coupon_pipeline.settings, "extraction_batch_size", 2)
+    monkeypatch.setattr(coupon_pipeline, "screen_email", lambda *args: screening(0.5))
+    monkeypatch.setattr(
+        coupon_pipeline, "get_coupon_info_from_batch",
+        lambda batch: {message_id: {"has_coupon": False, "offers": []} for message_id in batch}
+    )
+    pipeline = coupon_pipeline.EmailPipeline()
+
+    pipeline.add("m1", EMAIL_INFO)
+    pipeline.add("m2", EMAIL_INFO)
+    # The full batch was submitted without waiting for more emails
+    for batch_future in list(pipeline.batch_futures):
+        batch_future.result()
+    pipeline.add("m3", EMAIL_INFO)
+    assert set(pipeline.futures) == {"m1", "m2"}
+
+    results = pipeline.finish()
+    assert [result["message_id"] for result in results] == ["m1", "m2", "m3"]
+
+
+@pytest.fixture
+def report_db(monkeypatch, memory_session_local):
+    monkeypatch.setattr(classifier_report, "SessionLocal", memory_session_local)
+    monkeypatch.setattr(classifier_report.settings, "classifier_shadow_rate", 0.05)
+    return memory_session_local
+
+
+def test_report_uses_the_stored_threshold_for_shadow_samples(report_db, monkeypatch):
+    db = report_db()
+    for email_id, score, threshold in (("a", 0.25, 0.3), ("b", 0.25, 0.2), ("c", 0.1, None)):
+        db.add(ProcessedEmail(
+            user_id=1, email_id=email_id, has_coupon=True, llm_labeled=True, classifier_score=score,
+            classifier_threshold=threshold, classifier_features=json.dumps({"percent": 1.0})
+        ))
+    db.commit()
+    db.close()
+
+    # The current threshold changed since "b" was screened; legacy "c" falls back to it
+    monkeypatch.setattr(classifier_report.settings, "classifier_threshold", 0.4)
+    weights = [weight for _, _, weight in classifier_report.load_labeled_examples()]
+    assert weights == [pytest.approx(20.0), 1.0, pytest.approx(20.0)]
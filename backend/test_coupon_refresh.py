@@ -0,0 +1,164 @@
+"""
+Tests for single-flight refreshes: progress replay for callers that join a
+running refresh, renewing the refresh lock while it runs, and where the delta
+sync cursor and the retry list of failed emails move to
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import coupon_refresh
+from auth.crud import acquire_refresh_lock, get_pending_email_ids
+from auth.models import RefreshLock, User, ProcessedEmail, UserCoupon
+from coupon_refresh import RefreshFlight, RefreshLockRenewal, ProcessedEmailLookup
+
+
+class RecordingListener:
+    def __init__(self):
+        self.events = []
+
+    def set_stage(self, stage, total=None):
+        self.events.append(("stage", stage, total))
+
+    def on_email_fetched(self, message_id, email_info):
+        self.events.append(("fetched", message_id))
+
+    def on_email_processed(self, result):
+        self.events.append(("processed", result["message_id"]))
+
+
+def test_listener_joining_mid_refresh_gets_the_progress_so_far():
+    flight = RefreshFlight()
+    first = RecordingListener()
+    flight.add_listener(first)
+    flight.set_stage("fetching")
+    flight.on_email_fetched("m1", {})
+    flight.set_stage("extracting", total=1)
+
+    joined = RecordingListener()
+    flight.add_listener(joined)
+    flight.on_email_processed({"message_id": "m1"})
+
+    assert joined.events == first.events == [
+        ("stage", "fetching", None), ("fetched", "m1"), ("stage", "extracting", 1), ("processed", "m1")
+    ]
+
+
+@pytest.fixture
+def lock_db(monkeypatch, memory_session_local):
+    monkeypatch.setattr(coupon_refresh, "SessionLocal", memory_session_local)
+    return memory_session_local
+
+
+def lock_expiry(session_local, user_id):
+    db = session_local()
+    try:
+        return db.query(RefreshLock).filter(RefreshLock.user_id == user_id).first().expires_at
+    finally:
+        db.close()
+
+
+def test_progress_renews_the_refresh_lock(lock_db, monkeypatch):
+    db = lock_db()
+    assert acquire_refresh_lock(db, 1, "worker-a", timedelta(minutes=1))
+    db.close()
+    expires_at = lock_expiry(lock_db, 1)
+
+    monkeypatch.setattr(coupon_refresh.settings, "refresh_lock_renew_seconds", 0.0)
+    RefreshLockRenewal(1, "worker-a").on_email_processed({"message_id": "m1"})
+    assert lock_expiry(lock_db, 1) > expires_at + timedelta(minutes=10)
+
+
+def test_renewal_never_extends_a_lock_taken_over_by_another_worker(lock_db, monkeypatch):
+    db = lock_db()
+    assert acquire_refresh_lock(db, 1, "worker-b", timedelta(minutes=1))
+    db.close()
+    expires_at = lock_expiry(lock_db, 1)
+
+    monkeypatch.setattr(coupon_refresh.settings, "refresh_lock_renew_seconds", 0.0)
+    RefreshLockRenewal(1, "worker-a").set_stage("saving")
+    assert lock_expiry(lock_db, 1) == expires_at
+    assert expires_at < datetime.utcnow() + timedelta(minutes=2)
+
+
+def fake_refresh_run(monkeypatch, failed_messages, pipeline_errors=()):
+    """Stubs Gmail and the pipeline; returns the get_new_emails_info_for_user calls"""
+    calls = []
+
+    def get_new_emails_info_for_user(gmail_service, **kwargs):
+        calls.append(kwargs)
+        kwargs["on_email"]("m1", {"email_text": "m1"})
+        return {"m1": {"email_text": "m1"}}, "900", dict(failed_messages)
+
+    class FakePipeline:
+        def __init__(self, user_id=None, on_result=None):
+            self.message_ids = []
+
+        def add(self, message_id, email_info):
+            self.message_ids.append(message_id)
+
+        def finish(self):
+            return [
+                {"message_id": message_id, "coupon": None, "processed": None,
+                 "error": "extraction failed" if message_id in pipeline_errors else None}
+                for message_id in self.message_ids
+            ]
+
+    monkeypatch.setattr(coupon_refresh, "create_gmail_service_for_user", lambda user, db: None)
+    monkeypatch.setattr(coupon_refresh, "get_new_emails_info_for_user", get_new_emails_info_for_user)
+    monkeypatch.setattr(coupon_refresh, "EmailPipeline", FakePipeline)
+    return calls
+
+
+def test_first_refresh_is_a_full_sync_and_failures_do_not_hold_the_cursor_back(lock_db, monkeypatch):
+    db = lock_db()
+    # The Gmail watch stores its own history ID when Gmail is connected
+    user = User(email="a@example.com", google_id="g1", gmail_history_id="500")
+    db.add(user)
+    db.commit()
+
+    calls = fake_refresh_run(monkeypatch, {"m2": "429"}, pipeline_errors={"m1"})
+    coupon_refresh.run_refresh(db, user)
+    assert calls[0]["start_history_id"] is None
+    assert user.gmail_sync_history_id == "900"
+    assert sorted(get_pending_email_ids(db, user.id)) == ["m1", "m2"]
+
+    calls = fake_refresh_run(monkeypatch, {})
+    coupon_refresh.run_refresh(db, user)
+    assert calls[0]["start_history_id"] == "900"
+    assert sorted(calls[0]["retry_message_ids"]) == ["m1", "m2"]
+    assert get_pending_email_ids(db, user.id) == []
+    db.close()
+
+
+def test_email_that_keeps_failing_is_given_up_on(lock_db, monkeypatch):
+    db = lock_db()
+    user = User(email="a@example.com", google_id="g1")
+    db.add(user)
+    db.commit()
+
+    monkeypatch.setattr(coupon_refresh.settings, "gmail_retry_max_attempts", 3)
+    fake_refresh_run(monkeypatch, {"m2": "500"})
+    for _ in range(2):
+        coupon_refresh.run_refresh(db, user)
+        assert get_pending_email_ids(db, user.id) == ["m2"]
+    coupon_refresh.run_refresh(db, user)
+    assert get_pending_email_ids(db, user.id) == []
+    db.close()
+
+
+def test_lookup_only_answers_for_the_ids_and_campaigns_asked_about(memory_session_local):
+    db = memory_session_local()
+    sent_at = datetime(2025, 1, 6, 9)
+    db.add_all([
+        ProcessedEmail(user_id=1, email_id="m1", campaign_key="deals@shop.com|sale", email_timestamp=sent_at),
+        ProcessedEmail(user_id=1, email_id="m2", campaign_key="deals@shop.com|news"),
+        ProcessedEmail(user_id=2, email_id="m3", campaign_key="deals@shop.com|sale"),
+        UserCoupon(user_id=1, email_id="legacy", coupon_data="{}"),
+    ])
+    db.commit()
+
+    lookup = ProcessedEmailLookup(db, 1)
+    assert lookup.known_message_ids(["m1", "m3", "legacy", "new"]) == {"m1", "legacy"}
+    assert lookup.known_campaigns({"deals@shop.com|sale", "other|x"}) == {"deals@shop.com|sale": [sent_at]}
+    db.close()
@@ -0,0 +1,193 @@
+"""
+Tests for the tolerant JSON parsing of Gemini extraction responses and for
+how truncated responses are kept out of the extraction cache
+"""
+import json
+from datetime import datetime
+
+import pytest
+
+import extraction_cache
+import get_coupon_info_from_email as extraction
+from core import gemini
+from coupon_schema import repair_truncated_json, parse_json_response, validate_extraction
+
+TRUNCATED_RESPONSE = (
+    '{"has_coupon": true, "email_sender_company": "Shop", "offers": ['
+    '{"offer_type": "discount", "discount_amount": "10%", "offer_title": "10% off", "expiry_inferred": false}, '
+    '{"offer_type": "coupon", "discount_amount": "20%", "coupon_code": "SAV'
+)
+
+
+def test_repair_closes_open_objects_and_arrays():
+    candidates = repair_truncated_json('{"a": [1, 2, {"b": 3}')
+    assert json.loads(candidates[0]) == {"a": [1, 2, {"b": 3}]}
+
+
+def test_repair_never_keeps_a_cut_off_value():
+    candidates = repair_truncated_json(TRUNCATED_RESPONSE)
+    assert candidates
+    assert all('"SAV' not in candidate for candidate in candidates)
+
+
+def test_repair_ignores_brackets_inside_strings():
+    candidates = repair_truncated_json('{"title": "Save [now] {today}", "offers": [')
+    parsed = [json.loads(candidate) for candidate in candidates if _parses(candidate)]
+    assert parsed[0]["title"] == "Save [now] {today}"
+
+
+def test_repair_returns_complete_document_unchanged():
+    assert repair_truncated_json('prose {"a": 1} more prose') == ['{"a": 1}']
+
+
+def test_repair_without_json_has_no_candidates():
+    assert repair_truncated_json("no json here") == []
+
+
+def test_parse_reports_whether_the_response_was_repaired():
+    assert parse_json_response('```json\n{"has_coupon": false, "offers": []}\n```') == (
+        {"has_coupon": False, "offers": []}, False
+    )
+    data, repaired = parse_json_response(TRUNCATED_RESPONSE)
+    assert repaired
+    assert data["offers"][0]["offer_title"] == "10% off"
+
+
+def test_complete_document_in_prose_is_not_reported_as_repaired():
+    assert parse_json_response('{"has_coupon": false, "offers": []}\nNote: no offers found.') == (
+        {"has_coupon": False, "offers": []}, False
+    )
+    assert parse_json_response('Here is the JSON:\n```json\n[{"email_key": "e1"}]\n```') == (
+        [{"email_key": "e1"}], False
+    )
+
+
+def test_parse_raises_when_nothing_is_recoverable():
+    with pytest.raises(json.JSONDecodeError):
+        parse_json_response("not json")
+
+
+def test_validate_drops_invalid_offers_and_clears_has_coupon():
+    result = validate_extraction({"has_coupon": True, "offers": [{"offer_type": "discount", "discount_amount": "20%"}]})
+    assert result["has_coupon"] is False
+    assert result["offers"] == []
+
+
+class FakeResponse:
+    def __init__(self, text, finish_reason="STOP"):
+        self.text = text
+        self.usage_metadata = None
+        self.candidates = [type("Candidate", (), {"finish_reason": finish_reason})()]
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """Extraction model returning canned responses, with the extraction cache recorded in memory"""
+    responses = []
+    stored = {}
+
+    class FakeModel:
+        def __init__(self, model_name, **model_kwargs):
+            pass
+
+        def generate_content(self, prompt, **kwargs):
+            return responses.pop(0)
+
+    monkeypatch.setattr(extraction_cache, "get_cached_extraction", lambda cache_key: None)
+    monkeypatch.setattr(extraction_cache, "store_extraction", lambda cache_key, result, *args: stored.update({cache_key: result}))
+    gemini.set_model_factory(FakeModel)
+    yield responses, stored
+    gemini.set_model_factory(None)
+
+
+def extract(email_text="Take 20% off with code SAVE20"):
+    return extraction.get_coupon_info_from_email(email_text, "Sale", "Shop <deals@shop.com>", datetime(2025, 1, 6))
+
+
+def test_truncated_response_is_retried_not_cached(fake_gemini):
+    responses, stored = fake_gemini
+    responses.append(FakeResponse(TRUNCATED_RESPONSE))
+    result = extract()
+    assert "error" in result
+    assert stored == {}
+
+
+def test_max_tokens_response_is_retried_not_cached(fake_gemini):
+    responses, stored = fake_gemini
+    responses.append(FakeResponse('{"has_coupon": false, "offers": []}', finish_reason="MAX_TOKENS"))
+    assert "error" in extract()
+    assert stored == {}
+
+
+def test_complete_response_is_cached(fake_gemini):
+    responses, stored = fake_gemini
+    offer = {"offer_type": "coupon", "coupon_code": "SAVE20", "offer_title": "20% off", "expiry_inferred": False}
+    responses.append(FakeResponse(json.dumps({"has_coupon": True, "offers": [offer]})))
+    result = extract()
+    assert result["has_coupon"] is True
+    assert list(stored.values()) == [result]
+
+
+def test_truncated_batch_keeps_only_complete_items(fake_gemini):
+    responses, stored = fake_gemini
+    offer = {"offer_type": "discount", "discount_amount": "10%", "offer_title": "10% off", "expiry_inferred": False}
+    complete_item = json.dumps({"email_key": "1", "has_coupon": True, "offers": [offer]})
+    responses.append(FakeResponse(f'[{complete_item}, {{"email_key": "2", "has_coupon": true, "offers": [{{"offer_type": "cou'))
+    emails = {
+        message_id: {"email_text": "10% off", "email_subject": "Sale", "email_sender": "Shop <a@shop.com>", "email_timestamp": datetime(2025, 1, 6)}
+        for message_id in ("m1", "m2")
+    }
+    assert list(extraction.extract_batch(emails)) == ["m1"]
+
+
+
+def batch_emails(*message_ids):
+    return {
+        message_id: {"email_text": f"Deal {message_id}: 10% off", "email_subject": "Sale", "email_sender": "Shop <a@shop.com>", "email_timestamp": datetime(2025, 1, 6)}
+        for message_id in message_ids
+    }
+
+
+def batch_item(email_key, company):
+    return {"email_key": email_key, "has_coupon": False, "email_sender_company": company, "offers": []}
+
+
+def test_batch_items_map_back_to_message_ids_by_email_key(fake_gemini):
+    responses, stored = fake_gemini
+    responses.append(FakeResponse(json.dumps([batch_item("3", "C"), batch_item("1", "A"), batch_item("2", "B")])))
+    results = extraction.get_coupon_info_from_emails(batch_emails("m1", "m2", "m3"))
+    assert {message_id: info["email_sender_company"] for message_id, info in results.items()} == {"m1": "A", "m2": "B", "m3": "C"}
+    assert responses == []
+    assert len(stored) == 3
+
+
+def test_missing_duplicate_and_invalid_batch_items_fall_back_to_single_emails(fake_gemini):
+    responses, stored = fake_gemini
+    invalid_item = {"email_key": "2", "offers": []}
+    responses.append(FakeResponse(json.dumps([batch_item("1", "A"), batch_item("1", "Duplicate"), invalid_item, batch_item("9", "Unknown")])))
+    # One single-email request each for m2 (invalid) and m3 (missing), in batch order
+    responses.append(FakeResponse(json.dumps({"has_coupon": False, "email_sender_company": "B", "offers": []})))
+    responses.append(FakeResponse(json.dumps({"has_coupon": False, "email_sender_company": "C", "offers": []})))
+    results = extraction.get_coupon_info_from_emails(batch_emails("m1", "m2", "m3"))
+    assert {message_id: info["email_sender_company"] for message_id, info in results.items()} == {"m1": "A", "m2": "B", "m3": "C"}
+    assert responses == []
+
+
+def test_batch_emails_are_trimmed_once(fake_gemini, monkeypatch):
+    responses, stored = fake_gemini
+    trimmed = []
+    trim_email_text = extraction.trim_email_text
+    monkeypatch.setattr(extraction, "trim_email_text", lambda text: trimmed.append(text) or trim_email_text(text))
+    responses.append(FakeResponse(json.dumps([batch_item("1", "A")])))
+    responses.append(FakeResponse(json.dumps({"has_coupon": False, "email_sender_company": "B", "offers": []})))
+    emails = batch_emails("m1", "m2")
+    extraction.get_coupon_info_from_emails(emails)
+    assert sorted(trimmed) == sorted(email["email_text"] for email in emails.values())
+
+
+def _parses(text):
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
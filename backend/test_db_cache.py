@@ -0,0 +1,34 @@
+"""
+Tests for the bookkeeping shared by the database-backed caches: upserts that
+race with another worker and the prune schedule
+"""
+from sqlalchemy.exc import IntegrityError
+
+from auth.models import CompanyLogoEntry
+from core.db_cache import upsert_entry, PruneSchedule
+
+
+def test_upsert_updates_the_existing_entry(memory_session_local):
+    db = memory_session_local()
+    assert upsert_entry(db, CompanyLogoEntry, CompanyLogoEntry.domain, "shop.com", logo_url="a.png")
+    assert upsert_entry(db, CompanyLogoEntry, CompanyLogoEntry.domain, "shop.com", logo_url="b.png")
+    assert [entry.logo_url for entry in db.query(CompanyLogoEntry)] == ["b.png"]
+    db.close()
+
+
+def test_upsert_keeps_the_entry_another_worker_inserted_first(memory_session_local, monkeypatch):
+    db = memory_session_local()
+
+    def conflicting_commit():
+        raise IntegrityError("INSERT INTO company_logos", {}, Exception("UNIQUE constraint failed"))
+    monkeypatch.setattr(db, "commit", conflicting_commit)
+    assert not upsert_entry(db, CompanyLogoEntry, CompanyLogoEntry.domain, "shop.com", logo_url="a.png")
+    db.close()
+
+
+def test_prune_runs_once_every_so_many_writes():
+    prunes = []
+    schedule = PruneSchedule(lambda: prunes.append(1), every_writes=3)
+    for _ in range(7):
+        schedule.record_write()
+    assert len(prunes) == 2
@@ -0,0 +1,52 @@
+"""
+Tests for the cross-user extraction cache key and for keeping personal
+coupon codes out of the shared cache
+"""
+from datetime import datetime
+
+from extraction_cache import get_extraction_cache_key, is_shareable_extraction
+
+TIMESTAMP = datetime(2025, 1, 6, 9, 30)
+
+
+def cache_key(email_text, email_subject="Our biggest sale", email_sender="Shop <deals@shop.com>", email_timestamp=TIMESTAMP):
+    return get_extraction_cache_key(email_text, email_subject, email_sender, email_timestamp, "v1", "model")
+
+
+def coupon(code):
+    return {"has_coupon": True, "offers": [{"offer_type": "coupon", "coupon_code": code, "offer_title": "20% off"}]}
+
+
+def test_recipient_details_map_to_the_same_key():
+    assert cache_key("Hi Anna, take 20% off. View in browser: https://shop.com/v?u=1 Sent to anna@example.com") == cache_key(
+        "Hi Ben, take 20% off. View in browser: https://shop.com/v?u=2 Sent to ben@example.com"
+    )
+
+
+def test_subject_name_prefix_is_ignored():
+    assert cache_key("Take 20% off", "Anna, our biggest sale") == cache_key("Take 20% off", "Ben, our biggest sale")
+
+
+def test_different_campaigns_get_different_keys():
+    assert cache_key("Take 20% off") != cache_key("Take 30% off")
+    assert cache_key("Take 20% off") != cache_key("Take 20% off", email_sender="Other <deals@other.com>")
+    assert cache_key("Take 20% off") != cache_key("Take 20% off", email_timestamp=datetime(2025, 1, 7))
+
+
+def test_personal_codes_are_not_shared():
+    # Both copies map to one key, so the extraction must not be shared
+    first_text = "Your code SAVE20-A8F3K2L9Q7X1 takes 20% off"
+    second_text = "Your code SAVE20-Z9Q2M4B7C1D5 takes 20% off"
+    assert cache_key(first_text) == cache_key(second_text)
+    assert not is_shareable_extraction(coupon("SAVE20-A8F3K2L9Q7X1"), first_text, "Our biggest sale")
+
+
+def test_codes_in_links_are_not_shared():
+    text = "Shop now: https://shop.com/apply?promo=QX7Y2 for 20% off"
+    assert not is_shareable_extraction(coupon("QX7Y2"), text, "Our biggest sale")
+
+
+def test_campaign_codes_are_shared():
+    text = "Use code SAVE20 at checkout. Tracking 9f8e7d6c5b4a39281706 https://shop.com/t"
+    assert is_shareable_extraction(coupon("SAVE20"), text, "Our biggest sale")
+    assert is_shareable_extraction({"has_coupon": False, "offers": []}, text, "Our biggest sale")
@@ -0,0 +1,369 @@
+"""
+Tests for Gmail delta sync (which messages a refresh reads and where the
+stored history ID moves to), campaign re-send filtering and image triage
+before OCR
+"""
+from datetime import datetime, timedelta
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from googleapiclient.errors import HttpError
+from PIL import Image
+
+import get_emails_info
+from get_emails_info import (
+    list_history_message_ids, get_new_emails_info_for_user, iter_emails_info_for_message_ids, fetch_messages_batch,
+    get_campaign_key, filter_candidate_messages,
+    get_ocr_image_links_from_html, download_image_for_ocr, get_text_from_images
+)
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeGmail:
+    """users().history().list() and users().getProfile() over a list of history pages"""
+
+    def __init__(self, history_pages, mailbox_history_id="900"):
+        self.history_pages = history_pages
+        self.mailbox_history_id = mailbox_history_id
+        self.history_calls = 0
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **kwargs):
+        page = int(kwargs.get("pageToken", 0))
+        self.history_calls += 1
+        response = {"history": self.history_pages[page]}
+        if page + 1 < len(self.history_pages):
+            response["nextPageToken"] = str(page + 1)
+        return FakeRequest(response)
+
+    def getProfile(self, userId):
+        return FakeRequest({"historyId": self.mailbox_history_id})
+
+
+def history_record(history_id, *message_ids, labels=("CATEGORY_PROMOTIONS",)):
+    return {
+        "id": history_id,
+        "messagesAdded": [{"message": {"id": message_id, "labelIds": list(labels)}} for message_id in message_ids],
+    }
+
+
+def test_lists_added_promotions_newest_first_across_pages():
+    gmail = FakeGmail([
+        [history_record("101", "m1"), history_record("102", "m2")],
+        [history_record("103", "m3"), history_record("104", "other", labels=("INBOX",))],
+    ])
+    assert list_history_message_ids(gmail, "100", max_messages=10) == (["m3", "m2", "m1"], None)
+
+
+def test_capped_delta_keeps_oldest_and_resumes_after_them():
+    gmail = FakeGmail([[history_record(str(100 + index), f"m{index}") for index in range(1, 6)]])
+    message_ids, resume_history_id = list_history_message_ids(gmail, "100", max_messages=3)
+    assert message_ids == ["m3", "m2", "m1"]
+    assert resume_history_id == "103"
+
+
+def test_capped_delta_stops_paging_once_past_the_cap():
+    gmail = FakeGmail([[history_record("101", "m1", "m2")], [history_record("102", "m3")], [history_record("103", "m4")]])
+    list_history_message_ids(gmail, "100", max_messages=1)
+    assert gmail.history_calls == 1
+
+
+def fake_email_infos(monkeypatch):
+    def iter_emails(gmail_service, message_ids, processed=None, failed_messages=None):
+        for message_id in message_ids:
+            yield message_id, {"email_text": message_id}
+    monkeypatch.setattr(get_emails_info, "iter_emails_info_for_message_ids", iter_emails)
+
+
+def test_delta_sync_moves_to_mailbox_history_id_when_complete(monkeypatch):
+    fake_email_infos(monkeypatch)
+    gmail = FakeGmail([[history_record("101", "m1"), history_record("102", "m2")]])
+    emails_info, history_id, failed_messages = get_new_emails_info_for_user(gmail, start_history_id="100")
+    assert set(emails_info) == {"m1", "m2"}
+    assert history_id == "900"
+    assert failed_messages == {}
+
+
+def test_retried_messages_are_read_with_the_delta(monkeypatch):
+    fake_email_infos(monkeypatch)
+    gmail = FakeGmail([[history_record("101", "m1", "m2")]])
+    emails_info, _, _ = get_new_emails_info_for_user(gmail, start_history_id="100", retry_message_ids=["m2", "old"])
+    assert list(emails_info) == ["m2", "m1", "old"]
+
+
+def test_capped_delta_sync_reads_everything_over_several_refreshes(monkeypatch):
+    fake_email_infos(monkeypatch)
+    monkeypatch.setattr(get_emails_info.settings, "gmail_max_messages", 2)
+    records = [history_record(str(100 + index), f"m{index}") for index in range(1, 6)]
+
+    seen = []
+    history_id = "100"
+    for _ in range(3):
+        remaining = [record for record in records if int(record["id"]) > int(history_id)]
+        emails_info, history_id, _ = get_new_emails_info_for_user(FakeGmail([remaining]), start_history_id=history_id)
+        seen.extend(emails_info)
+    assert sorted(seen) == ["m1", "m2", "m3", "m4", "m5"]
+    assert history_id == "900"
+
+
+def test_failed_read_does_not_advance_history_id(monkeypatch):
+    def failing_iter(*args, **kwargs):
+        yield "m1", {"email_text": "m1"}
+        raise RuntimeError("batch failed")
+    monkeypatch.setattr(get_emails_info, "iter_emails_info_for_message_ids", failing_iter)
+    emails_info, history_id, _ = get_new_emails_info_for_user(FakeGmail([[history_record("101", "m1", "m2")]]), start_history_id="100")
+    assert list(emails_info) == ["m1"]
+    assert history_id is None
+
+
+def http_error(status):
+    return HttpError(SimpleNamespace(status=status, reason=""), b"")
+
+
+def test_messages_that_fail_to_fetch_or_parse_are_reported(monkeypatch):
+    def fetch_messages_batch(gmail_service, message_ids, **kwargs):
+        return {"m1": "m1", "m3": "m3", "bad": "bad"}, {"m2": http_error(429), "deleted": http_error(404)}
+
+    def get_email_info_from_message(message_object):
+        if message_object == "bad":
+            raise ValueError("no payload")
+        return {"email_text": message_object, "ocr_skipped": False}
+
+    monkeypatch.setattr(get_emails_info, "fetch_messages_batch", fetch_messages_batch)
+    monkeypatch.setattr(get_emails_info, "get_email_info_from_message", get_email_info_from_message)
+    failed_messages = {}
+    read = [message_id for message_id, _ in iter_emails_info_for_message_ids(
+        None, ["m1", "m2", "m3", "bad", "deleted"], failed_messages=failed_messages
+    )]
+    assert read == ["m1", "m3"]
+    # Deleted messages can never be read, so they are not retried
+    assert set(failed_messages) == {"m2", "bad"}
+
+
+class FakeBatchGmail:
+    """users().messages().get() through new_batch_http_request(); failures maps IDs to the errors of their first attempts"""
+
+    def __init__(self, failures):
+        self.failures = {message_id: list(errors) for message_id, errors in failures.items()}
+        self.batch_sizes = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, **kwargs):
+        return id
+
+    def new_batch_http_request(self, callback):
+        gmail = self
+
+        class Batch:
+            def __init__(self):
+                self.message_ids = []
+
+            def add(self, request, request_id):
+                self.message_ids.append(request_id)
+
+            def execute(self):
+                gmail.batch_sizes.append(len(self.message_ids))
+                for message_id in self.message_ids:
+                    errors = gmail.failures.get(message_id)
+                    if errors:
+                        callback(message_id, None, errors.pop(0))
+                    else:
+                        callback(message_id, {"id": message_id}, None)
+        return Batch()
+
+
+def test_rate_limited_messages_are_retried_with_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(get_emails_info.time, "sleep", sleeps.append)
+    monkeypatch.setattr(get_emails_info.settings, "gmail_max_retries", 3)
+    gmail = FakeBatchGmail({"m2": [http_error(429), http_error(503)], "m3": [http_error(400)]})
+
+    messages, errors = fetch_messages_batch(gmail, ["m1", "m2", "m3"], format="full")
+    assert list(messages) == ["m1", "m2"]
+    # Client errors are not retried
+    assert list(errors) == ["m3"]
+    assert gmail.batch_sizes == [3, 1, 1]
+    assert len(sleeps) == 2 and sleeps[1] >= sleeps[0]
+
+
+def test_retries_give_up_after_the_limit(monkeypatch):
+    monkeypatch.setattr(get_emails_info.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(get_emails_info.settings, "gmail_max_retries", 2)
+    gmail = FakeBatchGmail({"m1": [http_error(429)] * 5})
+    messages, errors = fetch_messages_batch(gmail, ["m1"])
+    assert messages == {}
+    assert errors["m1"].resp.status == 429
+    assert gmail.batch_sizes == [1, 1, 1]
+
+
+def metadata_message(sender, subject, sent_at):
+    return {
+        "internalDate": str(int(sent_at.timestamp() * 1000)),
+        "payload": {"headers": [{"name": "From", "value": sender}, {"name": "Subject", "value": subject}]},
+    }
+
+
+def test_campaign_resend_within_window_is_skipped():
+    processed_at = datetime(2025, 1, 6, 9)
+    known_campaigns = {get_campaign_key("Shop <deals@shop.com>", "Your weekly deals"): [processed_at]}
+    messages = {
+        "resend": metadata_message("Shop <DEALS@shop.com>", "Your weekly deals", processed_at + timedelta(hours=2)),
+        "next_week": metadata_message("Shop <deals@shop.com>", "Your weekly deals", processed_at + timedelta(days=7)),
+        "other": metadata_message("Shop <deals@shop.com>", "Flash sale", processed_at + timedelta(hours=1)),
+    }
+    assert filter_candidate_messages(messages, known_campaigns=known_campaigns) == ["next_week", "other"]
+
+
+def test_known_message_ids_are_skipped_and_undated_messages_kept():
+    known_campaigns = {get_campaign_key("Shop <deals@shop.com>", "Today's offers"): [datetime(2025, 1, 6)]}
+    undated = metadata_message("Shop <deals@shop.com>", "Today's offers", datetime(2025, 1, 6))
+    del undated["internalDate"]
+    messages = {"seen": metadata_message("a@b.com", "Hi", datetime(2025, 1, 6)), "undated": undated}
+    assert filter_candidate_messages(messages, known_message_ids={"seen"}, known_campaigns=known_campaigns) == ["undated"]
+
+
+def test_only_tracking_spacer_and_social_images_are_dropped_by_url():
+    html = "".join(f'<img src="{src}">' for src in (
+        "https://ad.doubleclick.net/ddm/ad/123",
+        "https://links.shop.com/wf/open?upn=abc",
+        "https://shop.com/images/spacer.gif",
+        "https://shop.com/icons/facebook.png",
+        "https://shop.com/img/instagram-icon-white.png",
+        "https://shop.com/img/transparent-tote-20-off.jpg",
+        "https://shop.com/img/youtube-creators-sale.jpg",
+        "https://shop.com/img/pixel-phone-deal.jpg",
+    ))
+    img_links, skipped = get_ocr_image_links_from_html(html)
+    assert img_links == [
+        "https://shop.com/img/transparent-tote-20-off.jpg",
+        "https://shop.com/img/youtube-creators-sale.jpg",
+        "https://shop.com/img/pixel-phone-deal.jpg",
+    ]
+    assert skipped == 5
+
+
+def test_thin_banners_are_kept_and_tiny_images_dropped():
+    html = (
+        '<img src="https://shop.com/banner.png" width="600" height="40">'
+        '<img src="https://shop.com/badge.png" width="40" height="40">'
+        '<img src="https://shop.com/hero.png" width="600">'
+    )
+    img_links, skipped = get_ocr_image_links_from_html(html)
+    assert img_links == ["https://shop.com/banner.png", "https://shop.com/hero.png"]
+    assert skipped == 1
+
+
+class FakeImageResponse:
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+        self.headers = {"Content-Type": "image/png"}
+
+    def raise_for_status(self):
+        pass
+
+
+def png_bytes(width, height):
+    encoded = BytesIO()
+    Image.new("RGB", (width, height), "white").save(encoded, format="PNG")
+    return encoded.getvalue()
+
+
+def test_downloaded_image_size_is_checked_without_a_second_request(monkeypatch):
+    requested, stored = [], []
+    monkeypatch.setattr(get_emails_info.ocr_cache, "get_cached_url_ocr", lambda cache_key: None)
+    monkeypatch.setattr(get_emails_info.ocr_cache, "get_cached_ocr", lambda cache_key: None)
+    monkeypatch.setattr(
+        get_emails_info.ocr_cache, "store_ocr_result", lambda keys, status, text="", validators=None: stored.append(status)
+    )
+    images = {"https://shop.com/tiny.png": png_bytes(10, 10), "https://shop.com/banner.png": png_bytes(600, 40)}
+
+    def get(url, **kwargs):
+        requested.append(url)
+        return FakeImageResponse(images[url])
+    monkeypatch.setattr(get_emails_info.image_http_session, "get", get)
+
+    assert download_image_for_ocr("https://shop.com/tiny.png") == {"text": "", "skipped": True}
+    assert stored == [get_emails_info.ocr_cache.STATUS_NO_TEXT]
+    assert download_image_for_ocr("https://shop.com/banner.png")["text"] is None
+    assert requested == ["https://shop.com/tiny.png", "https://shop.com/banner.png"]
+
+
+def test_ocr_calls_respect_byte_budget_and_image_deadlines(monkeypatch):
+    monkeypatch.setattr(get_emails_info.settings, "ocr_images_per_request", 6)
+    monkeypatch.setattr(get_emails_info.settings, "ocr_request_byte_budget", 250)
+    monkeypatch.setattr(get_emails_info, "store_image_ocr_text", lambda *args: None)
+
+    def download(image_url, timeout=None):
+        if image_url == "cached":
+            return {"text": "CACHED"}
+        if image_url == "tiny":
+            return {"text": "", "skipped": True}
+        return {"text": None, "image": {"data": b"x" * 100, "name": image_url}, "cache_keys": [], "deadline": get_emails_info.time.monotonic() + 20}
+    calls = []
+
+    def ocr(images, deadline=None):
+        calls.append(([image["name"] for image in images], deadline - get_emails_info.time.monotonic()))
+        return [image["name"].upper() for image in images]
+    monkeypatch.setattr(get_emails_info, "download_image_for_ocr", download)
+    monkeypatch.setattr(get_emails_info, "gemini_ocr_images", ocr)
+
+    assert get_text_from_images(["a", "cached", "tiny", "b", "c", "d", "e"]) == ("A CACHED B C D E", 1)
+    assert sorted(names for names, _ in calls) == [["a", "b"], ["c", "d"], ["e"]]
+    assert all(0 < timeout <= 20 for _, timeout in calls)
+
+
+def test_images_past_their_deadline_are_not_sent(monkeypatch):
+    monkeypatch.setattr(get_emails_info, "gemini_ocr_images", lambda images, deadline=None: pytest.fail("called Gemini"))
+    expired = {"image": {"data": b"x"}, "cache_keys": [], "deadline": get_emails_info.time.monotonic() - 1}
+    assert get_emails_info.ocr_downloaded_images([expired]) == [""]
+
+
+class RecordingLookup:
+    """Processed-email lookup that records which IDs and campaigns it was asked about"""
+
+    def __init__(self, message_ids, campaigns):
+        self.message_ids = message_ids
+        self.campaigns = campaigns
+        self.calls = []
+
+    def known_message_ids(self, message_ids):
+        self.calls.append(list(message_ids))
+        return self.message_ids & set(message_ids)
+
+    def known_campaigns(self, campaign_keys):
+        return {key: dates for key, dates in self.campaigns.items() if key in campaign_keys}
+
+
+def test_processed_emails_are_looked_up_one_batch_at_a_time(monkeypatch):
+    monkeypatch.setattr(get_emails_info.settings, "gmail_batch_size", 2)
+    sent_at = datetime(2025, 1, 6, 9)
+    subjects = {"m1": "Sale", "m2": "Sale", "m3": "New arrivals", "m4": "Seen"}
+
+    def fetch_messages_batch(gmail_service, message_ids, **kwargs):
+        return {message_id: metadata_message("Shop <deals@shop.com>", subjects[message_id], sent_at) for message_id in message_ids}, {}
+    monkeypatch.setattr(get_emails_info, "fetch_messages_batch", fetch_messages_batch)
+    monkeypatch.setattr(get_emails_info, "get_email_info_from_message", lambda message: {"email_text": "", "ocr_skipped": True})
+
+    lookup = RecordingLookup({"m4"}, {get_campaign_key("deals@shop.com", "Sale"): [sent_at]})
+    read = [message_id for message_id, _ in iter_emails_info_for_message_ids(None, ["m1", "m2", "m3", "m4"], processed=lookup)]
+    assert read == ["m3"]
+    assert lookup.calls == [["m1", "m2"], ["m3", "m4"]]
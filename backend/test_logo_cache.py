@@ -0,0 +1,56 @@
+"""
+Tests for the per-domain company logo cache, including cached misses
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import logo_cache
+from auth.models import CompanyLogoEntry
+
+
+@pytest.fixture
+def cache_db(monkeypatch, memory_session_local):
+    monkeypatch.setattr(logo_cache, "SessionLocal", memory_session_local)
+    monkeypatch.setattr(logo_cache, "_memory", logo_cache.OrderedDict())
+    return memory_session_local
+
+
+def age_entry(session_local, domain, **age):
+    db = session_local()
+    entry = db.query(CompanyLogoEntry).filter(CompanyLogoEntry.domain == domain).first()
+    entry.created_at = datetime.utcnow() - timedelta(**age)
+    db.commit()
+    db.close()
+
+
+def test_logo_is_served_from_the_database_after_a_restart(cache_db):
+    logo_cache.store_logo("shop.com", "https://logo.dev/shop.com.png")
+    logo_cache._memory.clear()
+    assert logo_cache.get_cached_logo("shop.com") == "https://logo.dev/shop.com.png"
+
+
+def test_miss_is_cached_for_the_negative_ttl_only(cache_db):
+    logo_cache.store_logo("nologo.com", None)
+    assert logo_cache.get_cached_logo("nologo.com") == logo_cache.NO_LOGO
+
+    logo_cache._memory.clear()
+    age_entry(cache_db, "nologo.com", hours=logo_cache.settings.logo_cache_negative_ttl_hours + 1)
+    assert logo_cache.get_cached_logo("nologo.com") is None
+
+
+def test_unknown_domain_is_a_miss(cache_db):
+    assert logo_cache.get_cached_logo("unknown.com") is None
+
+
+def test_prune_evicts_least_recently_used_beyond_the_limit(cache_db, monkeypatch):
+    for domain in ("a.com", "b.com", "c.com"):
+        logo_cache.store_logo(domain, f"https://logo.dev/{domain}.png")
+    logo_cache._memory.clear()
+    logo_cache.get_cached_logo("a.com")
+
+    monkeypatch.setattr(logo_cache.settings, "logo_cache_max_entries", 2)
+    logo_cache.prune_logo_cache()
+    db = cache_db()
+    assert sorted(entry.domain for entry in db.query(CompanyLogoEntry)) == ["a.com", "c.com"]
+    db.close()
@@ -0,0 +1,60 @@
+"""
+Tests for the OCR cache keys and for revalidating URL entries whose image may have changed
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import ocr_cache
+from auth.models import OcrCacheEntry
+from ocr_cache import normalize_image_url, url_cache_key
+
+
+@pytest.fixture
+def cache_db(monkeypatch, memory_session_local):
+    monkeypatch.setattr(ocr_cache, "SessionLocal", memory_session_local)
+    return memory_session_local
+
+
+def age_entry(session_local, cache_key, hours):
+    db = session_local()
+    entry = db.query(OcrCacheEntry).filter(OcrCacheEntry.cache_key == cache_key).first()
+    entry.created_at = datetime.utcnow() - timedelta(hours=hours)
+    db.commit()
+    db.close()
+
+
+def test_campaign_tracking_params_are_dropped():
+    assert normalize_image_url("HTTPS://Shop.com/b.png?utm_source=email&w=600&fbclid=1#top") == "https://shop.com/b.png?w=600"
+
+
+def test_recipient_params_stay_in_the_key():
+    assert url_cache_key("https://shop.com/code.png?uid=1") != url_cache_key("https://shop.com/code.png?uid=2")
+    assert url_cache_key("https://shop.com/code.png?email=a%40b.com") != url_cache_key("https://shop.com/code.png")
+
+
+def test_fresh_url_entry_is_trusted(cache_db):
+    key = url_cache_key("https://shop.com/banner.png")
+    ocr_cache.store_ocr_result([key], ocr_cache.STATUS_OK, "20% OFF")
+    cached = ocr_cache.get_cached_url_ocr(key)
+    assert (cached["text"], cached["fresh"]) == ("20% OFF", True)
+
+
+def test_old_url_entry_without_validators_is_a_miss(cache_db):
+    key = url_cache_key("https://shop.com/banner.png")
+    content_key = ocr_cache.content_cache_key(b"banner")
+    ocr_cache.store_ocr_result([key, content_key], ocr_cache.STATUS_OK, "20% OFF")
+    for cache_key in (key, content_key):
+        age_entry(cache_db, cache_key, ocr_cache.settings.ocr_cache_url_ttl_hours + 1)
+    assert ocr_cache.get_cached_url_ocr(key) is None
+    # Image bytes can't change under their hash, so the content entry is still used after a re-download
+    assert ocr_cache.get_cached_ocr(content_key) == (ocr_cache.STATUS_OK, "20% OFF")
+
+
+def test_old_url_entry_with_validators_is_revalidated(cache_db):
+    key = url_cache_key("https://shop.com/banner.png")
+    ocr_cache.store_ocr_result([key], ocr_cache.STATUS_OK, "20% OFF", validators={"etag": '"v1"', "last_modified": None})
+    age_entry(cache_db, key, ocr_cache.settings.ocr_cache_url_ttl_hours + 1)
+    cached = ocr_cache.get_cached_url_ocr(key)
+    assert cached["fresh"] is False
+    assert ocr_cache.revalidation_headers(cached) == {"If-None-Match": '"v1"'}
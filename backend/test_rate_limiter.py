@@ -0,0 +1,110 @@
+"""
+Tests for the shared Gemini rate limiter: token buckets, the adaptive
+concurrency limit and which errors are retried
+"""
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from core import rate_limiter
+from core.rate_limiter import TokenBucket, AdaptiveConcurrencyLimit, GeminiRateLimiter
+
+DAILY_QUOTA_ERROR = google_exceptions.ResourceExhausted(
+    "You exceeded your current quota. Quota exceeded for quota id: GenerateRequestsPerDayPerProjectPerModel-FreeTier"
+)
+MINUTE_QUOTA_ERROR = google_exceptions.ResourceExhausted(
+    "You exceeded your current quota. Quota exceeded for quota id: GenerateRequestsPerMinutePerProjectPerModel"
+)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_limiter.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_token_bucket_charges_and_refunds():
+    bucket = TokenBucket(100)
+    bucket.acquire(60)
+    assert bucket.available == pytest.approx(40, abs=1)
+    bucket.adjust(60)
+    assert bucket.available == pytest.approx(100)
+
+
+def test_token_bucket_without_limit_never_blocks():
+    TokenBucket(0).acquire(10 ** 9)
+
+
+def test_concurrency_limit_halves_on_throttle_and_grows_only_on_success():
+    limit = AdaptiveConcurrencyLimit(8)
+    limit.acquire()
+    limit.release(throttled=True)
+    assert limit.limit == 4
+    limit.acquire()
+    limit.release(succeeded=False)
+    assert limit.limit == 4
+    limit.acquire()
+    limit.release()
+    assert limit.limit == pytest.approx(4.25)
+
+
+class FlakyCall:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_per_minute_quota_is_retried(no_backoff_sleep):
+    limiter = GeminiRateLimiter(0, 0, 4)
+    call = FlakyCall(MINUTE_QUOTA_ERROR, MINUTE_QUOTA_ERROR)
+    assert limiter.call(call) == "ok"
+    assert call.calls == 3
+    assert len(no_backoff_sleep) == 2
+
+
+def test_daily_quota_fails_fast(no_backoff_sleep):
+    limiter = GeminiRateLimiter(0, 0, 4)
+    call = FlakyCall(DAILY_QUOTA_ERROR)
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        limiter.call(call)
+    assert call.calls == 1
+    assert no_backoff_sleep == []
+
+
+def test_failed_attempts_refund_tokens_and_keep_the_limit():
+    limiter = GeminiRateLimiter(0, 10000, 4)
+    limiter.concurrency.limit = 2.0
+    with pytest.raises(ValueError):
+        limiter.call(FlakyCall(ValueError("bad request")), estimated_tokens=5000)
+    assert limiter.tokens.available == pytest.approx(10000)
+    assert limiter.concurrency.limit == 2.0
+
+
+def test_deadline_caps_the_attempt_timeout_and_stops_retries(monkeypatch, no_backoff_sleep):
+    monkeypatch.setattr(rate_limiter.settings, "gemini_backoff_base_seconds", 5.0)
+    limiter = GeminiRateLimiter(0, 0, 4)
+    timeouts = []
+
+    def call(request_options):
+        timeouts.append(request_options["timeout"])
+        raise MINUTE_QUOTA_ERROR
+
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        limiter.call(call, request_options={"timeout": 30}, deadline=rate_limiter.time.monotonic() + 2)
+    # A backoff of at least 2.5s would end past the deadline, so there is no retry
+    assert len(timeouts) == 1 and 0 < timeouts[0] <= 2
+    assert no_backoff_sleep == []
+
+
+def test_rate_limit_waits_end_at_the_deadline():
+    limiter = GeminiRateLimiter(60, 0, 4)
+    limiter.requests.available = 0.0
+    with pytest.raises(TimeoutError):
+        limiter.call(pytest.fail, deadline=rate_limiter.time.monotonic() + 0.05)
+    assert limiter.concurrency.in_flight == 0
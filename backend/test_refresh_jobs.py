@@ -0,0 +1,123 @@
+"""
+Tests for background refresh jobs, their final status write and telling
+stale jobs from ones that are queued or waiting
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import refresh_jobs
+from auth.crud import create_refresh_job, get_refresh_job
+from auth.models import User, RefreshJob
+
+
+@pytest.fixture
+def jobs_db(monkeypatch, memory_session_local):
+    monkeypatch.setattr(refresh_jobs, "SessionLocal", memory_session_local)
+    monkeypatch.setattr(refresh_jobs.time, "sleep", lambda seconds: None)
+    db = memory_session_local()
+    user = User(email="a@shop.com", google_id="g1", gmail_connected=True, gmail_access_token="token")
+    db.add(user)
+    db.commit()
+    job_id, user_id = create_refresh_job(db, user.id).id, user.id
+    db.close()
+    return memory_session_local, job_id, user_id
+
+
+def job_status(session_local, job_id):
+    db = session_local()
+    try:
+        job = get_refresh_job(db, job_id)
+        return job.status, job.coupons_found
+    finally:
+        db.close()
+
+
+def test_succeeded_status_is_written_after_transient_failures(jobs_db, monkeypatch):
+    session_local, job_id, user_id = jobs_db
+    monkeypatch.setattr(
+        refresh_jobs, "refresh_coupons_for_user",
+        lambda db, user, progress=None: {"new_coupons": [{"id": 1}], "cached_coupons": [], "emails_processed": 3}
+    )
+    failures = [RuntimeError("database is locked")] * 2
+    real_update = refresh_jobs.update_refresh_job
+
+    def flaky_update(db, job_id, **fields):
+        if fields.get("status") == "succeeded" and failures:
+            raise failures.pop()
+        return real_update(db, job_id, **fields)
+    monkeypatch.setattr(refresh_jobs, "update_refresh_job", flaky_update)
+
+    refresh_jobs.run_refresh_job(job_id, user_id)
+    assert job_status(session_local, job_id) == ("succeeded", 1)
+
+
+def test_final_write_error_surfaces_once_attempts_run_out(jobs_db, monkeypatch):
+    _, job_id, _ = jobs_db
+    monkeypatch.setattr(refresh_jobs.settings, "refresh_job_final_write_attempts", 2)
+
+    def failing_update(db, job_id, **fields):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(refresh_jobs, "update_refresh_job", failing_update)
+
+    with pytest.raises(RuntimeError):
+        refresh_jobs.RefreshJobProgress(job_id).finish(status="failed")
+
+
+def test_failed_refresh_is_reported(jobs_db, monkeypatch):
+    session_local, job_id, user_id = jobs_db
+
+    def failing_refresh(db, user, progress=None):
+        raise RuntimeError("Gmail API error")
+    monkeypatch.setattr(refresh_jobs, "refresh_coupons_for_user", failing_refresh)
+
+    refresh_jobs.run_refresh_job(job_id, user_id)
+    assert job_status(session_local, job_id)[0] == "failed"
+
+
+def age_job(session_local, job_id, minutes):
+    db = session_local()
+    db.query(RefreshJob).filter(RefreshJob.id == job_id).update({"updated_at": datetime.utcnow() - timedelta(minutes=minutes)})
+    db.commit()
+    db.close()
+
+
+def status_check(session_local, job_id):
+    db = session_local()
+    try:
+        return refresh_jobs.get_refresh_job_status(db, job_id).status
+    finally:
+        db.close()
+
+
+def test_heartbeat_keeps_a_queued_job_from_going_stale(jobs_db, monkeypatch):
+    session_local, job_id, _ = jobs_db
+    monkeypatch.setattr(refresh_jobs, "_active_jobs", {job_id})
+    age_job(session_local, job_id, 60)
+    refresh_jobs.touch_active_jobs()
+    assert status_check(session_local, job_id) == "queued"
+
+    # Once no process sends heartbeats for it, the job is reported stale
+    age_job(session_local, job_id, 60)
+    monkeypatch.setattr(refresh_jobs, "_active_jobs", set())
+    refresh_jobs.touch_active_jobs()
+    assert status_check(session_local, job_id) == "failed"
+
+
+def test_job_reported_stale_records_its_real_result(jobs_db):
+    session_local, job_id, _ = jobs_db
+    age_job(session_local, job_id, 60)
+    assert status_check(session_local, job_id) == "failed"
+
+    refresh_jobs.RefreshJobProgress(job_id).finish(status="succeeded", coupons_found=2)
+    db = session_local()
+    job = get_refresh_job(db, job_id)
+    assert (job.status, job.coupons_found, job.error) == ("succeeded", 2, None)
+    db.close()
+
+
+def test_finished_job_is_not_overwritten(jobs_db):
+    session_local, job_id, _ = jobs_db
+    refresh_jobs.RefreshJobProgress(job_id).finish(status="failed", error="Gmail not connected")
+    refresh_jobs.RefreshJobProgress(job_id).finish(status="succeeded")
+    assert job_status(session_local, job_id)[0] == "failed"
@@ -0,0 +1,43 @@
+"""
+Tests for the deterministic coupon extraction that lets clear offers skip Gemini
+"""
+from datetime import datetime
+
+from rule_extractor import extract_offers_with_rules, CONFIDENCE_AMBIGUOUS, CONFIDENCE_WITH_CODE
+
+SENDER = "Shop <deals@shop.com>"
+SENT_AT = datetime(2026, 10, 14, 9)
+
+
+def extract(email_text, email_subject="Sale"):
+    return extract_offers_with_rules(email_text, email_subject, SENDER, SENT_AT)
+
+
+def test_code_with_keyword_is_confident():
+    coupon_info, confidence = extract("Take 30% off your entire purchase with code FALL30. Offer ends 10/20.")
+    offer = coupon_info["offers"][0]
+    assert (offer["offer_type"], offer["discount_amount"], offer["coupon_code"]) == ("coupon", "30%", "FALL30")
+    assert offer["expiry_date"] == "2026-10-20"
+    assert confidence == CONFIDENCE_WITH_CODE
+
+
+def test_zip_code_is_not_a_coupon_code():
+    coupon_info, confidence = extract("Visit our store, zip code 94105. 20% off everything this weekend.")
+    offer = coupon_info["offers"][0]
+    assert offer["coupon_code"] is None
+    assert offer["offer_type"] == "discount"
+    assert confidence < CONFIDENCE_WITH_CODE
+
+
+def test_digit_code_next_to_an_address_is_ignored():
+    coupon_info, _ = extract("Enter code 94105 at 500 Berry Street, San Francisco, CA 94105 for 20% off.")
+    assert coupon_info["offers"][0]["coupon_code"] is None
+
+
+def test_extra_percentage_makes_the_email_ambiguous():
+    _, confidence = extract("Get $10 off orders of $50+ with promo code PUP10. Autoship customers save an extra 5%.")
+    assert confidence == CONFIDENCE_AMBIGUOUS
+
+
+def test_no_offer_returns_nothing():
+    assert extract("Your order has shipped and arrives Tuesday.", "Shipping update") == (None, 0.0)
@@ -137,6 +137,52 @@ export const HomeScreen = ({ route }) => {
     );
   };
 
+  // Flatten coupon groups (one per email) into offers and group them by company
+  const showCouponGroups = (couponGroups) => {
+    const allOffers = [];
+    couponGroups.forEach((couponGroup) => {
+      if (couponGroup.offers) {
+        couponGroup.offers.forEach((offer, index) => {
+          allOffers.push({ 
+            ...offer, 
+            message_id: couponGroup.message_id,
+            email_sender: couponGroup.sender,
+            email_subject: couponGroup.subject,
+            email_timestamp: couponGroup.timestamp,
+            email_sender_company: couponGroup.email_sender_company,
+            company: couponGroup.company,
+            company_domain: couponGroup.company_domain,
+            company_logo_url: couponGroup.company_logo_url,
+            company_category: couponGroup.company_category,
+            isFavorite: false 
+          });
+        });
+      }
+    });
+
+    setCoupons(allOffers);
+
+    // Group offers by company
+    const companiesMap = {};
+    allOffers.forEach(offer => {
+      const companyName = offer.email_sender_company || offer.company || 'Unknown Company';
+      if (!companiesMap[companyName]) {
+        companiesMap[companyName] = {
+          name: companyName,
+          company_logo_url: offer.company_logo_url,
+          company_domain: offer.company_domain,
+          company_category: offer.company_category,
+          offers: []
+        };
+      }
+      companiesMap[companyName].offers.push(offer);
+    });
+
+    const companiesArray = Object.values(companiesMap);
+    setCompanies(companiesArray);
+    return { offerCount: allOffers.length, companyCount: companiesArray.length };
+  };
+
   const loadCoupons = async (forceRefresh = false) => {
     try {
       setLoading(true);
@@ -195,59 +241,33 @@ export const HomeScreen = ({ route }) => {
       
       console.log('Authentication successful, fetching coupons...');
       
-      // Call the real API
-      const result = await CouponService.getCoupons(token, forceRefresh);
+      // Stream the real API, so coupons show up as soon as their emails are processed
+      let cachedGroups = [];
+      const newGroups = [];
+      const result = await CouponService.streamCoupons(token, forceRefresh, {
+        onCached: (couponGroups) => {
+          cachedGroups = couponGroups;
+          if (cachedGroups.length) {
+            showCouponGroups(cachedGroups);
+            setLoading(false);
+          }
+        },
+        onCoupon: (couponGroup) => {
+          newGroups.push(couponGroup);
+          showCouponGroups([...newGroups, ...cachedGroups]);
+          setLoading(false);
+        },
+        onProgress: (progress) => {
+          console.log(`Refresh ${progress.stage}: ${progress.emails_extracted}/${progress.emails_total ?? '?'} emails processed`);
+        },
+      });
       
       if (result.success && result.data) {
         console.log('Successfully fetched real coupon data:', result.data);
-        
-        // Process the real API data
-        const allOffers = [];
-        if (result.data.all_coupons) {
-          result.data.all_coupons.forEach((couponGroup) => {
-            if (couponGroup.offers) {
-              couponGroup.offers.forEach((offer, index) => {
-                allOffers.push({ 
-                  ...offer, 
-                  message_id: couponGroup.message_id,
-                  email_sender: couponGroup.sender,
-                  email_subject: couponGroup.subject,
-                  email_timestamp: couponGroup.timestamp,
-                  email_sender_company: couponGroup.email_sender_company,
-                  company: couponGroup.company,
-                  company_domain: couponGroup.company_domain,
-                  company_logo_url: couponGroup.company_logo_url,
-                  company_category: couponGroup.company_category,
-                  isFavorite: false 
-                });
-              });
-            }
-          });
-        }
-        
-        setCoupons(allOffers);
-        
-        // Group offers by company
-        const companiesMap = {};
-        allOffers.forEach(offer => {
-          const companyName = offer.email_sender_company || offer.company || 'Unknown Company';
-          if (!companiesMap[companyName]) {
-            companiesMap[companyName] = {
-              name: companyName,
-              company_logo_url: offer.company_logo_url,
-              company_domain: offer.company_domain,
-              company_category: offer.company_category,
-              offers: []
-            };
-          }
-          companiesMap[companyName].offers.push(offer);
-        });
-        
-        const companiesArray = Object.values(companiesMap);
-        setCompanies(companiesArray);
+        const { offerCount, companyCount } = showCouponGroups(result.data.all_coupons || []);
         setLastUpdated(new Date());
         
-        console.log(`Loaded ${allOffers.length} offers from ${companiesArray.length} companies`);
+        console.log(`Loaded ${offerCount} offers from ${companyCount} companies`);
         
       } else {
         console.error('Failed to fetch coupon data:', result.error);
@@ -79,6 +79,111 @@ class CouponService {
     }
   }
 
+  /**
+   * Stream coupons from user's Gmail as they are extracted (newline-delimited JSON)
+   * Uses XMLHttpRequest because React Native's fetch doesn't expose a streaming body.
+   * @param {string} token - JWT token
+   * @param {boolean} refresh - Force refresh from Gmail instead of using cache
+   * @param {{onCached?: Function, onCoupon?: Function, onProgress?: Function}} handlers -
+   *   onCached(coupons) with previously saved coupons, onCoupon(coupon) for each new
+   *   coupon, onProgress({stage, emails_fetched, emails_extracted, emails_total})
+   * @returns {Promise<{success: boolean, data?: any, error?: string}>} Same data as getCoupons once the stream ends
+   */
+  streamCoupons(token, refresh = false, handlers = {}) {
+    return new Promise((resolve) => {
+      const url = refresh
+        ? `${API_BASE_URL}/api/coupons/stream?refresh=true`
+        : `${API_BASE_URL}/api/coupons/stream`;
+      const xhr = new XMLHttpRequest();
+      let readOffset = 0;
+      let cachedCoupons = [];
+      const newCoupons = [];
+      let result = null;
+
+      const handleEvent = (event) => {
+        switch (event.type) {
+          case 'cached':
+            cachedCoupons = event.coupons || [];
+            handlers.onCached?.(cachedCoupons);
+            break;
+          case 'coupon':
+            newCoupons.push(event.coupon);
+            handlers.onCoupon?.(event.coupon);
+            break;
+          case 'progress':
+            handlers.onProgress?.(event);
+            break;
+          case 'done':
+            result = {
+              success: true,
+              data: {
+                // Newest emails first, followed by previously cached coupons
+                all_coupons: [...newCoupons, ...cachedCoupons],
+                total_emails_processed: event.total_emails_processed,
+                emails_with_coupons: event.emails_with_coupons,
+              },
+            };
+            break;
+          case 'error':
+            result = { success: false, error: event.detail || 'Failed to get coupons' };
+            break;
+        }
+      };
+
+      // Parse the complete lines received since the last call
+      const readEvents = () => {
+        const text = xhr.responseText || '';
+        const end = text.lastIndexOf('\n') + 1;
+        if (end <= readOffset) {
+          return;
+        }
+        const lines = text.substring(readOffset, end).split('\n');
+        readOffset = end;
+        lines.forEach((line) => {
+          if (!line.trim()) {
+            return;
+          }
+          try {
+            handleEvent(JSON.parse(line));
+          } catch (error) {
+            console.error('Failed to parse coupon stream event:', error);
+          }
+        });
+      };
+
+      xhr.open('GET', url);
+      xhr.setRequestHeader('Authorization', `Bearer ${token}`);
+      xhr.setRequestHeader('Accept', 'application/x-ndjson');
+      xhr.onprogress = () => {
+        if (xhr.status === 200) {
+          readEvents();
+        }
+      };
+      xhr.onload = () => {
+        if (xhr.status !== 200) {
+          let detail = 'Failed to get coupons';
+          try {
+            detail = JSON.parse(xhr.responseText).detail || detail;
+          } catch (error) {
+            // Not a JSON error body
+          }
+          resolve({ success: false, error: detail });
+          return;
+        }
+        readEvents();
+        resolve(result || { success: false, error: 'Coupon stream ended unexpectedly' });
+      };
+      xhr.onerror = () => {
+        console.error('Stream coupons network error');
+        resolve({
+          success: false,
+          error: 'Network error. Please check your connection.',
+        });
+      };
+      xhr.send();
+    });
+  }
+
   /**
    * Get HTML content of a specific email
    * @param {string} messageId - Gmail message ID